@@ -0,0 +1,97 @@
+"""Analytics page series and charts, cached per user and data version.
+
+Receipts only change through receipt_store.save_receipt, which bumps
+User.data_version. Computed results are therefore reused until that version
+moves, and the cache keeps at most config.ANALYTICS_CACHE_MAX_USERS users,
+evicting the least recently viewed.
+"""
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+import plotly.express as px
+
+import config
+from models import Receipt
+from queries import spending_by_day, spending_by_category, spending_by_vendor
+
+CHART_LAYOUT = dict(height=320, margin=dict(t=30, b=0, l=0, r=0), plot_bgcolor='rgba(0,0,0,0)', paper_bgcolor='rgba(0,0,0,0)')
+
+
+class AnalyticsCache:
+    """Thread-safe LRU of {user_id: (data_version, analytics)}."""
+
+    def __init__(self, max_users):
+        self.max_users = max_users
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, data_version):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] != data_version:
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def put(self, user_id, data_version, analytics):
+        with self._lock:
+            self._entries[user_id] = (data_version, analytics)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = AnalyticsCache(config.ANALYTICS_CACHE_MAX_USERS)
+
+
+def compute_series(session, user_id):
+    """Return the monthly, weekly, category and vendor spending series for a user."""
+    # Monthly and weekly trends are rolled up from per-day totals computed in the database
+    df = pd.DataFrame(spending_by_day(session, user_id), columns=['date', 'amount'])
+    df['date'] = pd.to_datetime(df['date'])
+    df['month'] = df['date'].dt.to_period('M').astype(str)
+    df['week'] = df['date'].dt.to_period('W').astype(str)
+
+    return {
+        'monthly': df.groupby('month')['amount'].sum().reset_index(),
+        'weekly': df.groupby('week')['amount'].sum().reset_index(),
+        'category': pd.DataFrame(list(spending_by_category(session, user_id).items()), columns=['category', 'amount']).sort_values('amount', ascending=False),
+        'vendor': pd.DataFrame(spending_by_vendor(session, user_id, limit=10), columns=['vendor', 'amount']),
+    }
+
+
+def build_figures(series):
+    """Build the four Analytics charts from computed series."""
+    fig_month = px.bar(series['monthly'], x='month', y='amount', labels={'amount': 'Total Spent ($)'}, color='amount', color_continuous_scale='Blues')
+    fig_week = px.line(series['weekly'], x='week', y='amount', markers=True, labels={'amount': 'Total Spent ($)'})
+    fig_cat = px.bar(series['category'], x='category', y='amount', color='amount', color_continuous_scale='Teal', labels={'amount': 'Total Spent ($)'})
+    fig_vendor = px.bar(series['vendor'], x='vendor', y='amount', color='amount', color_continuous_scale='Oranges', labels={'amount': 'Total Spent ($)'})
+    figures = {'monthly': fig_month, 'weekly': fig_week, 'category': fig_cat, 'vendor': fig_vendor}
+    for fig in figures.values():
+        fig.update_layout(**CHART_LAYOUT)
+    return figures
+
+
+def get_user_analytics(session, user):
+    """Return the user's analytics, computing them only when their data version changed.
+
+    The result is a dict with 'has_receipts', 'has_items', 'series' and 'figures'.
+    Figures are shared between sessions and must not be mutated by callers.
+    """
+    analytics = _cache.get(user.id, user.data_version)
+    if analytics is not None:
+        return analytics
+
+    analytics = {'has_receipts': False, 'has_items': False, 'series': None, 'figures': None}
+    analytics['has_receipts'] = session.query(Receipt.id).filter_by(user_id=user.id).first() is not None
+    if analytics['has_receipts']:
+        series = compute_series(session, user.id)
+        if not series['monthly'].empty:
+            analytics.update(has_items=True, series=series, figures=build_figures(series))
+    _cache.put(user.id, user.data_version, analytics)
+    return analytics
@@ -1,29 +1,29 @@
 # NOTE: Before running this app, make sure to install dependencies:
 # pip install -r requirements.txt
 
+# Heavy libraries (pandas, numpy, plotly.express, the export writers, the extraction
+# stack and model SDKs) are imported by the pages and actions that use them, so the
+# login page renders without them. Streamlit itself already loads PIL.
 import streamlit as st
 import os
-import json
-from PIL import Image
 import tempfile
-import subprocess
-import sys
-import pandas as pd
-import plotly.express as px
-import openai
 import base64
 import io
-import csv
 from datetime import datetime
-from process_receipt import process_receipt
-from export_utils import export_to_csv, export_to_excel, export_to_pdf
+from functools import partial
 import hashlib # Import hashlib for image hashing
+import html
 import os.path
 from auth_pages import show_login_page, show_register_page
-from models import Session, User, Receipt, Budget
+from models import Session, session_scope, User, Receipt, Budget
+from migrations import run_migrations
+from queries import CATEGORIES, receipt_months, monthly_spend_by_category, has_receipt_with_hash
+from tracing import trace, span, read_recent_spans, stage_stats, slowest_traces
+import config
+import extraction_cache
 
-# Set OpenAI API key
-openai.api_key = "ADD YOU OPENAI API KEY HERE"
+# Create tables and apply pending schema upgrades and backfills (runs once per process)
+run_migrations()
 
 # Initialize session state variables
 if 'authenticated' not in st.session_state:
@@ -42,6 +42,8 @@ if not st.session_state['authenticated']:
     st.stop()
 
 def encode_image(image_path):
+    from PIL import Image
+
     with Image.open(image_path) as image:
         buffered = io.BytesIO()
         image.save(buffered, format="JPEG")
@@ -56,22 +58,227 @@ def calculate_image_hash(image_content):
     hasher.update(image_content)
     return hasher.hexdigest()
 
-# Function to load existing image hashes from the log file
-def load_existing_hashes():
-    log_file = "data/gpt_usage_log.csv"
-    existing_hashes = set()
-    if os.path.exists(log_file) and os.path.getsize(log_file) > 0: # Check if file exists and is not empty
-        try:
-            # Read only the 'image_hash' column
-            df = pd.read_csv(log_file, usecols=["image_hash"], dtype=str)
-            existing_hashes = set(df["image_hash"].dropna().unique()) # Add non-null unique hashes to set
-        except pd.errors.EmptyDataError: # Handle empty file case
-            st.warning(f"Log file '{log_file}' is empty.")
-        except KeyError: # Handle case where 'image_hash' column is missing (e.g. old log file format)
-            st.warning(f"'image_hash' column not found in '{log_file}'. Please ensure the log file is correctly formatted.")
-        except Exception as e:
-            st.error(f"Error reading log file {log_file}: {e}")
-    return existing_hashes
+# Check for an earlier upload of the same image by this user (indexed on user_id, image_hash)
+def is_duplicate_receipt(user_email, image_hash):
+    session = Session()
+    try:
+        return has_receipt_with_hash(session, user_email, image_hash)
+    finally:
+        session.close()
+
+# Perceptual hash of an upload; computed once per image (the bytes are not hashed by the cache)
+@st.cache_data(max_entries=32, show_spinner=False)
+def get_upload_phash(image_hash, _image_bytes):
+    from perceptual_hash import phash_bytes
+
+    return phash_bytes(_image_bytes)
+
+# Closest earlier receipt whose image looks the same, as (vendor, date, distance), or None
+def find_similar_receipt(user_email, phash):
+    from perceptual_hash import find_near_duplicates
+
+    session = Session()
+    try:
+        user = session.query(User).filter_by(email=user_email).first()
+        matches = find_near_duplicates(session, user.id, phash, limit=1) if user else []
+        if not matches:
+            return None
+        receipt, distance = matches[0]
+        return receipt.vendor, receipt.date, distance
+    finally:
+        session.close()
+
+# Build one export file for the displayed receipt. Only receipt_hash and export_format
+# are part of the cache key; the underscored arguments are the data they identify.
+@st.cache_data(max_entries=64, show_spinner=False)
+def build_export(receipt_hash, export_format, _store, _txn, _items, _pie_data):
+    from export_utils import export_to_csv, export_to_excel, export_to_pdf
+
+    if export_format == "csv":
+        return export_to_csv(_store, _txn, _items)
+    if export_format == "excel":
+        return export_to_excel(_store, _txn, _items, _pie_data)
+    return export_to_pdf(_store, _txn, _items, _pie_data)
+
+# Category icons for the item grid
+CATEGORY_ICONS = {
+    "Food": "🛒",
+    "Electronics": "💻",
+    "Services": "🛠️",
+    "Personal Care": "🧴",
+    "Household": "🏠",
+    "Other": "📦"
+}
+
+# Build the Categorized Items grid as one HTML block per non-empty category,
+# so a long receipt renders with one st.markdown call per column
+def item_card_blocks(items):
+    cat_dict = {cat: [] for cat in CATEGORIES}
+    for item in items:
+        # Results extracted before category validation may carry other labels
+        cat = item.get("category")
+        cat_dict[cat if cat in cat_dict else "Other"].append(item)
+
+    blocks = []
+    for cat in CATEGORIES:
+        if not cat_dict[cat]:
+            continue
+        cards = "".join(
+            f"<div class='item-card'>"
+            f"<div class='item-title'>{html.escape(str(item['name']))}</div>"
+            f"<div class='item-desc'>{html.escape(str(item.get('description', '')))}</div>"
+            f"<div class='item-detail'><b>Qty:</b> <span class='item-qty'>{html.escape(str(item['quantity']))}</span></div>"
+            f"<div class='item-detail'><b>Price:</b> <span class='item-price'>${item['price']:.2f}</span></div>"
+            f"<div class='item-detail'><b>Subtotal:</b> <span class='item-subtotal'>${item['subtotal']:.2f}</span></div>"
+            f"</div>"
+            for item in cat_dict[cat]
+        )
+        blocks.append((
+            cat,
+            f"<div class='category-card'>"
+            f"<div style='font-size:1.2em;font-weight:bold;color:var(--primary-color);margin-bottom:0.5em;'>{CATEGORY_ICONS[cat]} {cat} ({len(cat_dict[cat])})</div>"
+            f"{cards}</div>"
+        ))
+    return blocks
+
+# Item grid of the displayed receipt, cached by receipt_hash; _items is the data it identifies
+@st.cache_data(max_entries=64, show_spinner=False)
+def build_item_cards(receipt_hash, _items):
+    return item_card_blocks(_items)
+
+def show_item_cards(category_blocks):
+    if category_blocks:
+        cols = st.columns(len(category_blocks))
+        for col, (cat, block) in zip(cols, category_blocks):
+            with col:
+                st.markdown(block, unsafe_allow_html=True)
+
+# Stream the user's receipt history (optionally date-filtered) into a temporary file on disk
+def build_history_csv(user_id, start_date, end_date):
+    from export_utils import iter_history_csv
+
+    history_file = tempfile.TemporaryFile()
+    session = Session()
+    try:
+        for chunk in iter_history_csv(session, user_id, start_date, end_date):
+            history_file.write(chunk)
+    finally:
+        session.close()
+    history_file.seek(0)
+    return history_file
+
+# Write the user's history workbook (items, monthly summary, category pivot) to a temporary file
+def build_history_excel(user_id, start_date, end_date):
+    from export_utils import export_history_to_excel
+
+    history_file = tempfile.TemporaryFile()
+    session = Session()
+    try:
+        export_history_to_excel(session, user_id, history_file, start_date, end_date)
+    finally:
+        session.close()
+    history_file.seek(0)
+    return history_file
+
+def get_user_id(user_email):
+    session = Session()
+    try:
+        user = session.query(User).filter_by(email=user_email).first()
+        return user.id if user else None
+    finally:
+        session.close()
+
+# Spending-by-category pie data and chart for one extraction result
+def build_pie_chart(result):
+    categories = CATEGORIES
+    totals = {cat: 0.0 for cat in categories}
+    for item in result["items"]:
+        cat = item.get("category")
+        totals[cat if cat in totals else "Other"] += item.get("subtotal") or 0.0
+    pie_data = [{"Category": cat, "Total": totals[cat]} for cat in categories if totals[cat] > 0]
+
+    fig = None
+    if pie_data:
+        import pandas as pd
+        import plotly.express as px
+
+        df = pd.DataFrame(pie_data)
+        fig = px.pie(
+            df, 
+            names="Category", 
+            values="Total", 
+            title="Spending Breakdown",
+            color_discrete_sequence=px.colors.qualitative.Dark24
+        )
+    return pie_data, fig
+
+# Put a finished extraction on screen
+def display_job_result(job):
+    with trace(job['image_hash'][:16]), span("render.chart"):
+        pie_data, fig = build_pie_chart(job['result'])
+    st.session_state['processed_result'] = job['result']
+    st.session_state['plotly_fig'] = fig
+    st.session_state['pie_data'] = pie_data
+    st.session_state['current_display_hash'] = job['image_hash']
+    st.session_state['extraction_error'] = None
+
+# Store info and items the worker has streamed so far for a running extraction
+def show_partial_result(partial):
+    if partial.get('restarted'):
+        st.caption("The first read looked wrong, so a stronger model is reading the receipt again.")
+    store = partial.get('store_info')
+    if store:
+        st.markdown("### 🏪 Store Information")
+        st.markdown(
+            f"""
+            <div style='background:var(--card-bg); padding:1.2em 1.5em; border-radius:18px; margin-bottom:1.5em; color:var(--text-color);'>
+                <b>Name:</b> {html.escape(str(store.get('name', '')))}<br>
+                <b>Date:</b> {html.escape(str(store.get('date', '')))}
+            </div>
+            """,
+            unsafe_allow_html=True
+        )
+    if partial.get('items'):
+        st.markdown(f"### Categorized Items ({len(partial['items'])} so far)")
+        show_item_cards(item_card_blocks(partial['items']))
+
+# Re-runs on its own every second until the queued extraction finishes
+@st.fragment(run_every=1)
+def show_active_job():
+    from jobs import get_job, ACTIVE_STATUSES
+
+    job = get_job(st.session_state['active_job_id'])
+    if job is not None and job['status'] in ACTIVE_STATUSES:
+        st.info(f"⏳ Extracting receipt in the background ({job['status']})... you can keep using the app.")
+        if job['partial']:
+            show_partial_result(job['partial'])
+        return
+    st.session_state['active_job_id'] = None
+    if job is not None and job['status'] == 'done':
+        display_job_result(job)
+    else:
+        st.session_state['extraction_error'] = job['error'] if job else "Extraction job not found."
+    st.rerun(scope="app")
+
+# Sidebar list of the user's latest extractions; finished ones can be reopened
+def show_recent_jobs():
+    from jobs import recent_jobs
+
+    user_id = get_user_id(st.session_state['user_email'])
+    jobs = recent_jobs(user_id) if user_id else []
+    if not jobs:
+        return
+    status_icons = {'pending': '⏳', 'running': '⚙️', 'done': '✅', 'failed': '❌'}
+    with st.sidebar.expander("Recent extractions", expanded=False):
+        for job in jobs:
+            label = f"{status_icons.get(job['status'], '')} {job['created_at']:%b %d %H:%M}"
+            if job['status'] == 'done':
+                name = job['result']['store_info'].get('name') or 'Receipt'
+                if st.button(f"{label} · {name}", key=f"view_job_{job['id']}", use_container_width=True):
+                    display_job_result(job)
+                    st.rerun()
+            else:
+                st.markdown(f"{label} · {job['status']}")
 
 st.set_page_config(page_title="Receipt NoteTaker", layout="wide")
 
@@ -230,13 +437,18 @@ if st.button("🔄 Reset App"):
     st.session_state['pie_data'] = None
     st.session_state['current_display_hash'] = None
     st.session_state['allow_duplicate_process'] = False
+    st.session_state['active_job_id'] = None
+    st.session_state['extraction_error'] = None
     st.rerun()
 
 # Sidebar navigation
 st.sidebar.markdown("---")
+nav_pages = ["Dashboard", "Analytics", "Budgets"]
+if (st.session_state['user_email'] or '').lower() in config.ADMIN_EMAILS:
+    nav_pages.append("Admin")
 page = st.sidebar.radio(
     "Navigation",
-    ["Dashboard", "Analytics", "Budgets"],
+    nav_pages,
     key="main_nav_radio"
 )
 
@@ -266,14 +478,15 @@ if page == "Dashboard":
     if st.session_state['uploaded_image_file'] is not None:
         image_file = st.session_state['uploaded_image_file']
         # Save uploaded image to a temp file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-            tmp.write(image_file.read())
-            tmp_path = tmp.name
+        with span("upload.temp_write"):
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
+                tmp.write(image_file.read())
+                tmp_path = tmp.name
 
         st.sidebar.image(tmp_path, caption="Uploaded Receipt", use_container_width=True)
 
-        current_image_hash = calculate_image_hash(image_file.getvalue())
-        existing_hashes = load_existing_hashes()
+        with span("upload.hash"):
+            current_image_hash = calculate_image_hash(image_file.getvalue())
 
         # Determine if we need to process the receipt
         should_process_this_image = False
@@ -282,8 +495,22 @@ if page == "Dashboard":
         # This means a new image has been uploaded or a new instance of an old image.
         if 'current_display_hash' not in st.session_state or st.session_state['current_display_hash'] != current_image_hash:
             # Check for duplicates if it's a new or re-uploaded image not yet processed in this run
-            if current_image_hash in existing_hashes and not st.session_state['allow_duplicate_process']:
-                st.warning("This receipt has already been uploaded.")
+            is_duplicate = False
+            similar_receipt = None
+            if not st.session_state['allow_duplicate_process']:
+                with trace(current_image_hash[:16]), span("upload.duplicate_check"):
+                    is_duplicate = is_duplicate_receipt(st.session_state['user_email'], current_image_hash)
+                # Catch the same receipt re-photographed, re-cropped or re-saved before paying for extraction
+                phash = get_upload_phash(current_image_hash, image_file.getvalue())
+                if not is_duplicate and phash:
+                    with trace(current_image_hash[:16]), span("upload.near_duplicate_check"):
+                        similar_receipt = find_similar_receipt(st.session_state['user_email'], phash)
+            if is_duplicate or similar_receipt:
+                if is_duplicate:
+                    st.warning("This receipt has already been uploaded.")
+                else:
+                    vendor, receipt_date, distance = similar_receipt
+                    st.warning(f"This looks like a receipt you already uploaded: {vendor} on {receipt_date:%b %d, %Y} ({distance} of 256 bits differ).")
                 col_dup1, col_dup2 = st.columns(2)
                 with col_dup1:
                     if st.button("Go ahead anyway", key="go_ahead_button"):
@@ -305,90 +532,49 @@ if page == "Dashboard":
                 if st.session_state['allow_duplicate_process']:
                     st.session_state['allow_duplicate_process'] = False
         # Condition 2: If the image hash is the same, but processed_result is not yet set (e.g., first run after upload)
-        elif 'processed_result' not in st.session_state or st.session_state['processed_result'] is None:
+        # and its extraction is neither queued nor already failed
+        elif (
+            ('processed_result' not in st.session_state or st.session_state['processed_result'] is None)
+            and st.session_state.get('active_job_id') is None
+            and not st.session_state.get('extraction_error')
+        ):
             should_process_this_image = True
 
         if should_process_this_image:
-            with st.spinner("Processing receipt..."):
-                try:
-                    result = process_receipt(tmp_path, current_image_hash)
-                    st.session_state['processed_result'] = result
-
-                    # Calculate pie data and Plotly figure immediately after processing
-                    categories = ["Food", "Electronics", "Services", "Personal Care", "Household", "Other"]
-                    cat_dict = {cat: [] for cat in categories}
-                    for item in result["items"]:
-                        cat_dict[item["category"]].append(item)
-                    pie_data = []
-                    for cat in categories:
-                        total = sum(item["subtotal"] for item in cat_dict[cat])
-                        if total > 0:
-                            pie_data.append({"Category": cat, "Total": total})
-                    
-                    fig = None
-                    if pie_data:
-                        df = pd.DataFrame(pie_data)
-                        fig = px.pie(
-                            df, 
-                            names="Category", 
-                            values="Total", 
-                            title="Spending Breakdown",
-                            color_discrete_sequence=px.colors.qualitative.Dark24
-                        )
-                    
-                    st.session_state['plotly_fig'] = fig
-                    st.session_state['pie_data'] = pie_data
-                    st.session_state['current_display_hash'] = current_image_hash # Mark this hash as processed and displayed
-
-                    # --- Save to DB ---
-                    session = Session()
-                    user = session.query(User).filter_by(email=st.session_state['user_email']).first()
-                    if user:
-                        # Parse date
-                        from dateutil import parser as date_parser
-                        try:
-                            # Try to parse the date from store info
-                            receipt_date = date_parser.parse(result['store_info']['date'])
-                            # Ensure the date has no timezone info (convert to system timezone if it does)
-                            if receipt_date.tzinfo is not None:
-                                receipt_date = receipt_date.astimezone().replace(tzinfo=None)
-                        except (ValueError, TypeError, KeyError):
-                            # If date parsing fails, use current date
-                            receipt_date = datetime.now()
-                            st.warning("Could not parse receipt date. Using current date instead.")
-                        
-                        # Ensure the date is not in the future
-                        if receipt_date > datetime.now():
-                            receipt_date = datetime.now()
-                            st.warning("Receipt date was in the future. Using current date instead.")
-                        
-                        vendor = result['store_info']['name']
-                        total = result['transaction_details']['total']
-                        items_json = json.dumps(result['items'])
-                        categories_json = json.dumps([item['category'] for item in result['items']])
-                        new_receipt = Receipt(
-                            user_id=user.id,
-                            date=receipt_date,
-                            vendor=vendor,
-                            total=total,
-                            items=items_json,
-                            categories=categories_json
-                        )
-                        session.add(new_receipt)
-                        session.commit()
-                    session.close()
-                    # --- End Save to DB ---
-
-                except Exception as e:
-                    st.error(f"Error processing receipt: {str(e)}")
-                    st.session_state['processed_result'] = None
-                    st.session_state['plotly_fig'] = None
-                    st.session_state['pie_data'] = None
-                    st.session_state['current_display_hash'] = None
+            # Queue the extraction; a background worker calls the API and saves the receipt
+            from jobs import enqueue_extraction
+
+            user_id = get_user_id(st.session_state['user_email'])
+            suffix = os.path.splitext(image_file.name)[1].lower() or ".jpg"
+            with trace(current_image_hash[:16]), span("upload.enqueue"):
+                st.session_state['active_job_id'] = enqueue_extraction(
+                    user_id, image_file.getvalue(), current_image_hash, suffix,
+                    perceptual_hash=get_upload_phash(current_image_hash, image_file.getvalue())
+                )
+            st.session_state['processed_result'] = None
+            st.session_state['plotly_fig'] = None
+            st.session_state['pie_data'] = None
+            st.session_state['extraction_error'] = None
+            st.session_state['current_display_hash'] = current_image_hash # Mark this hash as queued for display
+
+    # Poll the running extraction without blocking the rest of the page
+    if st.session_state.get('active_job_id') is not None:
+        show_active_job()
+
+    if st.session_state.get('extraction_error'):
+        st.error(f"Error processing receipt: {st.session_state['extraction_error']}")
+
+    show_recent_jobs()
     
     # Now, whether processed or retrieved, display the data if available
     if 'processed_result' in st.session_state and st.session_state['processed_result'] is not None:
         result_to_display = st.session_state['processed_result']
+        if result_to_display.get('warnings'):
+            # Every routed model's answer looked misread; it was saved but not cached
+            st.warning("Please double-check this receipt: " + "; ".join(result_to_display['warnings']))
+        for warning in result_to_display.get('save_warnings', []):
+            # Notes from saving the receipt (see jobs.run_job)
+            st.warning(warning)
         fig_to_display = st.session_state.get('plotly_fig')
         pie_data_to_display = st.session_state.get('pie_data', [])
 
@@ -446,51 +632,9 @@ if page == "Dashboard":
             unsafe_allow_html=True
         )
 
-        # Display categorized items
+        # Display categorized items, one pre-built block per non-empty category
         st.markdown("### Categorized Items")
-        categories = ["Food", "Electronics", "Services", "Personal Care", "Household", "Other"]
-        cat_dict = {cat: [] for cat in categories}
-        
-        for item in result_to_display["items"]:
-            cat_dict[item["category"]].append(item)
-
-        # Category icons
-        category_icons = {
-            "Food": "🛒",
-            "Electronics": "💻",
-            "Services": "🛠️",
-            "Personal Care": "🧴",
-            "Household": "🏠",
-            "Other": "📦"
-        }
-        
-        # Filter out empty categories
-        non_empty_categories = [cat for cat in categories if len(cat_dict[cat]) > 0]
-        cols = st.columns(len(non_empty_categories))
-
-        for idx, cat in enumerate(non_empty_categories):
-            with cols[idx]:
-                st.markdown(
-                    f"""
-                    <div class='category-card'>
-                        <div style='font-size:1.2em;font-weight:bold;color:var(--primary-color);margin-bottom:0.5em;'>{category_icons[cat]} {cat} ({len(cat_dict[cat])})</div>
-                    """,
-                    unsafe_allow_html=True
-                )
-                for item in cat_dict[cat]:
-                    st.markdown(
-                        f"""
-                        <div class='item-card'>
-                            <div class='item-title'>{item['name']}</div>
-                            <div class='item-desc'>{item.get('description','')}</div>
-                            <div class='item-detail'><b>Qty:</b> <span class='item-qty'>{item['quantity']}</span></div>
-                            <div class='item-detail'><b>Price:</b> <span class='item-price'>${item['price']:.2f}</span></div>
-                            <div class='item-detail'><b>Subtotal:</b> <span class='item-subtotal'>${item['subtotal']:.2f}</span></div>
-                        </div>
-                        """,
-                        unsafe_allow_html=True
-                    )
-                st.markdown("</div>", unsafe_allow_html=True)
+        show_item_cards(build_item_cards(st.session_state.get('current_display_hash'), result_to_display["items"]))
 
         # Pie chart for spending by category
         st.markdown("### Spending by Category")
@@ -507,32 +651,29 @@ if page == "Dashboard":
         txn = result_to_display["transaction_details"]
         items = result_to_display["items"]
 
+        # Exports are generated on click (not on every rerun) and memoized per receipt and format
+        receipt_hash = st.session_state.get('current_display_hash')
+
         with col1:
-            csv_data = export_to_csv(store, txn, items)
             st.download_button(
                 label="Export as CSV",
-                data=csv_data,
+                data=partial(build_export, receipt_hash, "csv", store, txn, items, pie_data_to_display),
                 file_name="receipt_data.csv",
                 mime="text/csv",
                 key="csv_download"
             )
         with col2:
-            excel_data = export_to_excel(store, txn, items, pie_data_to_display)
             st.download_button(
                 label="Export as Excel",
-                data=excel_data,
+                data=partial(build_export, receipt_hash, "excel", store, txn, items, pie_data_to_display),
                 file_name="receipt_data.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                 key="excel_download"
             )
         with col3:
-            if fig_to_display:
-                pdf_data = export_to_pdf(store, txn, items, fig_to_display)
-            else:
-                pdf_data = export_to_pdf(store, txn, items, None)
             st.download_button(
                 label="Export as PDF",
-                data=pdf_data,
+                data=partial(build_export, receipt_hash, "pdf", store, txn, items, pie_data_to_display),
                 file_name="receipt_report.pdf",
                 mime="application/pdf",
                 key="pdf_download"
@@ -545,194 +686,216 @@ if page == "Dashboard":
     elif (
         ('processed_result' not in st.session_state or st.session_state['processed_result'] is None)
         and (st.session_state.get('uploaded_image_file') is None)
+        and (st.session_state.get('active_job_id') is None)
     ):
         st.info("Upload a receipt image to get started.")
 
 elif page == "Analytics":
     st.title("📊 Advanced Analytics")
     st.markdown("<div style='margin-bottom:2em'></div>", unsafe_allow_html=True)
-    session = Session()
-    user = session.query(User).filter_by(email=st.session_state['user_email']).first()
-    if user:
-        receipts = session.query(Receipt).filter_by(user_id=user.id).order_by(Receipt.date).all()
-        if not receipts:
-            st.info("No receipts found. Upload receipts to see analytics.")
-        else:
-            # Prepare DataFrame
-            data = []
-            for r in receipts:
-                items = json.loads(r.items)
-                for item in items:
-                    data.append({
-                        'date': r.date,
-                        'vendor': r.vendor,
-                        'category': item.get('category', 'Other'),
-                        'amount': item.get('subtotal', 0.0)
-                    })
-            df = pd.DataFrame(data)
-            if df.empty:
+    from analytics import get_user_analytics
+
+    with session_scope() as session:
+        user = session.query(User).filter_by(email=st.session_state['user_email']).first()
+        if user:
+            # Recomputed only when the user's data version changed since the last view
+            analytics = get_user_analytics(session, user)
+            if not analytics['has_receipts']:
+                st.info("No receipts found. Upload receipts to see analytics.")
+            elif not analytics['has_items']:
                 st.info("No item data found in receipts.")
             else:
-                df['date'] = pd.to_datetime(df['date'])
-                df['month'] = df['date'].dt.to_period('M').astype(str)
-                df['week'] = df['date'].dt.to_period('W').astype(str)
+                figures = analytics['figures']
 
                 # --- Monthly Spending Trend ---
                 st.markdown("#### 📅 Monthly Spending Trend")
-                monthly = df.groupby('month')['amount'].sum().reset_index()
-                fig_month = px.bar(monthly, x='month', y='amount', labels={'amount': 'Total Spent ($)'}, color='amount', color_continuous_scale='Blues')
-                fig_month.update_layout(height=320, margin=dict(t=30, b=0, l=0, r=0), plot_bgcolor='rgba(0,0,0,0)', paper_bgcolor='rgba(0,0,0,0)')
-                st.plotly_chart(fig_month, use_container_width=True)
+                st.plotly_chart(figures['monthly'], use_container_width=True)
 
                 # --- Weekly Spending Trend ---
                 st.markdown("#### 📆 Weekly Spending Trend")
-                weekly = df.groupby('week')['amount'].sum().reset_index()
-                fig_week = px.line(weekly, x='week', y='amount', markers=True, labels={'amount': 'Total Spent ($)'})
-                fig_week.update_layout(height=320, margin=dict(t=30, b=0, l=0, r=0), plot_bgcolor='rgba(0,0,0,0)', paper_bgcolor='rgba(0,0,0,0)')
-                st.plotly_chart(fig_week, use_container_width=True)
+                st.plotly_chart(figures['weekly'], use_container_width=True)
 
                 # --- Top Categories ---
                 st.markdown("#### 🏷️ Top Spending Categories")
-                cat_sum = df.groupby('category')['amount'].sum().reset_index().sort_values('amount', ascending=False)
-                fig_cat = px.bar(cat_sum, x='category', y='amount', color='amount', color_continuous_scale='Teal', labels={'amount': 'Total Spent ($)'})
-                fig_cat.update_layout(height=320, margin=dict(t=30, b=0, l=0, r=0), plot_bgcolor='rgba(0,0,0,0)', paper_bgcolor='rgba(0,0,0,0)')
-                st.plotly_chart(fig_cat, use_container_width=True)
+                st.plotly_chart(figures['category'], use_container_width=True)
 
                 # --- Top Vendors ---
                 st.markdown("#### 🏪 Top Vendors")
-                vendor_sum = df.groupby('vendor')['amount'].sum().reset_index().sort_values('amount', ascending=False).head(10)
-                fig_vendor = px.bar(vendor_sum, x='vendor', y='amount', color='amount', color_continuous_scale='Oranges', labels={'amount': 'Total Spent ($)'})
-                fig_vendor.update_layout(height=320, margin=dict(t=30, b=0, l=0, r=0), plot_bgcolor='rgba(0,0,0,0)', paper_bgcolor='rgba(0,0,0,0)')
-                st.plotly_chart(fig_vendor, use_container_width=True)
-    else:
-        st.error("User not found.")
-    session.close()
+                st.plotly_chart(figures['vendor'], use_container_width=True)
+
+                # --- Export History ---
+                st.markdown("#### 📥 Export Receipt History")
+                col_from, col_to = st.columns(2)
+                with col_from:
+                    history_start = st.date_input("From", value=None, key="history_start")
+                with col_to:
+                    history_end = st.date_input("To", value=None, key="history_end")
+                col_csv, col_excel = st.columns(2)
+                with col_csv:
+                    st.download_button(
+                        label="Export all receipts as CSV",
+                        data=partial(build_history_csv, user.id, history_start, history_end),
+                        file_name="receipt_history.csv",
+                        mime="text/csv",
+                        key="history_csv_download"
+                    )
+                with col_excel:
+                    st.download_button(
+                        label="Export all receipts as Excel",
+                        data=partial(build_history_excel, user.id, history_start, history_end),
+                        file_name="receipt_history.xlsx",
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        key="history_excel_download"
+                    )
+        else:
+            st.error("User not found.")
 
 elif page == "Budgets":
     st.title("💰 Budgets & Alerts")
     st.markdown("<div style='margin-bottom:2em'></div>", unsafe_allow_html=True)
-    session = Session()
-    user = session.query(User).filter_by(email=st.session_state['user_email']).first()
-    if not user:
-        st.error("User not found.")
-        session.close()
-    else:
-        # Get all unique months from receipts
-        all_receipts = session.query(Receipt).filter_by(user_id=user.id).all()
-        unique_months = sorted(set(r.date.strftime('%Y-%m') for r in all_receipts))
-        
-        # Add current month if not in list
-        current_month = datetime.now().strftime('%Y-%m')
-        if current_month not in unique_months:
-            unique_months.append(current_month)
-        unique_months.sort(reverse=True)  # Most recent first
-        
-        # Month selector
-        selected_month = st.selectbox(
-            "Select Month",
-            unique_months,
-            index=unique_months.index(current_month) if current_month in unique_months else 0
-        )
-        
-        # Determine if selected month is in the past
-        selected_year, selected_month_num = map(int, selected_month.split('-'))
-        is_past_month = datetime(selected_year, selected_month_num, 1) < datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        
-        if is_past_month:
-            st.info("📊 Viewing historical spending data. Budgets cannot be set for past months.")
+    with session_scope() as session:
+        user = session.query(User).filter_by(email=st.session_state['user_email']).first()
+        if not user:
+            st.error("User not found.")
         else:
-            st.success("💰 Set your budgets for this month below.")
+            # Get all unique months from receipts
+            unique_months = receipt_months(session, user.id)
         
-        st.markdown("<div style='margin-bottom:2em'></div>", unsafe_allow_html=True)
+            # Add current month if not in list
+            current_month = datetime.now().strftime('%Y-%m')
+            if current_month not in unique_months:
+                unique_months.append(current_month)
+            unique_months.sort(reverse=True)  # Most recent first
         
-        # --- Budget Form ---
-        if not is_past_month:
-            st.markdown("#### Set Monthly Budgets per Category")
-            categories = ["Food", "Electronics", "Services", "Personal Care", "Household", "Other"]
-            budget_dict = {b.category: b for b in session.query(Budget).filter_by(user_id=user.id, month=selected_month).all()}
-            with st.form("budget_form"):
-                cols = st.columns(len(categories))
-                new_budgets = {}
-                for idx, cat in enumerate(categories):
-                    with cols[idx]:
-                        val = budget_dict[cat].amount if cat in budget_dict else 0.0
-                        new_budgets[cat] = st.number_input(f"{cat}", min_value=0.0, value=float(val), step=10.0, format="%.2f")
-                submitted = st.form_submit_button("Save Budgets")
-                if submitted:
-                    for cat, amt in new_budgets.items():
-                        b = budget_dict.get(cat)
-                        if b:
-                            b.amount = amt
-                        else:
-                            b = Budget(user_id=user.id, category=cat, month=selected_month, amount=amt)
-                            session.add(b)
-                    session.commit()
-                    st.success("Budgets saved!")
-                    st.rerun()
-            st.markdown("<div style='margin-bottom:2em'></div>", unsafe_allow_html=True)
+            # Month selector
+            selected_month = st.selectbox(
+                "Select Month",
+                unique_months,
+                index=unique_months.index(current_month) if current_month in unique_months else 0
+            )
         
-        # --- Spending vs. Budget ---
-        if is_past_month:
-            st.markdown("#### Monthly Spending Breakdown")
-        else:
-            st.markdown("#### This Month's Spending vs. Budget")
+            # Determine if selected month is in the past
+            selected_year, selected_month_num = map(int, selected_month.split('-'))
+            is_past_month = datetime(selected_year, selected_month_num, 1) < datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
         
-        # Parse selected month
-        year, month = map(int, selected_month.split('-'))
-        first_day = datetime(year, month, 1)
-        if month == 12:
-            next_month = first_day.replace(year=year + 1, month=1)
-        else:
-            next_month = first_day.replace(month=month + 1)
-            
-        # Get filtered receipts and calculate spending
-        receipts = session.query(Receipt).filter_by(user_id=user.id).filter(
-            Receipt.date >= first_day,
-            Receipt.date < next_month
-        ).all()
+            if is_past_month:
+                st.info("📊 Viewing historical spending data. Budgets cannot be set for past months.")
+            else:
+                st.success("💰 Set your budgets for this month below.")
         
-        categories = ["Food", "Electronics", "Services", "Personal Care", "Household", "Other"]
-        spend_data = {cat: 0.0 for cat in categories}
+            st.markdown("<div style='margin-bottom:2em'></div>", unsafe_allow_html=True)
         
-        for r in receipts:
-            items = json.loads(r.items)
-            for item in items:
-                cat = item.get('category', 'Other')
-                amount = item.get('subtotal', 0.0)
-                spend_data[cat] += amount
+            # --- Budget Form ---
+            if not is_past_month:
+                st.markdown("#### Set Monthly Budgets per Category")
+                categories = ["Food", "Electronics", "Services", "Personal Care", "Household", "Other"]
+                budget_dict = {b.category: b for b in session.query(Budget).filter_by(user_id=user.id, month=selected_month).all()}
+                with st.form("budget_form"):
+                    cols = st.columns(len(categories))
+                    new_budgets = {}
+                    for idx, cat in enumerate(categories):
+                        with cols[idx]:
+                            val = budget_dict[cat].amount if cat in budget_dict else 0.0
+                            new_budgets[cat] = st.number_input(f"{cat}", min_value=0.0, value=float(val), step=10.0, format="%.2f")
+                    submitted = st.form_submit_button("Save Budgets")
+                    if submitted:
+                        for cat, amt in new_budgets.items():
+                            b = budget_dict.get(cat)
+                            if b:
+                                b.amount = amt
+                            else:
+                                b = Budget(user_id=user.id, category=cat, month=selected_month, amount=amt)
+                                session.add(b)
+                        session.commit()
+                        st.success("Budgets saved!")
+                        st.rerun()
+                st.markdown("<div style='margin-bottom:2em'></div>", unsafe_allow_html=True)
         
-        # Display spending data
-        for cat in categories:
-            spent = spend_data[cat]
+            # --- Spending vs. Budget ---
             if is_past_month:
-                # For past months, just show the spending amount
-                st.markdown(
-                    f"""
-                    <div style='background:var(--card-bg);padding:1em 1.5em;border-radius:12px;margin-bottom:1.2em;box-shadow:0 2px 8px rgba(0,0,0,0.10);'>
-                        <b>{cat}</b>  &nbsp;  ${spent:.2f}
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
+                st.markdown("#### Monthly Spending Breakdown")
             else:
-                # For current/future months, show budget comparison
-                budget = new_budgets.get(cat, 0.0)
-                percent = spent / budget * 100 if budget > 0 else 0
-                bar_color = '#03dac6' if percent < 80 else ('#ffb300' if percent < 100 else '#ff1744')
-                st.markdown(
-                    f"""
-                    <div style='background:var(--card-bg);padding:1em 1.5em;border-radius:12px;margin-bottom:1.2em;box-shadow:0 2px 8px rgba(0,0,0,0.10);'>
-                        <b>{cat}</b>  &nbsp;  ${spent:.2f} / ${budget:.2f}
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
-                st.progress(min(percent/100, 1.0), text=f"{percent:.0f}% of budget")
-                if budget > 0 and percent >= 90 and percent < 100:
-                    st.warning(f"You're approaching your {cat} budget!")
-                elif budget > 0 and percent >= 100:
-                    st.error(f"You have exceeded your {cat} budget!")
-        session.close()
+                st.markdown("#### This Month's Spending vs. Budget")
+        
+            # Read the month's spending from the maintained monthly aggregate
+            categories = CATEGORIES
+            spend_data = {cat: 0.0 for cat in categories}
+            for cat, amount in monthly_spend_by_category(session, user.id, selected_month).items():
+                # Categories outside the known list are counted as Other
+                spend_data[cat if cat in spend_data else 'Other'] += amount or 0.0
+        
+            # Display spending data
+            for cat in categories:
+                spent = spend_data[cat]
+                if is_past_month:
+                    # For past months, just show the spending amount
+                    st.markdown(
+                        f"""
+                        <div style='background:var(--card-bg);padding:1em 1.5em;border-radius:12px;margin-bottom:1.2em;box-shadow:0 2px 8px rgba(0,0,0,0.10);'>
+                            <b>{cat}</b>  &nbsp;  ${spent:.2f}
+                        </div>
+                        """,
+                        unsafe_allow_html=True
+                    )
+                else:
+                    # For current/future months, show budget comparison
+                    budget = new_budgets.get(cat, 0.0)
+                    percent = spent / budget * 100 if budget > 0 else 0
+                    bar_color = '#03dac6' if percent < 80 else ('#ffb300' if percent < 100 else '#ff1744')
+                    st.markdown(
+                        f"""
+                        <div style='background:var(--card-bg);padding:1em 1.5em;border-radius:12px;margin-bottom:1.2em;box-shadow:0 2px 8px rgba(0,0,0,0.10);'>
+                            <b>{cat}</b>  &nbsp;  ${spent:.2f} / ${budget:.2f}
+                        </div>
+                        """,
+                        unsafe_allow_html=True
+                    )
+                    st.progress(min(percent/100, 1.0), text=f"{percent:.0f}% of budget")
+                    if budget > 0 and percent >= 90 and percent < 100:
+                        st.warning(f"You're approaching your {cat} budget!")
+                    elif budget > 0 and percent >= 100:
+                        st.error(f"You have exceeded your {cat} budget!")
+
+elif page == "Admin":
+    st.title("🛠️ Ingestion Latency")
+    st.markdown("<div style='margin-bottom:2em'></div>", unsafe_allow_html=True)
+    # Spans come from the shared trace log, so worker processes are included
+    spans = read_recent_spans()
+    if not spans:
+        st.info("No timings recorded yet. Upload a receipt to start collecting them.")
+    else:
+        import pandas as pd
+        import plotly.express as px
+
+        stats_df = pd.DataFrame.from_dict(stage_stats(spans), orient='index').rename_axis('stage').reset_index()
+        stats_df = stats_df.sort_values('p95_ms', ascending=False)
+        st.markdown(f"#### Per-stage latency (last {config.TRACE_STATS_WINDOW} spans per stage)")
+        st.dataframe(stats_df, use_container_width=True, hide_index=True)
+        fig_stages = px.bar(stats_df, x='stage', y=['p50_ms', 'p95_ms', 'p99_ms'], barmode='group', labels={'value': 'Latency (ms)', 'variable': ''})
+        fig_stages.update_layout(height=320, margin=dict(t=30, b=0, l=0, r=0), plot_bgcolor='rgba(0,0,0,0)', paper_bgcolor='rgba(0,0,0,0)')
+        st.plotly_chart(fig_stages, use_container_width=True)
+
+        st.markdown("#### Slowest recent uploads")
+        slow_rows = []
+        for t in slowest_traces(spans):
+            slowest_stage = max(t['stages'], key=t['stages'].get)
+            slow_rows.append({'trace': t['trace_id'], 'last seen': t['last_ts'], 'total_ms': t['total_ms'],
+                              'slowest stage': slowest_stage, 'slowest stage ms': t['stages'][slowest_stage]})
+        st.dataframe(pd.DataFrame(slow_rows), use_container_width=True, hide_index=True)
+
+    st.markdown("#### Model routes")
+    # Imported here: process_receipt pulls in PIL and the extractors
+    from process_receipt import usage_summary
+
+    route_rows = usage_summary()
+    if route_rows:
+        # fast = first try on the cheap model, strong = escalations, repair = text-only corrections
+        st.dataframe(route_rows, use_container_width=True, hide_index=True)
+    else:
+        st.info("No model requests logged yet.")
+
+    st.markdown("#### Extraction cache")
+    st.json(extraction_cache.stats())
 
 # Add user info and logout button
 st.sidebar.markdown(
@@ -1,5 +1,5 @@
 import streamlit as st
-from models import User, Session
+from models import User, session_scope
 import re
 
 def is_valid_email(email):
@@ -59,17 +59,19 @@ def show_login_page():
                     st.error("Please enter a valid email address")
                     return False
                 
-                session = Session()
-                user = session.query(User).filter_by(email=email).first()
-                
-                if user and user.check_password(password):
-                    st.session_state['authenticated'] = True
-                    st.session_state['user_email'] = email
-                    st.success("Login successful!")
-                    st.rerun()
-                else:
-                    st.error("Invalid email or password")
-                session.close()
+                with session_scope() as session:
+                    user = session.query(User).filter_by(email=email).first()
+                    
+                    if user and user.check_password(password):
+                        # Bring hashes made with an older cost factor up to the configured one
+                        if user.upgrade_password_hash(password):
+                            session.commit()
+                        st.session_state['authenticated'] = True
+                        st.session_state['user_email'] = email
+                        st.success("Login successful!")
+                        st.rerun()
+                    else:
+                        st.error("Invalid email or password")
         
         with col2:
             if st.button("Create Account", use_container_width=True):
@@ -138,20 +140,17 @@ def show_register_page():
                     st.error("Password must be at least 6 characters long")
                     return
                 
-                session = Session()
-                existing_user = session.query(User).filter_by(email=email).first()
-                
-                if existing_user:
-                    st.error("Email already registered")
-                    session.close()
-                    return
-                
-                new_user = User(email=email)
-                new_user.set_password(password)
-                
-                session.add(new_user)
-                session.commit()
-                session.close()
+                with session_scope() as session:
+                    existing_user = session.query(User).filter_by(email=email).first()
+                    
+                    if existing_user:
+                        st.error("Email already registered")
+                        return
+                    
+                    new_user = User(email=email)
+                    new_user.set_password(password)
+                    
+                    session.add(new_user)
                 
                 st.success("Account created successfully! Please login.")
                 st.session_state['show_register'] = False
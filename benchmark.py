@@ -0,0 +1,302 @@
+"""Time the app's hot paths against synthetic data and write machine-readable results.
+
+    python benchmark.py --generate --users 5 --receipts 2000 --items 8
+    python benchmark.py --output data/benchmarks/after.json --compare data/benchmarks/before.json
+
+Each benchmark runs once to warm up and then --repeat times; the JSON output
+records per-benchmark min/median/mean/p95/max in milliseconds together with the
+git commit and dataset size, so runs can be compared across commits.
+
+The startup group renders the login page and each app page in a fresh Python
+process with Streamlit's AppTest, so import and first-render costs are measured
+the way a cold container sees them.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import sqlalchemy
+from sqlalchemy import func
+
+import synthetic_data
+from analytics import compute_series, build_figures, get_user_analytics
+from export_utils import export_to_csv, export_to_excel, export_to_pdf, iter_history_csv, export_history_to_excel
+from migrations import run_migrations
+from models import Session, User, Receipt, ReceiptItem, Budget
+from queries import receipt_months, monthly_spend_by_category, has_receipt_with_hash
+
+GROUPS = ["analytics", "budgets", "duplicates", "exports", "startup"]
+STARTUP_PAGES = ["Login", "Dashboard", "Analytics", "Budgets"]
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _stats(timings):
+    timings = sorted(timings)
+    return {
+        "repeat": len(timings),
+        "min_ms": round(timings[0], 3),
+        "median_ms": round(statistics.median(timings), 3),
+        "mean_ms": round(statistics.mean(timings), 3),
+        "p95_ms": round(_percentile(timings, 0.95), 3),
+        "max_ms": round(timings[-1], 3),
+    }
+
+
+def time_call(fn, repeat):
+    """Run fn once to warm up, then `repeat` times; return timing stats in milliseconds."""
+    fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return _stats(timings)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _pick_user(session, email=None):
+    """Return the requested user, or the one with the most receipts."""
+    if email:
+        return session.query(User).filter_by(email=email).first()
+    row = session.query(Receipt.user_id, func.count(Receipt.id)).group_by(Receipt.user_id).order_by(func.count(Receipt.id).desc()).first()
+    return session.get(User, row[0]) if row else None
+
+
+def _sample_receipt(item_count, seed):
+    """Build an extracted-style receipt with item_count items for the per-receipt exports."""
+    rng = random.Random(seed)
+    items = []
+    while len(items) < item_count:
+        items.extend(synthetic_data.make_receipt_items(rng, "grocery", item_count))
+    items = items[:item_count]
+    subtotal = round(sum(item["subtotal"] for item in items), 2)
+    store = {"name": "FreshMart", "address": "1 Main St", "phone": "(555) 000-0000", "date": "2024-05-01"}
+    txn = {"subtotal": subtotal, "tax": round(subtotal * 0.05, 2), "total": round(subtotal * 1.05, 2),
+           "payment_method": "Visa", "change": 0.0}
+    totals = defaultdict(float)
+    for item in items:
+        totals[item["category"]] += item["subtotal"]
+    pie_data = [{"Category": cat, "Total": total} for cat, total in totals.items()]
+    return store, txn, items, pie_data
+
+
+def render_page(page, user_email=None):
+    """Render one app page in this process; returns (first render, rerun) times in milliseconds."""
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py"), default_timeout=120)
+    if page != "Login":
+        app.session_state["authenticated"] = True
+        app.session_state["user_email"] = user_email
+        app.session_state["main_nav_radio"] = page
+    start = time.perf_counter()
+    app.run()
+    first_ms = (time.perf_counter() - start) * 1000
+    if app.exception:
+        raise RuntimeError(f"{page} page raised: {app.exception[0].value}")
+    start = time.perf_counter()
+    app.run()
+    return first_ms, (time.perf_counter() - start) * 1000
+
+
+def time_startup(user_email, repeat, pages=STARTUP_PAGES):
+    """Render each page `repeat` times, each in a new process; returns [(name, stats)]."""
+    results = []
+    for page in pages:
+        first, rerun = [], []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "--render-page", page, "--user", user_email or ""],
+                                 capture_output=True, text=True, check=True).stdout
+            timings = json.loads(out.strip().splitlines()[-1])
+            first.append(timings["first_ms"])
+            rerun.append(timings["rerun_ms"])
+        for suffix, timings in (("first_render", first), ("rerun", rerun)):
+            # Every sample is a cold start, so there is no warmup run to discard
+            results.append((f"{page.lower()}_{suffix}", _stats(timings)))
+    return results
+
+
+def define_benchmarks(session, user, export_items, seed):
+    """Return [(group, name, fn)] for every timed hot path."""
+    user_id, email = user.id, user.email
+    months = receipt_months(session, user_id)
+    hashes = [h for (h,) in session.query(Receipt.image_hash).filter_by(user_id=user_id).limit(50)]
+    store, txn, items, pie_data = _sample_receipt(export_items, seed)
+
+    def analytics_cached():
+        # Same user and data version: served from the in-process analytics cache
+        get_user_analytics(session, user)
+
+    def budgets_page():
+        # Month selector plus the spend-vs-budget loop the Budgets page runs for one month
+        for month in receipt_months(session, user_id)[-1:]:
+            session.query(Budget).filter_by(user_id=user_id, month=month).all()
+            monthly_spend_by_category(session, user_id, month)
+
+    def budgets_all_months():
+        for month in months:
+            monthly_spend_by_category(session, user_id, month)
+
+    def duplicate_check_hits():
+        for image_hash in hashes:
+            has_receipt_with_hash(session, email, image_hash)
+
+    def duplicate_check_misses():
+        for i in range(50):
+            has_receipt_with_hash(session, email, f"missing-{i}")
+
+    def history_csv():
+        for _ in iter_history_csv(session, user_id):
+            pass
+
+    def history_excel():
+        export_history_to_excel(session, user_id, io.BytesIO())
+
+    series = compute_series(session, user_id)
+    return [
+        ("analytics", "compute_series", lambda: compute_series(session, user_id)),
+        ("analytics", "build_figures", lambda: build_figures(series)),
+        ("analytics", "get_user_analytics_cached", analytics_cached),
+        ("budgets", "receipt_months", lambda: receipt_months(session, user_id)),
+        ("budgets", "page_current_month", budgets_page),
+        ("budgets", "spend_all_months", budgets_all_months),
+        ("duplicates", "has_receipt_with_hash_50_hits", duplicate_check_hits),
+        ("duplicates", "has_receipt_with_hash_50_misses", duplicate_check_misses),
+        ("exports", "export_to_csv", lambda: export_to_csv(store, txn, items)),
+        ("exports", "export_to_excel", lambda: export_to_excel(store, txn, items, pie_data)),
+        ("exports", "export_to_pdf", lambda: export_to_pdf(store, txn, items, pie_data)),
+        ("exports", "history_csv", history_csv),
+        ("exports", "history_excel", history_excel),
+    ]
+
+
+def run(user_email=None, repeat=5, export_items=50, seed=42, only=None):
+    """Run the suite and return the results document."""
+    session = Session()
+    try:
+        user = _pick_user(session, user_email)
+        if user is None:
+            raise SystemExit("No receipts to benchmark; run with --generate or synthetic_data.py first")
+        dataset = {
+            "user_receipts": session.query(func.count(Receipt.id)).filter_by(user_id=user.id).scalar(),
+            "user_items": session.query(func.count(ReceiptItem.id)).join(Receipt).filter(Receipt.user_id == user.id).scalar(),
+            "total_users": session.query(func.count(User.id)).scalar(),
+            "total_receipts": session.query(func.count(Receipt.id)).scalar(),
+            "total_items": session.query(func.count(ReceiptItem.id)).scalar(),
+            "user_months": len(receipt_months(session, user.id)),
+            "export_items": export_items,
+        }
+        results = []
+        for group, name, fn in define_benchmarks(session, user, export_items, seed):
+            if only and group not in only:
+                continue
+            stats = time_call(fn, repeat)
+            results.append(dict(group=group, name=name, **stats))
+            print(f"{group:<11} {name:<40} median {stats['median_ms']:>10.2f} ms   p95 {stats['p95_ms']:>10.2f} ms")
+        user_email = user.email
+    finally:
+        session.close()
+
+    if not only or "startup" in only:
+        for name, stats in time_startup(user_email, repeat):
+            results.append(dict(group="startup", name=name, **stats))
+            print(f"{'startup':<11} {name:<40} median {stats['median_ms']:>10.2f} ms   p95 {stats['p95_ms']:>10.2f} ms")
+
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "sqlalchemy": sqlalchemy.__version__,
+            "platform": platform.platform(),
+            "database": str(Session.kw["bind"].url),
+            "dataset": dataset,
+        },
+        "results": results,
+    }
+
+
+def compare(current, baseline_path):
+    """Print median ratios of current results against a previous results file."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["group"], r["name"]): r for r in json.load(f)["results"]}
+    print(f"\nCompared with {baseline_path}:")
+    for result in current["results"]:
+        previous = baseline.get((result["group"], result["name"]))
+        if previous and previous["median_ms"]:
+            ratio = result["median_ms"] / previous["median_ms"]
+            print(f"{result['group']:<11} {result['name']:<40} {previous['median_ms']:>10.2f} -> {result['median_ms']:>10.2f} ms  ({ratio:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark analytics, budgets, duplicate checks, exports and page startup.")
+    parser.add_argument("--generate", action="store_true", help="Replace synthetic data before benchmarking")
+    parser.add_argument("--users", type=int, default=5, help="Synthetic users to generate (default: 5)")
+    parser.add_argument("--receipts", type=int, default=1000, help="Receipts per synthetic user (default: 1000)")
+    parser.add_argument("--items", type=int, default=6, help="Mean items per synthetic receipt (default: 6)")
+    parser.add_argument("--months", type=int, default=12, help="Months of synthetic history (default: 12)")
+    parser.add_argument("--user", help="Benchmark this user's data (default: the user with the most receipts)")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per benchmark (default: 5)")
+    parser.add_argument("--export-items", type=int, default=50, help="Items on the receipt used for per-receipt exports (default: 50)")
+    parser.add_argument("--only", nargs="+", choices=GROUPS, help="Run only these groups")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (default: 42)")
+    parser.add_argument("--output", help="Results JSON path (default: data/benchmarks/<timestamp>-<commit>.json)")
+    parser.add_argument("--compare", metavar="BASELINE", help="Previous results JSON to compare medians against")
+    # Used by the startup group: render one page in this fresh process and print its timings
+    parser.add_argument("--render-page", choices=STARTUP_PAGES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.render_page:
+        first_ms, rerun_ms = render_page(args.render_page, args.user)
+        print(json.dumps({"first_ms": round(first_ms, 3), "rerun_ms": round(rerun_ms, 3)}))
+        return
+
+    run_migrations()
+    if args.generate:
+        session = Session()
+        try:
+            synthetic_data.reset_synthetic_data(session)
+            session.commit()
+        finally:
+            session.close()
+        synthetic_data.generate(args.users, args.receipts, args.items, args.months, args.seed)
+
+    document = run(args.user, args.repeat, args.export_items, args.seed, args.only)
+    if args.generate:
+        document["meta"]["dataset"].update(generated_users=args.users, generated_receipts_per_user=args.receipts,
+                                           generated_mean_items=args.items, generated_months=args.months)
+
+    output = args.output
+    if not output:
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join("data", "benchmarks", f"{stamp}-{document['meta']['git_commit'] or 'nogit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(document, f, indent=2)
+    print(f"\nWrote {output}")
+
+    if args.compare:
+        compare(document, args.compare)
+
+
+if __name__ == "__main__":
+    main()
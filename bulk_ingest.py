@@ -0,0 +1,244 @@
+"""Concurrent bulk ingestion of receipt images.
+
+Used by `python process_receipt.py --batch <source> --user <email>` for
+back-office imports. Extractions run on a thread pool behind a
+requests/tokens-per-minute limiter. It is charged for every API request,
+including escalations to the strong model, repair calls and per-image
+fallbacks from a batch, so --rpm/--tpm also hold on bad scans. Transient API
+failures are retried with exponential backoff, and every saved receipt is
+appended to a checkpoint file so an interrupted import resumes where it
+stopped. With batch_size > 1 several
+images share one request (process_receipt_batch), so the system prompt is
+sent once per batch instead of once per image.
+"""
+import glob
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from extractors import TransientExtractionError
+from migrations import run_migrations
+from models import Session, User, Receipt
+from perceptual_hash import phash_file, find_near_duplicates
+from process_receipt import process_receipt, process_receipt_batch
+from receipt_store import save_receipt
+from tracing import trace, span
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# Errors worth retrying: every backend reports throttling, timeouts, dropped
+# connections and 5xx responses as TransientExtractionError
+TRANSIENT_ERRORS = (TransientExtractionError,)
+
+
+class RateLimiter:
+    """Sliding one-minute window limiter on request count and token usage."""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._window = deque()  # (timestamp, tokens) per admitted request
+        self._tokens_in_window = 0
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        while self._window and now - self._window[0][0] >= 60:
+            _, tokens = self._window.popleft()
+            self._tokens_in_window -= tokens
+
+    def acquire(self, tokens=0):
+        """Block until a request using `tokens` tokens fits in the current window."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._trim(now)
+                requests_ok = self.requests_per_minute is None or len(self._window) < self.requests_per_minute
+                tokens_ok = (
+                    self.tokens_per_minute is None
+                    or not self._window
+                    or self._tokens_in_window + tokens <= self.tokens_per_minute
+                )
+                if requests_ok and tokens_ok:
+                    self._window.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    return
+                wait = 60 - (now - self._window[0][0])
+            time.sleep(max(wait, 0.05))
+
+
+def collect_images(source):
+    """Resolve a directory, glob pattern or manifest file into a sorted list of image paths.
+
+    A manifest is a text file with one image path per line; relative paths are
+    resolved against the manifest's directory.
+    """
+    if os.path.isdir(source):
+        paths = []
+        for root, _, files in os.walk(source):
+            paths.extend(os.path.join(root, f) for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+        return sorted(paths)
+
+    if os.path.isfile(source) and not source.lower().endswith(IMAGE_EXTENSIONS):
+        base_dir = os.path.dirname(os.path.abspath(source))
+        paths = []
+        with open(source, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                paths.append(line if os.path.isabs(line) else os.path.join(base_dir, line))
+        return paths
+
+    return sorted(p for p in glob.glob(source, recursive=True) if p.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def load_checkpoint(checkpoint_path):
+    """Return the set of image hashes already ingested according to the checkpoint file."""
+    done = set()
+    if not os.path.exists(checkpoint_path):
+        return done
+    with open(checkpoint_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["image_hash"])
+            except (ValueError, KeyError):
+                # Ignore a partially written last line from a crash
+                continue
+    return done
+
+
+def _extract_with_retries(chunk, limiter, tokens_per_receipt, max_retries, base_delay, extractor=None, backend=None):
+    """Extract a chunk of (path, image_hash, phash) entries in one request; returns a result or exception per entry."""
+    def throttle(receipts):
+        limiter.acquire(tokens_per_receipt * receipts)
+
+    attempt = 0
+    while True:
+        try:
+            with trace(chunk[0][1][:16]):
+                if len(chunk) == 1:
+                    results = [process_receipt(chunk[0][0], chunk[0][1], extractor=extractor, backend=backend, throttle=throttle)]
+                else:
+                    results = process_receipt_batch([(path, image_hash) for path, image_hash, _ in chunk],
+                                                    extractor=extractor, backend=backend, throttle=throttle)
+        except TRANSIENT_ERRORS:
+            if attempt >= max_retries:
+                raise
+            delay = base_delay * (2 ** attempt)
+            time.sleep(delay + random.uniform(0, delay))
+            attempt += 1
+            continue
+        return [ValueError(result["error"]) if "error" in result else result for result in results]
+
+
+def run_batch(source, user_email, concurrency=4, requests_per_minute=60, tokens_per_minute=None,
+              tokens_per_receipt=2000, checkpoint_path=None, max_retries=5, base_delay=1.0,
+              skip_duplicates=True, extractor=None, backend=None, batch_size=1):
+    """Extract and save every image in `source` for the given user.
+
+    `batch_size` images are sent per request; receipts a batched answer gets
+    wrong are retried one by one.
+
+    `backend` selects the extraction backend (default: config.EXTRACTOR_BACKEND),
+    routed between its fast and strong models; an explicit `extractor` is used
+    on its own instead.
+
+    Returns a summary dict with counts of saved, skipped and failed images.
+    """
+    run_migrations()
+    session = Session()
+    try:
+        user = session.query(User).filter_by(email=user_email).first()
+        if user is None:
+            raise ValueError(f"No user with email {user_email}")
+        user_id = user.id
+    finally:
+        session.close()
+
+    checkpoint_path = checkpoint_path or "data/ingest_checkpoint.jsonl"
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint_path)), exist_ok=True)
+    done = load_checkpoint(checkpoint_path)
+
+    pending = []
+    skipped = 0
+    session = Session()
+    try:
+        for path in collect_images(source):
+            with open(path, "rb") as f:
+                image_hash = hashlib.sha256(f.read()).hexdigest()
+            if image_hash in done:
+                skipped += 1
+                continue
+            if skip_duplicates and session.query(Receipt.id).filter_by(user_id=user_id, image_hash=image_hash).first():
+                skipped += 1
+                continue
+            phash = phash_file(path)
+            if skip_duplicates and phash:
+                near = find_near_duplicates(session, user_id, phash, limit=1)
+                if near:
+                    print(f"Skipping {path}: looks like receipt {near[0][0].id} ({near[0][1]} bits apart)")
+                    skipped += 1
+                    continue
+            done.add(image_hash)  # Also de-duplicates identical files within this batch
+            pending.append((path, image_hash, phash))
+    finally:
+        session.close()
+
+    print(f"Ingesting {len(pending)} images ({skipped} already done) with concurrency {concurrency}, batch size {batch_size}")
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    saved, failed = 0, []
+
+    # Workers only call the API; results are written from this thread so SQLite sees one writer
+    with ThreadPoolExecutor(max_workers=concurrency) as pool, open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+        batch_size = max(1, batch_size)
+        chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        futures = {
+            pool.submit(_extract_with_retries, chunk, limiter, tokens_per_receipt, max_retries, base_delay, extractor, backend): chunk
+            for chunk in chunks
+        }
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                results = [e] * len(chunk)
+            for (path, image_hash, phash), result in zip(chunk, results):
+                receipt_id = _save_extracted(checkpoint, user_id, path, image_hash, phash, result)
+                if receipt_id is None:
+                    failed.append(path)
+                    continue
+                saved += 1
+                print(f"[{saved + len(failed)}/{len(pending)}] saved {path} as receipt {receipt_id}")
+
+    return {"saved": saved, "skipped": skipped, "failed": len(failed), "failed_paths": failed}
+
+
+def _save_extracted(checkpoint, user_id, path, image_hash, phash, result):
+    """Save one extraction result and checkpoint it; returns the receipt id, or None if it failed."""
+    try:
+        if isinstance(result, Exception):
+            raise result
+        session = Session()
+        try:
+            with trace(image_hash[:16]):
+                with span("save.build"):
+                    user = session.get(User, user_id)
+                    receipt, warnings = save_receipt(session, user, result, image_hash, phash)
+                with span("save.commit"):
+                    session.commit()
+            receipt_id = receipt.id
+        finally:
+            session.close()
+    except Exception as e:
+        print(f"FAILED {path}: {e}")
+        return None
+    for warning in warnings:
+        print(f"{path}: {warning}")
+    checkpoint.write(json.dumps({"path": path, "image_hash": image_hash, "receipt_id": receipt_id}) + "\n")
+    checkpoint.flush()
+    return receipt_id
@@ -1,9 +1,77 @@
 import pandas as pd
 import io
+import csv
+import math
+import xlsxwriter
+from datetime import datetime, time, timedelta
 from fpdf import FPDF
-from PIL import Image
-import tempfile
-import os
+from models import Receipt, ReceiptItem
+
+# Same palette as the Dashboard pie chart (Plotly's Dark24)
+CHART_COLORS = ['#2E91E5', '#E15F99', '#1CA71C', '#FB0D0D', '#DA16FF', '#222A2A',
+                '#B68100', '#750D86', '#EB663B', '#511CFB', '#00A08B', '#FB00D1']
+
+class ReportPDF(FPDF):
+    """FPDF with a filled circle-sector primitive for drawing pie charts."""
+
+    def sector(self, xc, yc, r, start_angle, end_angle, style='F'):
+        """Draw a sector centred on (xc, yc); angles in degrees, clockwise from 12 o'clock."""
+        k, h = self.k, self.h
+
+        def point(angle):
+            return xc + r * math.sin(angle), yc - r * math.cos(angle)
+
+        def out(x, y):
+            return '%.2F %.2F' % (x * k, (h - y) * k)
+
+        a, end = math.radians(start_angle), math.radians(end_angle)
+        ops = ['%.2F %.2F m' % (xc * k, (h - yc) * k), out(*point(a)) + ' l']
+        # Approximate the arc with cubic Beziers of at most 90 degrees each
+        while a < end - 1e-9:
+            b = min(end, a + math.pi / 2)
+            handle = 4 / 3 * math.tan((b - a) / 4) * r
+            x0, y0 = point(a)
+            x3, y3 = point(b)
+            x1, y1 = x0 + handle * math.cos(a), y0 + handle * math.sin(a)
+            x2, y2 = x3 - handle * math.cos(b), y3 - handle * math.sin(b)
+            ops.append('%s %s %s c' % (out(x1, y1), out(x2, y2), out(x3, y3)))
+            a = b
+        ops.append({'F': 'f', 'FD': 'b', 'DF': 'b'}.get(style, 's'))
+        self._out(' '.join(ops))
+
+def _hex_to_rgb(color):
+    color = color.lstrip('#')
+    return tuple(int(color[i:i + 2], 16) for i in (0, 2, 4))
+
+def draw_pie_chart(pdf, pie_data, radius=40):
+    """Draw a pie chart with a legend from [{'Category', 'Total'}] using PDF vector paths."""
+    total = sum(row['Total'] for row in pie_data)
+    if total <= 0:
+        pdf.multi_cell(0, 5, 'No spending data available.')
+        return
+    top = pdf.get_y() + 5
+    xc, yc = pdf.l_margin + radius + 5, top + radius
+
+    pdf.set_draw_color(255, 255, 255)
+    angle = 0.0
+    for idx, row in enumerate(pie_data):
+        sweep = 360.0 * row['Total'] / total
+        pdf.set_fill_color(*_hex_to_rgb(CHART_COLORS[idx % len(CHART_COLORS)]))
+        pdf.sector(xc, yc, radius, angle, angle + sweep, style='FD')
+        angle += sweep
+
+    # Legend to the right of the pie
+    pdf.set_font('Arial', '', 10)
+    legend_x = xc + radius + 15
+    for idx, row in enumerate(pie_data):
+        y = top + 5 + idx * 8
+        pdf.set_fill_color(*_hex_to_rgb(CHART_COLORS[idx % len(CHART_COLORS)]))
+        pdf.rect(legend_x, y, 5, 5, 'F')
+        pdf.set_xy(legend_x + 8, y)
+        pdf.cell(0, 5, f"{row['Category']}: ${row['Total']:.2f} ({row['Total'] / total * 100:.0f}%)")
+    pdf.set_draw_color(0, 0, 0)
+    pdf.set_fill_color(255, 255, 255)
+    pdf.set_y(max(top + 2 * radius, top + 5 + len(pie_data) * 8) + 5)
 
 def export_to_csv(store_info, transaction_details, items):
     # Combine all data into a single DataFrame for CSV
@@ -32,6 +100,117 @@ def export_to_csv(store_info, transaction_details, items):
     df.to_csv(csv_buffer, index=False)
     return csv_buffer.getvalue().encode('utf-8')
 
+HISTORY_CSV_COLUMNS = ['Receipt ID', 'Date', 'Vendor', 'Receipt Total', 'Item', 'Quantity', 'Price', 'Subtotal', 'Category']
+
+def _date_bounds(start_date, end_date):
+    """Turn an inclusive date range into datetime bounds [start, end)."""
+    start = datetime.combine(start_date, time.min) if start_date else None
+    end = datetime.combine(end_date, time.min) + timedelta(days=1) if end_date else None
+    return start, end
+
+def _query_history_items(session, user_id, start_date, end_date, chunk_rows):
+    start, end = _date_bounds(start_date, end_date)
+    query = session.query(
+        Receipt.id, Receipt.date, Receipt.vendor, Receipt.total,
+        ReceiptItem.name, ReceiptItem.quantity, ReceiptItem.price, ReceiptItem.subtotal, ReceiptItem.category
+    ).outerjoin(ReceiptItem).filter(Receipt.user_id == user_id)
+    if start is not None:
+        query = query.filter(Receipt.date >= start)
+    if end is not None:
+        query = query.filter(Receipt.date < end)
+    return query.order_by(Receipt.date, Receipt.id, ReceiptItem.id).yield_per(chunk_rows)
+
+def iter_history_csv(session, user_id, start_date=None, end_date=None, chunk_rows=1000):
+    """Yield the user's full receipt history as UTF-8 CSV chunks, one row per item.
+
+    Rows are streamed from the database with yield_per, so memory stays flat
+    regardless of history size. start_date and end_date are inclusive.
+    """
+    query = _query_history_items(session, user_id, start_date, end_date, chunk_rows)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(HISTORY_CSV_COLUMNS)
+    rows_in_buffer = 0
+    for row in query:
+        writer.writerow([row[0], row[1].strftime('%Y-%m-%d'), *row[2:]])
+        rows_in_buffer += 1
+        if rows_in_buffer >= chunk_rows:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            rows_in_buffer = 0
+    yield buffer.getvalue().encode('utf-8')
+
+def export_history_to_excel(session, user_id, output, start_date=None, end_date=None, chunk_rows=1000):
+    """Write the user's receipt history as an Excel workbook to output (a path or binary file).
+
+    Sheets: every item, a per-month summary and a category x month pivot. Rows
+    are streamed from the database into xlsxwriter's constant-memory mode and
+    the summaries are accumulated per month/category during the same pass, so
+    memory stays bounded however many items there are.
+    """
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    bold = workbook.add_format({'bold': True})
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd'})
+    money = workbook.add_format({'num_format': '0.00'})
+
+    items_sheet = workbook.add_worksheet('Items')
+    items_sheet.write_row(0, 0, HISTORY_CSV_COLUMNS, bold)
+    items_sheet.set_column(1, 1, 12)
+    items_sheet.set_column(2, 2, 24)
+    items_sheet.set_column(4, 4, 30)
+
+    months = {}  # month -> [receipts, items, total]
+    pivot = {}  # category -> {month: total}
+    last_receipt_id = None
+    row_idx = 1
+    for receipt_id, date, vendor, receipt_total, name, quantity, price, subtotal, category in _query_history_items(
+            session, user_id, start_date, end_date, chunk_rows):
+        items_sheet.write_number(row_idx, 0, receipt_id)
+        items_sheet.write_datetime(row_idx, 1, date, date_format)
+        items_sheet.write_string(row_idx, 2, vendor or '')
+        items_sheet.write_number(row_idx, 3, receipt_total or 0, money)
+        items_sheet.write_string(row_idx, 4, name or '')
+        if quantity is not None:
+            items_sheet.write_number(row_idx, 5, quantity)
+        if price is not None:
+            items_sheet.write_number(row_idx, 6, price, money)
+        if subtotal is not None:
+            items_sheet.write_number(row_idx, 7, subtotal, money)
+        items_sheet.write_string(row_idx, 8, category or '')
+        row_idx += 1
+
+        month = date.strftime('%Y-%m')
+        summary = months.setdefault(month, [0, 0, 0.0])
+        if receipt_id != last_receipt_id:
+            summary[0] += 1
+            last_receipt_id = receipt_id
+        if subtotal is not None:
+            summary[1] += 1
+            summary[2] += subtotal
+            by_month = pivot.setdefault(category, {})
+            by_month[month] = by_month.get(month, 0.0) + subtotal
+
+    month_sheet = workbook.add_worksheet('Monthly Summary')
+    month_sheet.write_row(0, 0, ['Month', 'Receipts', 'Items', 'Total Spent'], bold)
+    for idx, month in enumerate(sorted(months), start=1):
+        receipts, item_count, total = months[month]
+        month_sheet.write_row(idx, 0, [month, receipts, item_count])
+        month_sheet.write_number(idx, 3, total, money)
+
+    pivot_sheet = workbook.add_worksheet('Category Pivot')
+    month_columns = sorted(months)
+    pivot_sheet.write_row(0, 0, ['Category', *month_columns, 'Total'], bold)
+    for idx, category in enumerate(sorted(pivot), start=1):
+        by_month = pivot[category]
+        pivot_sheet.write_string(idx, 0, category)
+        for col, month in enumerate(month_columns, start=1):
+            pivot_sheet.write_number(idx, col, by_month.get(month, 0.0), money)
+        pivot_sheet.write_number(idx, len(month_columns) + 1, sum(by_month.values()), money)
+
+    workbook.close()
+
 def export_to_excel(store_info, transaction_details, items, pie_data):
     excel_buffer = io.BytesIO()
     with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
@@ -68,8 +247,13 @@ def export_to_excel(store_info, transaction_details, items, pie_data):
     excel_buffer.seek(0)
     return excel_buffer.getvalue()
 
-def export_to_pdf(store_info, transaction_details, items, fig):
-    pdf = FPDF()
+def export_to_pdf(store_info, transaction_details, items, pie_data):
+    """Build the PDF report for one receipt.
+
+    The category breakdown is drawn natively from pie_data as vector paths, so
+    no chart image is rendered, written to disk or embedded.
+    """
+    pdf = ReportPDF()
     pdf.add_page()
     pdf.set_font('Arial', 'B', 16)
     pdf.cell(200, 10, 'Receipt Genie Report', 0, 1, 'C')
@@ -78,20 +262,20 @@ def export_to_pdf(store_info, transaction_details, items, fig):
     pdf.set_font('Arial', 'B', 12)
     pdf.cell(200, 10, 'Store Information', 0, 1, 'L')
     pdf.set_font('Arial', '', 10)
-    pdf.multi_cell(0, 5, f'Name: {store_info.get('name')}')
-    pdf.multi_cell(0, 5, f'Address: {store_info.get('address')}')
-    pdf.multi_cell(0, 5, f'Phone: {store_info.get('phone')}')
-    pdf.multi_cell(0, 5, f'Date: {store_info.get('date')}')
+    pdf.multi_cell(0, 5, f'Name: {store_info.get("name")}')
+    pdf.multi_cell(0, 5, f'Address: {store_info.get("address")}')
+    pdf.multi_cell(0, 5, f'Phone: {store_info.get("phone")}')
+    pdf.multi_cell(0, 5, f'Date: {store_info.get("date")}')
     pdf.ln(5)
 
     pdf.set_font('Arial', 'B', 12)
     pdf.cell(200, 10, 'Transaction Details', 0, 1, 'L')
     pdf.set_font('Arial', '', 10)
-    pdf.multi_cell(0, 5, f'Total: ${transaction_details.get('total'):.2f}')
-    pdf.multi_cell(0, 5, f'Tax: ${transaction_details.get('tax'):.2f}')
-    pdf.multi_cell(0, 5, f'Subtotal: ${transaction_details.get('subtotal'):.2f}')
-    pdf.multi_cell(0, 5, f'Payment Method: {transaction_details.get('payment_method')}')
-    pdf.multi_cell(0, 5, f'Change: ${transaction_details.get('change'):.2f}')
+    pdf.multi_cell(0, 5, f'Total: ${transaction_details.get("total"):.2f}')
+    pdf.multi_cell(0, 5, f'Tax: ${transaction_details.get("tax"):.2f}')
+    pdf.multi_cell(0, 5, f'Subtotal: ${transaction_details.get("subtotal"):.2f}')
+    pdf.multi_cell(0, 5, f'Payment Method: {transaction_details.get("payment_method")}')
+    pdf.multi_cell(0, 5, f'Change: ${transaction_details.get("change"):.2f}')
     pdf.ln(5)
 
     pdf.set_font('Arial', 'B', 12)
@@ -118,27 +302,12 @@ def export_to_pdf(store_info, transaction_details, items, fig):
         pdf.multi_cell(0, 5, 'No items found.')
     pdf.ln(5)
 
-    # Add Plotly chart as image
-    if fig:
+    # Spending by category chart
+    if pie_data:
         pdf.add_page()
         pdf.set_font('Arial', 'B', 12)
         pdf.cell(200, 10, 'Spending by Category', 0, 1, 'L')
-        img_bytes = fig.to_image(format="png", engine="kaleido")
-        img = Image.open(io.BytesIO(img_bytes))
-        
-        # Resize image to fit PDF width while maintaining aspect ratio
-        img_width, img_height = img.size
-        pdf_width = 180  # Max width for image in PDF
-        pdf_height = (img_height / img_width) * pdf_width
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp_img_file:
-            img.save(tmp_img_file.name)
-            image_path = tmp_img_file.name
-        
-        # Center the image
-        x_coordinate = (pdf.w - pdf_width) / 2
-        pdf.image(image_path, x=x_coordinate, w=pdf_width, h=pdf_height)
-        os.remove(image_path) # Clean up the temporary file
+        draw_pie_chart(pdf, pie_data)
 
     pdf_output = pdf.output(dest='S').encode('latin-1') # Output as bytes
     return pdf_output 
\ No newline at end of file
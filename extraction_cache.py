@@ -0,0 +1,142 @@
+"""Persistent cache of parsed receipt extractions.
+
+Entries are keyed by the SHA-256 of the image bytes together with the model,
+prompt version and request parameters, so a re-upload of the same receipt is
+answered from the database instead of a new API call. The cache is bounded by
+entry count, total size and age; least recently used entries are evicted first.
+"""
+import hashlib
+import json
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+import config
+from models import Session, ExtractionCacheEntry
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+
+
+def make_key(image_hash, model, prompt_version, params):
+    """Build the cache key for an image and the exact request that would be sent."""
+    payload = json.dumps(
+        {"image_hash": image_hash, "model": model, "prompt_version": prompt_version, "params": params},
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _record(outcome):
+    with _stats_lock:
+        _stats[outcome] += 1
+
+
+def get(key):
+    """Return the cached extraction for key, or None on a miss."""
+    if not config.EXTRACTION_CACHE_ENABLED:
+        return None
+    session = Session()
+    try:
+        entry = session.get(ExtractionCacheEntry, key)
+        if entry is None:
+            _record("misses")
+            return None
+        now = datetime.utcnow()
+        if entry.created_at < now - timedelta(days=config.EXTRACTION_CACHE_MAX_AGE_DAYS):
+            session.delete(entry)
+            session.commit()
+            _record("misses")
+            return None
+        entry.hit_count += 1
+        entry.last_accessed_at = now
+        result = json.loads(entry.result)
+        session.commit()
+        _record("hits")
+        return result
+    finally:
+        session.close()
+
+
+def put(key, image_hash, model, prompt_version, result):
+    """Store a parsed extraction and evict old entries if the cache is over budget.
+
+    Losing the race to store the same key is not an error: the entry already
+    holds an extraction of the same image with the same request.
+    """
+    if not config.EXTRACTION_CACHE_ENABLED:
+        return
+    payload = json.dumps(result)
+    now = datetime.utcnow()
+    session = Session()
+    try:
+        entry = session.get(ExtractionCacheEntry, key)
+        if entry is None:
+            entry = ExtractionCacheEntry(key=key, image_hash=image_hash, model=model,
+                                         prompt_version=prompt_version, hit_count=0, created_at=now)
+            session.add(entry)
+        entry.result = payload
+        entry.size_bytes = len(payload.encode("utf-8"))
+        entry.last_accessed_at = now
+        try:
+            session.flush()
+        except IntegrityError:
+            # A concurrent extraction of the same image (double upload, two workers) stored it first
+            session.rollback()
+            return
+        _evict(session, now)
+        session.commit()
+    finally:
+        session.close()
+
+
+def _evict(session, now):
+    """Drop expired entries, then least recently used ones until within budget."""
+    cutoff = now - timedelta(days=config.EXTRACTION_CACHE_MAX_AGE_DAYS)
+    session.query(ExtractionCacheEntry).filter(ExtractionCacheEntry.created_at < cutoff).delete(synchronize_session=False)
+
+    count, total_bytes = session.query(
+        func.count(ExtractionCacheEntry.key), func.coalesce(func.sum(ExtractionCacheEntry.size_bytes), 0)
+    ).one()
+    if count <= config.EXTRACTION_CACHE_MAX_ENTRIES and total_bytes <= config.EXTRACTION_CACHE_MAX_BYTES:
+        return
+
+    oldest_first = session.query(ExtractionCacheEntry.key, ExtractionCacheEntry.size_bytes).order_by(
+        ExtractionCacheEntry.last_accessed_at
+    )
+    to_delete = []
+    for key, size in oldest_first.yield_per(500):
+        if count <= config.EXTRACTION_CACHE_MAX_ENTRIES and total_bytes <= config.EXTRACTION_CACHE_MAX_BYTES:
+            break
+        to_delete.append(key)
+        count -= 1
+        total_bytes -= size
+    for start in range(0, len(to_delete), 500):
+        batch = to_delete[start:start + 500]
+        session.query(ExtractionCacheEntry).filter(ExtractionCacheEntry.key.in_(batch)).delete(synchronize_session=False)
+
+
+def stats():
+    """Return hit/miss counts for this process plus the current size of the cache."""
+    session = Session()
+    try:
+        entries, total_bytes, total_hits = session.query(
+            func.count(ExtractionCacheEntry.key),
+            func.coalesce(func.sum(ExtractionCacheEntry.size_bytes), 0),
+            func.coalesce(func.sum(ExtractionCacheEntry.hit_count), 0)
+        ).one()
+    finally:
+        session.close()
+    with _stats_lock:
+        hits, misses = _stats["hits"], _stats["misses"]
+    lookups = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / lookups if lookups else 0.0,
+        "entries": entries,
+        "bytes": total_bytes,
+        "lifetime_hits": total_hits,
+    }
@@ -0,0 +1,324 @@
+"""Model backends that turn a receipt image into raw extraction output.
+
+Every backend receives the same OpenAI-style chat messages and returns the raw
+response text plus token usage, so parsing, caching, saving and exports are
+identical whichever one is used:
+
+- "openai":   OpenAI chat completions (gpt-4o by default)
+- "together": Together AI vision models through its OpenAI-compatible API
+- "fake":     deterministic offline replay of recorded fixtures, with
+              configurable latency and failure injection, for load tests and
+              benchmarks without network access or spend
+
+Backends raise TransientExtractionError for failures worth retrying
+(throttling, timeouts, dropped connections, 5xx responses). When `complete` is
+given an on_delta callback the response is streamed, and on_delta receives each
+piece of text as it arrives; the returned dict is the same either way.
+"""
+import glob
+import json
+import os
+import random
+import threading
+import time
+
+import config
+
+
+class TransientExtractionError(Exception):
+    """A backend failure that may succeed when retried."""
+
+
+class Extractor:
+    """Base class for extraction backends.
+
+    Subclasses set `name`, `model` and per-1K-token prices and implement
+    `complete`, returning {"content", "input_tokens", "output_tokens"}.
+    """
+
+    name = None
+    model = None
+    input_cost_per_1k = 0.0
+    output_cost_per_1k = 0.0
+
+    def complete(self, messages, params, image_hash=None, on_delta=None):
+        raise NotImplementedError
+
+    def cost(self, input_tokens, output_tokens):
+        return (input_tokens / 1000) * self.input_cost_per_1k + (output_tokens / 1000) * self.output_cost_per_1k
+
+
+def _collect_stream(chunks, on_delta):
+    """Accumulate an OpenAI-style streamed completion, passing each text delta to on_delta."""
+    parts = []
+    usage = None
+    for chunk in chunks:
+        if chunk.choices:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                on_delta(delta)
+        # Usage arrives on the final chunk
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+    return {
+        "content": "".join(parts),
+        "input_tokens": usage.prompt_tokens if usage else 0,
+        "output_tokens": usage.completion_tokens if usage else 0,
+    }
+
+
+def _api_key(env_name):
+    """Return an API key from the environment, failing clearly when it is not set."""
+    key = os.environ.get(env_name, "").strip()
+    if not key:
+        raise ValueError(f"{env_name} is not set; export it before using this backend")
+    return key
+
+
+def _set_prices(extractor, prices):
+    """Use the model's (input, output) per-1K-token prices when listed, else the class defaults."""
+    if extractor.model in prices:
+        extractor.input_cost_per_1k, extractor.output_cost_per_1k = prices[extractor.model]
+
+
+class OpenAIExtractor(Extractor):
+    name = "openai"
+    input_cost_per_1k = 0.005
+    output_cost_per_1k = 0.015
+    PRICES = {
+        "gpt-4o": (0.005, 0.015),
+        "gpt-4o-mini": (0.00015, 0.0006),
+    }
+
+    # Exception class names in openai treated as transient
+    TRANSIENT_ERROR_NAMES = ("RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError")
+
+    def __init__(self, model="gpt-4o"):
+        self.model = model
+        self._client = None
+        _set_prices(self, self.PRICES)
+
+    def _get_client(self):
+        if self._client is None:
+            # Imported on first use; the SDK is slow to import and only workers need it
+            from openai import OpenAI
+            self._client = OpenAI(api_key=_api_key("OPENAI_API_KEY"))
+        return self._client
+
+    def complete(self, messages, params, image_hash=None, on_delta=None):
+        import openai
+
+        transient = tuple(getattr(openai, n) for n in self.TRANSIENT_ERROR_NAMES)
+        try:
+            if on_delta is not None:
+                chunks = self._get_client().chat.completions.create(model=self.model, messages=messages, stream=True,
+                                                                    stream_options={"include_usage": True}, **params)
+                return _collect_stream(chunks, on_delta)
+            response = self._get_client().chat.completions.create(model=self.model, messages=messages, **params)
+        except transient as e:
+            raise TransientExtractionError(str(e)) from e
+        return {
+            "content": response.choices[0].message.content,
+            "input_tokens": response.usage.prompt_tokens,
+            "output_tokens": response.usage.completion_tokens,
+        }
+
+
+class TogetherExtractor(Extractor):
+    name = "together"
+    # Llama 3.2 90B Vision Turbo list price, $1.20 per million tokens either way
+    input_cost_per_1k = 0.0012
+    output_cost_per_1k = 0.0012
+    PRICES = {
+        "meta-llama/Llama-3.2-90B-Vision-Instruct-Turbo": (0.0012, 0.0012),
+        "meta-llama/Llama-3.2-11B-Vision-Instruct-Turbo": (0.00018, 0.00018),
+    }
+
+    # Exception class names in together.error treated as transient. APIError is left out:
+    # it is the base class of every API error, including authentication and invalid
+    # requests, and is only retried for 5xx responses (see complete)
+    TRANSIENT_ERROR_NAMES = ("RateLimitError", "Timeout", "APIConnectionError", "ServiceUnavailableError")
+
+    def __init__(self, model="meta-llama/Llama-3.2-90B-Vision-Instruct-Turbo"):
+        self.model = model
+        self._client = None
+        _set_prices(self, self.PRICES)
+
+    def _get_client(self):
+        if self._client is None:
+            from together import Together
+            self._client = Together(api_key=_api_key("TOGETHER_API_KEY"))
+        return self._client
+
+    def complete(self, messages, params, image_hash=None, on_delta=None):
+        import together
+
+        transient = tuple(
+            cls for cls in (getattr(together.error, n, None) for n in self.TRANSIENT_ERROR_NAMES)
+            if isinstance(cls, type)
+        )
+        api_error = getattr(together.error, "APIError", None)
+        try:
+            if on_delta is not None:
+                chunks = self._get_client().chat.completions.create(model=self.model, messages=messages, stream=True, **params)
+                return _collect_stream(chunks, on_delta)
+            response = self._get_client().chat.completions.create(model=self.model, messages=messages, **params)
+        except transient as e:
+            raise TransientExtractionError(str(e)) from e
+        except Exception as e:
+            # Plain APIError (not a subclass) is what the SDK raises for other 5xx responses
+            if api_error is not None and type(e) is api_error and (getattr(e, "http_status", None) or 0) >= 500:
+                raise TransientExtractionError(str(e)) from e
+            raise
+        return {
+            "content": response.choices[0].message.content,
+            "input_tokens": response.usage.prompt_tokens,
+            "output_tokens": response.usage.completion_tokens,
+        }
+
+
+class FakeExtractor(Extractor):
+    """Offline backend replaying recorded responses from a fixtures directory.
+
+    A fixture is a JSON file {"content", "input_tokens", "output_tokens"}. The
+    fixture named <image_hash>.json is used when present, otherwise one is
+    picked deterministically from the image hash. Latency, transient failures
+    and malformed (truncated) responses are drawn from a generator seeded with
+    the seed, image hash and attempt number, so runs are reproducible and
+    retries of a failed image can succeed.
+
+    A batched request passes the comma-separated hashes of its images and gets
+    their fixtures back as one JSON array.
+    """
+
+    name = "fake"
+    model = "fake-replay"
+    # When streaming, this share of the latency passes before the first chunk
+    FIRST_CHUNK_FRACTION = 0.2
+    STREAM_CHUNK_CHARS = 40
+    # Approximate system prompt tokens in each fixture, sent only once per batched request
+    SHARED_PROMPT_TOKENS = 350
+
+    def __init__(self, fixtures_dir=None, latency_ms=0, jitter_ms=0, failure_rate=0.0, malformed_rate=0.0, seed=0, model=None):
+        # A model name only labels the replay, so routing can be exercised offline
+        self.model = model or self.model
+        self.fixtures_dir = fixtures_dir or config.FAKE_EXTRACTOR_FIXTURES
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.malformed_rate = malformed_rate
+        self.seed = seed
+        self._fixtures = sorted(glob.glob(os.path.join(self.fixtures_dir, "*.json")))
+        if not self._fixtures:
+            raise ValueError(f"No extraction fixtures found in {self.fixtures_dir}")
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def _fixture_path(self, image_hash):
+        named = os.path.join(self.fixtures_dir, f"{image_hash}.json")
+        if os.path.exists(named):
+            return named
+        return self._fixtures[int(image_hash[:12], 16) % len(self._fixtures)]
+
+    def _load(self, image_hash):
+        hashes = image_hash.split(",")
+        fixtures = []
+        for single_hash in hashes:
+            with open(self._fixture_path(single_hash), encoding="utf-8") as f:
+                fixtures.append(json.load(f))
+        if len(fixtures) == 1:
+            return fixtures[0]
+        receipts = [json.loads(fixture["content"].strip().removeprefix("```json").removesuffix("```")) for fixture in fixtures]
+        return {
+            "content": json.dumps(receipts, indent=2),
+            "input_tokens": sum(fixture.get("input_tokens", 0) for fixture in fixtures) - self.SHARED_PROMPT_TOKENS * (len(fixtures) - 1),
+            "output_tokens": sum(fixture.get("output_tokens", 0) for fixture in fixtures),
+        }
+
+    def complete(self, messages, params, image_hash=None, on_delta=None):
+        image_hash = image_hash or "0"
+        with self._lock:
+            attempt = self._attempts.get(image_hash, 0)
+            self._attempts[image_hash] = attempt + 1
+        rng = random.Random(f"{self.seed}:{image_hash}:{attempt}")
+
+        delay_ms = self.latency_ms + rng.uniform(0, self.jitter_ms)
+        first_chunk_ms = delay_ms * self.FIRST_CHUNK_FRACTION if on_delta is not None else delay_ms
+        if first_chunk_ms > 0:
+            time.sleep(first_chunk_ms / 1000)
+        if rng.random() < self.failure_rate:
+            raise TransientExtractionError(f"Injected failure for {image_hash[:12]} (attempt {attempt + 1})")
+
+        fixture = self._load(image_hash)
+        content = fixture["content"]
+        if rng.random() < self.malformed_rate:
+            content = content[:len(content) // 2]
+        if on_delta is not None:
+            # Spread the rest of the latency over the chunks
+            chunks = [content[i:i + self.STREAM_CHUNK_CHARS] for i in range(0, len(content), self.STREAM_CHUNK_CHARS)]
+            pause = (delay_ms - first_chunk_ms) / 1000 / max(len(chunks), 1)
+            for chunk in chunks:
+                on_delta(chunk)
+                if pause > 0:
+                    time.sleep(pause)
+        return {
+            "content": content,
+            "input_tokens": fixture.get("input_tokens", 0),
+            "output_tokens": fixture.get("output_tokens", 0),
+        }
+
+
+def record_fixture(fixtures_dir, image_hash, response):
+    """Save a live backend response as a fixture the fake backend can replay."""
+    os.makedirs(fixtures_dir, exist_ok=True)
+    with open(os.path.join(fixtures_dir, f"{image_hash}.json"), "w", encoding="utf-8") as f:
+        json.dump(response, f, indent=2)
+
+
+BACKENDS = {
+    "openai": lambda model=None: OpenAIExtractor(model or config.OPENAI_MODEL),
+    "together": lambda model=None: TogetherExtractor(model or config.TOGETHER_MODEL),
+    "fake": lambda model=None: FakeExtractor(
+        config.FAKE_EXTRACTOR_FIXTURES,
+        latency_ms=config.FAKE_EXTRACTOR_LATENCY_MS,
+        jitter_ms=config.FAKE_EXTRACTOR_JITTER_MS,
+        failure_rate=config.FAKE_EXTRACTOR_FAILURE_RATE,
+        malformed_rate=config.FAKE_EXTRACTOR_MALFORMED_RATE,
+        seed=config.FAKE_EXTRACTOR_SEED,
+        model=model,
+    ),
+}
+
+# Cheaper, faster model tried first for each backend when routing is enabled
+FAST_MODELS = {
+    "openai": config.OPENAI_FAST_MODEL,
+    "together": config.TOGETHER_FAST_MODEL,
+    "fake": config.FAKE_FAST_MODEL,
+}
+
+_extractors = {}
+_extractors_lock = threading.Lock()
+
+
+def get_extractor(name=None, model=None):
+    """Return the shared extractor for a backend name (default config.EXTRACTOR_BACKEND) and model."""
+    name = name or config.EXTRACTOR_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown extractor backend {name!r}; choose from {', '.join(BACKENDS)}")
+    with _extractors_lock:
+        if (name, model) not in _extractors:
+            _extractors[(name, model)] = BACKENDS[name](model)
+        return _extractors[(name, model)]
+
+
+def get_routes(name=None):
+    """Return the extractors to try in order for a backend: its fast model first when routing is on.
+
+    The last one is the strong model, whose result is kept even when it looks doubtful.
+    """
+    strong = get_extractor(name)
+    fast_model = FAST_MODELS.get(name or config.EXTRACTOR_BACKEND) if config.ROUTING_ENABLED else None
+    if not fast_model or fast_model == strong.model:
+        return [strong]
+    return [get_extractor(name, fast_model), strong]
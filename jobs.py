@@ -0,0 +1,368 @@
+"""Durable receipt extraction queue.
+
+The Dashboard enqueues an ExtractionJob row for each upload and returns
+immediately. Workers claim jobs atomically by taking a lease: a conditional
+UPDATE that only one worker can win. A heartbeat renews the lease while the
+extraction runs, so only jobs whose worker died or hung past
+config.JOB_MAX_RUN_SECONDS see it expire and become claimable again. Failed
+attempts are retried with exponential backoff up to max_attempts; a job that
+keeps killing its worker fails for good once its attempts are used up.
+
+Jobs are worked by a small thread pool inside each app process
+(config.EXTRACTION_WORKERS) and/or by standalone `python worker.py` processes
+on any machine sharing the database.
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+
+from sqlalchemy import and_, or_, func
+
+import config
+from models import Session, User, ExtractionJob
+from receipt_store import save_receipt
+from tracing import trace, span, record
+
+ACTIVE_STATUSES = ('pending', 'running')
+
+_executor = None
+_executor_lock = threading.Lock()
+_wakeup_timer = None
+_wakeup_at = None
+
+
+def make_worker_id():
+    """Identify the current thread across hosts and processes."""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+
+def _lease_expired(now):
+    # The worker holding the lease crashed or hung
+    return and_(ExtractionJob.status == 'running',
+                or_(ExtractionJob.lease_expires_at.is_(None), ExtractionJob.lease_expires_at < now))
+
+
+def _claimable(now):
+    return or_(
+        and_(ExtractionJob.status == 'pending',
+             or_(ExtractionJob.available_at.is_(None), ExtractionJob.available_at <= now)),
+        and_(_lease_expired(now), ExtractionJob.attempts < ExtractionJob.max_attempts),
+    )
+
+
+def fail_abandoned_jobs(session, now=None):
+    """Fail expired-lease jobs that have used up their attempts; returns the number failed.
+
+    Without this a job that crashes every worker running it would be reclaimed forever.
+    """
+    now = now or datetime.utcnow()
+    abandoned = _lease_expired(now), ExtractionJob.attempts >= ExtractionJob.max_attempts
+    image_paths = [path for (path,) in session.query(ExtractionJob.image_path).filter(*abandoned)]
+    if not image_paths:
+        return 0
+    failed = session.query(ExtractionJob).filter(*abandoned).update({
+        ExtractionJob.status: 'failed',
+        ExtractionJob.error: 'Worker stopped before finishing the extraction on every attempt',
+        ExtractionJob.partial_result: None,
+        ExtractionJob.lease_expires_at: None,
+    }, synchronize_session=False)
+    session.commit()
+    for image_path in image_paths:
+        remove_upload(image_path)
+    return failed
+
+
+def claim_next_job(session, worker_id, candidates=5):
+    """Lease the oldest claimable job for worker_id and return its id, or None."""
+    now = datetime.utcnow()
+    fail_abandoned_jobs(session, now)
+    job_ids = session.query(ExtractionJob.id).filter(_claimable(now)).order_by(ExtractionJob.id).limit(candidates).all()
+    for (job_id,) in job_ids:
+        # The claimable condition is re-checked inside the UPDATE, so only one worker wins
+        claimed = session.query(ExtractionJob).filter(ExtractionJob.id == job_id, _claimable(now)).update({
+            ExtractionJob.status: 'running',
+            ExtractionJob.worker_id: worker_id,
+            ExtractionJob.lease_expires_at: now + timedelta(seconds=config.JOB_LEASE_SECONDS),
+            ExtractionJob.attempts: ExtractionJob.attempts + 1,
+        }, synchronize_session=False)
+        session.commit()
+        if claimed:
+            return job_id
+    return None
+
+
+def _held_lease(session, job_id, worker_id):
+    """Query for the job only while worker_id still holds its lease."""
+    return session.query(ExtractionJob).filter_by(id=job_id, worker_id=worker_id, status='running')
+
+
+def renew_lease(session, job_id, worker_id):
+    """Extend worker_id's lease on a running job; returns False if the lease was lost."""
+    renewed = _held_lease(session, job_id, worker_id).update({
+        ExtractionJob.lease_expires_at: datetime.utcnow() + timedelta(seconds=config.JOB_LEASE_SECONDS),
+    }, synchronize_session=False)
+    session.commit()
+    return bool(renewed)
+
+
+@contextmanager
+def _lease_heartbeat(job_id, worker_id):
+    """Renew the lease every third of JOB_LEASE_SECONDS while the block runs, up to JOB_MAX_RUN_SECONDS."""
+    stop = threading.Event()
+
+    def beat():
+        deadline = datetime.utcnow() + timedelta(seconds=config.JOB_MAX_RUN_SECONDS)
+        while not stop.wait(config.JOB_LEASE_SECONDS / 3) and datetime.utcnow() < deadline:
+            session = Session()
+            try:
+                if not renew_lease(session, job_id, worker_id):
+                    return
+            except Exception:
+                # A missed beat is harmless while the next one lands within the lease
+                session.rollback()
+            finally:
+                session.close()
+
+    thread = threading.Thread(target=beat, name=f"lease-{job_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+
+def _save_progress(session, job_id, worker_id, progress):
+    """Publish the partially extracted receipt on the job row for the Dashboard to show."""
+    _held_lease(session, job_id, worker_id).update({ExtractionJob.partial_result: json.dumps(progress)}, synchronize_session=False)
+    session.commit()
+
+
+def run_job(job_id, worker_id):
+    """Run a job this worker has claimed: extract, save the Receipt and record the outcome."""
+    # Imported here so the app pages importing this module do not load the extraction stack
+    from process_receipt import process_receipt
+
+    session = Session()
+    try:
+        job = session.get(ExtractionJob, job_id)
+        try:
+            with trace(job.image_hash[:16]), span("job.run", job_id=job_id, attempt=job.attempts):
+                if job.attempts == 1:
+                    record("job.queue_wait", (datetime.utcnow() - job.created_at).total_seconds() * 1000, attrs={"job_id": job_id})
+                on_partial = partial(_save_progress, session, job_id, worker_id) if config.EXTRACTION_STREAMING else None
+                with _lease_heartbeat(job_id, worker_id):
+                    result = process_receipt(job.image_path, job.image_hash, on_partial=on_partial)
+                if "error" in result:
+                    raise ValueError(result["error"])
+                # Save the receipt and complete the job in one transaction, and only if the lease
+                # was not lost to another worker in the meantime
+                with span("save.build"):
+                    user = session.get(User, job.user_id)
+                    receipt, warnings = save_receipt(session, user, result, job.image_hash, job.perceptual_hash)
+                    session.flush()
+                # Kept with the result so the Dashboard can show them, e.g. a date replaced by today's
+                result["save_warnings"] = [warning for warning in warnings if warning not in result.get("warnings", [])]
+                completed = _held_lease(session, job_id, worker_id).update({
+                    ExtractionJob.status: 'done',
+                    ExtractionJob.result: json.dumps(result),
+                    ExtractionJob.partial_result: None,
+                    ExtractionJob.receipt_id: receipt.id,
+                    ExtractionJob.error: None,
+                    ExtractionJob.lease_expires_at: None,
+                }, synchronize_session=False)
+                if completed:
+                    with span("save.commit"):
+                        session.commit()
+                    remove_upload(job.image_path)
+                else:
+                    session.rollback()
+        except Exception as e:
+            session.rollback()
+            job = session.get(ExtractionJob, job_id)
+            if job.attempts < job.max_attempts:
+                delay = config.JOB_RETRY_BASE_SECONDS * (2 ** (job.attempts - 1))
+                changes = {ExtractionJob.status: 'pending',
+                           ExtractionJob.available_at: datetime.utcnow() + timedelta(seconds=delay)}
+            else:
+                changes = {ExtractionJob.status: 'failed'}
+            changes.update({ExtractionJob.error: str(e), ExtractionJob.partial_result: None, ExtractionJob.lease_expires_at: None})
+            updated = _held_lease(session, job_id, worker_id).update(changes, synchronize_session=False)
+            session.commit()
+            if updated and changes[ExtractionJob.status] == 'failed':
+                remove_upload(job.image_path)
+    finally:
+        session.close()
+
+
+def drain_queue(worker_id=None, stop_event=None):
+    """Claim and run jobs until the queue has nothing claimable. Returns the number run."""
+    worker_id = worker_id or make_worker_id()
+    processed = 0
+    while stop_event is None or not stop_event.is_set():
+        session = Session()
+        try:
+            job_id = claim_next_job(session, worker_id)
+        finally:
+            session.close()
+        if job_id is None:
+            break
+        run_job(job_id, worker_id)
+        processed += 1
+    return processed
+
+
+def next_wakeup(session):
+    """Return when the next not-yet-claimable job becomes claimable (retry or lease expiry), or None."""
+    retry_at = session.query(func.min(ExtractionJob.available_at)).filter(ExtractionJob.status == 'pending').scalar()
+    lease_at = session.query(func.min(ExtractionJob.lease_expires_at)).filter(ExtractionJob.status == 'running').scalar()
+    times = [t for t in (retry_at, lease_at) if t is not None]
+    return min(times) if times else None
+
+
+def _drain_in_app():
+    """Drain the queue from the in-app pool, then sleep until the next retry or lease expiry."""
+    global _wakeup_timer, _wakeup_at
+    drain_queue()
+    session = Session()
+    try:
+        wakeup = next_wakeup(session)
+    finally:
+        session.close()
+    if wakeup is None:
+        return
+    with _executor_lock:
+        # Keep a single timer, moved earlier when a sooner wakeup is needed
+        if _wakeup_timer is not None and _wakeup_timer.is_alive() and _wakeup_at <= wakeup:
+            return
+        if _wakeup_timer is not None:
+            _wakeup_timer.cancel()
+        delay = max((wakeup - datetime.utcnow()).total_seconds(), 0) + 1
+        _wakeup_timer = threading.Timer(delay, lambda: _get_executor().submit(_drain_in_app))
+        _wakeup_timer.daemon = True
+        _wakeup_timer.start()
+        _wakeup_at = wakeup
+
+
+def _get_executor():
+    """Return the in-app worker pool, creating it once per process."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.EXTRACTION_WORKERS, thread_name_prefix="extraction")
+            # Pick up jobs left over from a previous process, and the uploads of finished ones
+            _executor.submit(sweep_uploads)
+            _executor.submit(_drain_in_app)
+        return _executor
+
+
+def store_upload(image_bytes, image_hash, suffix):
+    """Persist uploaded image bytes so they outlive the Streamlit rerun; returns the path.
+
+    Every upload gets its own file, so deleting one job's image never affects
+    another job for the same image.
+    """
+    os.makedirs(config.UPLOAD_DIR, exist_ok=True)
+    path = os.path.join(config.UPLOAD_DIR, f"{image_hash}.{uuid.uuid4().hex[:12]}{suffix}")
+    with open(path, "wb") as f:
+        f.write(image_bytes)
+    return path
+
+
+def remove_upload(image_path):
+    """Delete a job's uploaded image once the job is done or has failed for good."""
+    try:
+        os.remove(image_path)
+    except FileNotFoundError:
+        pass
+
+
+def sweep_uploads(min_age_seconds=3600):
+    """Delete uploads that no pending or running job needs; returns the number removed.
+
+    Catches images left behind by jobs failed outside run_job or by a crash
+    between finishing a job and deleting its file. Files younger than
+    min_age_seconds are kept: their job row may not be committed yet.
+    """
+    if not os.path.isdir(config.UPLOAD_DIR):
+        return 0
+    session = Session()
+    try:
+        needed = {
+            os.path.basename(path)
+            for (path,) in session.query(ExtractionJob.image_path).filter(ExtractionJob.status.in_(ACTIVE_STATUSES))
+        }
+    finally:
+        session.close()
+    cutoff = time.time() - min_age_seconds
+    removed = 0
+    for entry in os.scandir(config.UPLOAD_DIR):
+        if entry.name in needed or not entry.is_file():
+            continue
+        try:
+            if entry.stat().st_mtime >= cutoff:
+                continue
+        except FileNotFoundError:
+            # Swept by another worker starting at the same time
+            continue
+        remove_upload(entry.path)
+        removed += 1
+    return removed
+
+
+def enqueue_extraction(user_id, image_bytes, image_hash, suffix=".jpg", perceptual_hash=None):
+    """Queue an uploaded image for extraction and return the job id."""
+    image_path = store_upload(image_bytes, image_hash, suffix)
+    session = Session()
+    try:
+        job = ExtractionJob(user_id=user_id, image_path=image_path, image_hash=image_hash,
+                            perceptual_hash=perceptual_hash, status='pending',
+                            max_attempts=config.JOB_MAX_ATTEMPTS, available_at=datetime.utcnow())
+        session.add(job)
+        session.commit()
+        job_id = job.id
+    finally:
+        session.close()
+    if config.EXTRACTION_WORKERS > 0:
+        _get_executor().submit(_drain_in_app)
+    return job_id
+
+
+def _job_to_dict(job):
+    return {
+        "id": job.id,
+        "status": job.status,
+        "image_hash": job.image_hash,
+        "result": json.loads(job.result) if job.result else None,
+        "partial": json.loads(job.partial_result) if job.partial_result else None,
+        "error": job.error,
+        "attempts": job.attempts,
+        "receipt_id": job.receipt_id,
+        "created_at": job.created_at,
+    }
+
+
+def get_job(job_id):
+    """Return a job as a plain dict, or None if it does not exist."""
+    session = Session()
+    try:
+        job = session.get(ExtractionJob, job_id)
+        return _job_to_dict(job) if job else None
+    finally:
+        session.close()
+
+
+def recent_jobs(user_id, limit=5):
+    """Return the user's most recent jobs, newest first."""
+    session = Session()
+    try:
+        jobs = session.query(ExtractionJob).filter_by(user_id=user_id).order_by(ExtractionJob.created_at.desc()).limit(limit)
+        return [_job_to_dict(job) for job in jobs]
+    finally:
+        session.close()
@@ -0,0 +1,261 @@
+"""Schema upgrades and one-time data backfills for existing databases.
+
+`models.init_db` (Base.metadata.create_all) only creates missing tables, so columns and indexes
+added to existing models are applied here. Data migrations run once and are
+recorded in the schema_migrations table.
+
+The app and any number of worker processes call run_migrations at start. Each
+data migration first inserts its schema_migrations row and runs in that same
+transaction, so the row's primary key lets exactly one process apply it: the
+others block on the row, then skip it once it is committed.
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import DBAPIError, IntegrityError, OperationalError
+from sqlalchemy.schema import CreateIndex
+
+import config
+from models import engine, Base, Session, User, Receipt, ReceiptItem, Migration
+from perceptual_hash import phash_file, index_receipt
+from receipt_store import build_receipt_items, rebuild_monthly_spend
+
+USAGE_LOG_FILE = "data/gpt_usage_log.csv"
+# A receipt is saved a few seconds after its API call was logged
+BACKFILL_MATCH_WINDOW = timedelta(minutes=5)
+
+_lock = threading.Lock()
+_done = False
+
+
+def _create_missing_tables():
+    """Create tables that do not exist yet (models.init_db), tolerating processes starting together."""
+    existing_tables = set(inspect(engine).get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name in existing_tables:
+            continue
+        try:
+            # Its own transaction, starting with the write: SQLite then waits for the lock
+            # (busy_timeout) instead of failing to upgrade a read
+            with engine.begin() as conn:
+                table.create(conn)
+        except DBAPIError:
+            # Another process created it since we inspected the database
+            if not inspect(engine).has_table(table.name):
+                raise
+
+
+def _add_missing_columns():
+    """Add columns that exist on the models but not yet in the database."""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                default = ''
+                if column.server_default is not None:
+                    default = f' DEFAULT {column.server_default.arg.text}'
+                try:
+                    with conn.begin_nested():
+                        conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{default}'))
+                except DBAPIError:
+                    # Another process may have added it since we inspected the table
+                    if column.name not in {c['name'] for c in inspect(conn).get_columns(table.name)}:
+                        raise
+
+
+def _create_missing_indexes():
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                # IF NOT EXISTS, so processes starting together do not collide
+                conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def _parse_log_timestamp(value):
+    """Usage log timestamps are naive local time; receipts store naive UTC."""
+    return datetime.fromisoformat(value).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def backfill_receipt_image_hashes(session, log_file=USAGE_LOG_FILE):
+    """Attach image hashes from the usage log to receipts saved before they were stored.
+
+    Each receipt is matched to the latest unused log entry written shortly before it.
+    """
+    if not os.path.exists(log_file):
+        return 0
+
+    entries = []
+    with open(log_file, newline="") as f:
+        for row in csv.DictReader(f):
+            image_hash = row.get("image_hash")
+            if not image_hash or not row.get("timestamp"):
+                continue
+            try:
+                entries.append((_parse_log_timestamp(row["timestamp"]), image_hash))
+            except ValueError:
+                continue
+    if not entries:
+        return 0
+    entries.sort()
+    timestamps = [ts for ts, _ in entries]
+    used = set()
+
+    updated = 0
+    receipts = session.query(Receipt).filter(Receipt.image_hash.is_(None)).order_by(Receipt.created_at)
+    for receipt in receipts:
+        if receipt.created_at is None:
+            continue
+        pos = bisect_right(timestamps, receipt.created_at) - 1
+        while pos >= 0 and pos in used:
+            pos -= 1
+        if pos < 0 or receipt.created_at - timestamps[pos] > BACKFILL_MATCH_WINDOW:
+            continue
+        used.add(pos)
+        receipt.image_hash = entries[pos][1]
+        updated += 1
+    return updated
+
+
+def backfill_receipt_items(session, batch_size=500):
+    """Create receipt_items rows from the JSON items column of existing receipts."""
+    has_items = session.query(ReceiptItem.id).filter(ReceiptItem.receipt_id == Receipt.id).exists()
+    last_id = 0
+    created = 0
+    while True:
+        batch = session.query(Receipt.id, Receipt.items).filter(
+            Receipt.id > last_id, ~has_items
+        ).order_by(Receipt.id).limit(batch_size).all()
+        if not batch:
+            return created
+        for receipt_id, items_json in batch:
+            try:
+                items = json.loads(items_json or "[]")
+            except ValueError:
+                items = []
+            line_items = build_receipt_items(item for item in items if isinstance(item, dict))
+            for line_item in line_items:
+                line_item.receipt_id = receipt_id
+            session.add_all(line_items)
+            created += len(line_items)
+        last_id = batch[-1][0]
+        session.flush()
+
+
+def backfill_perceptual_hashes(session, upload_dir=None):
+    """Index perceptual hashes of existing receipts whose uploaded image is still on disk."""
+    upload_dir = upload_dir or config.UPLOAD_DIR
+    indexed = 0
+    receipts = session.query(Receipt).filter(Receipt.perceptual_hash.is_(None), Receipt.image_hash.isnot(None)).all()
+    for receipt in receipts:
+        paths = glob.glob(os.path.join(upload_dir, f"{receipt.image_hash}.*"))
+        phash = phash_file(paths[0]) if paths else None
+        if phash:
+            index_receipt(session, receipt, phash)
+            indexed += 1
+    return indexed
+
+
+def upgrade_usage_log(session, log_file=USAGE_LOG_FILE):
+    """Rewrite the API usage log under the current columns before any worker appends to it."""
+    # Imported here: process_receipt pulls in PIL and the extractors
+    from process_receipt import prepare_usage_log
+
+    prepare_usage_log(log_file)
+
+
+# Data migrations, applied once and in order
+DATA_MIGRATIONS = [
+    ("0001_backfill_receipt_image_hashes", backfill_receipt_image_hashes),
+    ("0002_backfill_receipt_items", backfill_receipt_items),
+    ("0003_build_monthly_category_spend", lambda session: rebuild_monthly_spend(session)),
+    ("0004_backfill_perceptual_hashes", backfill_perceptual_hashes),
+    ("0005_upgrade_usage_log", upgrade_usage_log),
+]
+
+
+def run_migrations():
+    """Bring the database schema and data up to date. Safe to call on every start."""
+    global _done
+    with _lock:
+        if _done:
+            return
+        _create_missing_tables()
+        _add_missing_columns()
+        _create_missing_indexes()
+
+        session = Session()
+        try:
+            applied = {m.name for m in session.query(Migration).all()}
+            for name, migrate in DATA_MIGRATIONS:
+                if name not in applied:
+                    _apply_data_migration(session, name, migrate)
+        finally:
+            session.close()
+        _done = True
+
+
+def _apply_data_migration(session, name, migrate, lock_wait_seconds=1):
+    """Apply one data migration unless another process has, holding its schema_migrations row meanwhile."""
+    while True:
+        try:
+            # Claim first: a second process blocks on this row until we commit, then gets IntegrityError
+            session.add(Migration(name=name))
+            session.flush()
+        except IntegrityError:
+            session.rollback()
+            return False
+        except OperationalError:
+            # SQLite gave up waiting for the write lock (a long migration elsewhere); try again
+            session.rollback()
+            time.sleep(lock_wait_seconds)
+            continue
+        try:
+            migrate(session)
+            session.commit()
+        except BaseException:
+            session.rollback()
+            raise
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply database migrations and rebuild derived tables.")
+    parser.add_argument("--rebuild-monthly-spend", action="store_true",
+                        help="Recompute the monthly spend-by-category aggregate from receipt items")
+    parser.add_argument("--user", help="Only rebuild aggregates for this user's email")
+    args = parser.parse_args()
+
+    run_migrations()
+    if args.rebuild_monthly_spend:
+        session = Session()
+        try:
+            user_id = None
+            if args.user:
+                user = session.query(User).filter_by(email=args.user).first()
+                if user is None:
+                    parser.error(f"No user with email {args.user}")
+                user_id = user.id
+            rows = rebuild_monthly_spend(session, user_id)
+            session.commit()
+            print(f"Rebuilt {rows} monthly spend rows")
+        finally:
+            session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,39 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, ForeignKey, Text
+from sqlalchemy import create_engine, event, Column, Integer, String, DateTime, Float, ForeignKey, Text, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-import bcrypt
+from contextlib import contextmanager
 from datetime import datetime
 import json
+import config
+import passwords
 
-# Create SQLite database
-engine = create_engine('sqlite:///users.db')
+def make_engine(url):
+    """Create the engine for a database URL, tuned for concurrent app sessions and workers."""
+    if url.startswith('sqlite'):
+        # Connections are shared across Streamlit script threads; writers wait for the lock
+        # (busy_timeout) instead of failing with "database is locked"
+        engine = create_engine(url, connect_args={'check_same_thread': False, 'timeout': config.SQLITE_BUSY_TIMEOUT_MS / 1000})
+
+        @event.listens_for(engine, 'connect')
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            # WAL lets readers run alongside a writer; NORMAL sync is safe in WAL mode
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute(f'PRAGMA busy_timeout={int(config.SQLITE_BUSY_TIMEOUT_MS)}')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.close()
+        return engine
+    # Server databases such as PostgreSQL get a connection pool that survives restarts
+    return create_engine(
+        url,
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=config.DB_MAX_OVERFLOW,
+        pool_recycle=config.DB_POOL_RECYCLE_SECONDS,
+        pool_pre_ping=True,
+    )
+
+# One engine (and connection pool) per process
+engine = make_engine(config.DATABASE_URL)
 Base = declarative_base()
 
 class User(Base):
@@ -16,15 +43,23 @@ class User(Base):
     email = Column(String, unique=True, nullable=False)
     password_hash = Column(String, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Bumped whenever the user's receipts change; keys cached per-user computations
+    data_version = Column(Integer, nullable=False, default=0, server_default=text('0'))
     receipts = relationship('Receipt', back_populates='user')
     budgets = relationship('Budget', back_populates='user')
     
     def set_password(self, password):
-        salt = bcrypt.gensalt()
-        self.password_hash = bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+        self.password_hash = passwords.hash_password(password)
     
     def check_password(self, password):
-        return bcrypt.checkpw(password.encode('utf-8'), self.password_hash.encode('utf-8'))
+        return passwords.verify_password(password, self.password_hash)
+
+    def upgrade_password_hash(self, password):
+        """Re-hash a just-verified password if it was stored with another cost; returns True if changed."""
+        if not passwords.needs_rehash(self.password_hash):
+            return False
+        self.set_password(password)
+        return True
 
 class Receipt(Base):
     __tablename__ = 'receipts'
@@ -33,10 +68,61 @@ class Receipt(Base):
     date = Column(DateTime, nullable=False)
     vendor = Column(String, nullable=False)
     total = Column(Float, nullable=False)
-    items = Column(Text, nullable=False)  # Store as JSON string
+    items = Column(Text, nullable=False)  # Full item JSON as extracted; queries use receipt_items
     categories = Column(Text, nullable=True)  # Store as JSON string
+    image_hash = Column(String, nullable=True)  # SHA-256 of the uploaded image bytes
+    perceptual_hash = Column(String, nullable=True)  # DCT pHash of the image as hex, for near-duplicate search
     created_at = Column(DateTime, default=datetime.utcnow)
     user = relationship('User', back_populates='receipts')
+    line_items = relationship('ReceiptItem', back_populates='receipt', cascade='all, delete-orphan')
+    hash_bands = relationship('ReceiptHashBand', cascade='all, delete-orphan')
+
+    __table_args__ = (
+        Index('ix_receipts_user_image_hash', 'user_id', 'image_hash'),
+        Index('ix_receipts_user_date', 'user_id', 'date'),
+    )
+
+class ReceiptItem(Base):
+    __tablename__ = 'receipt_items'
+    id = Column(Integer, primary_key=True)
+    receipt_id = Column(Integer, ForeignKey('receipts.id'), nullable=False)
+    name = Column(String, nullable=True)
+    price = Column(Float, nullable=True)
+    quantity = Column(Float, nullable=True)
+    category = Column(String, nullable=False, index=True)
+    subtotal = Column(Float, nullable=False, index=True)
+    receipt = relationship('Receipt', back_populates='line_items')
+
+    __table_args__ = (
+        # Covers the per-receipt SUM(subtotal) GROUP BY category aggregates
+        Index('ix_receipt_items_receipt_category_subtotal', 'receipt_id', 'category', 'subtotal'),
+    )
+
+class ReceiptHashBand(Base):
+    """One 8-bit slice of a receipt's perceptual hash (multi-index hashing).
+
+    Hashes within fewer bits of each other than there are bands share at least
+    one band value exactly, so near-duplicates are found with indexed equality
+    lookups instead of a scan over every receipt.
+    """
+    __tablename__ = 'receipt_hash_bands'
+    receipt_id = Column(Integer, ForeignKey('receipts.id'), primary_key=True)
+    band = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    value = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index('ix_receipt_hash_bands_lookup', 'user_id', 'band', 'value'),
+    )
+
+class MonthlyCategorySpend(Base):
+    """Per-user spending per month and category, kept up to date as receipts are saved."""
+    __tablename__ = 'monthly_category_spend'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    month = Column(String, primary_key=True)  # e.g., '2024-06'
+    category = Column(String, primary_key=True)
+    total = Column(Float, nullable=False, default=0.0)
+    item_count = Column(Integer, nullable=False, default=0)
 
 class Budget(Base):
     __tablename__ = 'budgets'
@@ -47,8 +133,65 @@ class Budget(Base):
     amount = Column(Float, nullable=False)
     user = relationship('User', back_populates='budgets')
 
-# Create tables
-Base.metadata.create_all(engine)
+class ExtractionCacheEntry(Base):
+    __tablename__ = 'extraction_cache'
+    key = Column(String, primary_key=True)  # SHA-256 of image hash + model + prompt version + params
+    image_hash = Column(String, nullable=False, index=True)
+    model = Column(String, nullable=False)
+    prompt_version = Column(String, nullable=False)
+    result = Column(Text, nullable=False)  # Parsed extraction stored as JSON string
+    size_bytes = Column(Integer, nullable=False)
+    hit_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    last_accessed_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class ExtractionJob(Base):
+    """A receipt image queued for extraction; the worker saves the Receipt when done."""
+    __tablename__ = 'extraction_jobs'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    image_path = Column(String, nullable=False)
+    image_hash = Column(String, nullable=False)
+    perceptual_hash = Column(String, nullable=True)
+    status = Column(String, nullable=False, default='pending', index=True)  # pending, running, done, failed
+    result = Column(Text, nullable=True)  # Extraction JSON once done
+    partial_result = Column(Text, nullable=True)  # Store info and items streamed so far while running
+    error = Column(Text, nullable=True)
+    receipt_id = Column(Integer, ForeignKey('receipts.id'), nullable=True)
+    attempts = Column(Integer, nullable=False, default=0, server_default=text('0'))
+    max_attempts = Column(Integer, nullable=False, default=3, server_default=text('3'))
+    available_at = Column(DateTime, nullable=True)  # Not claimable before this time (retry backoff)
+    worker_id = Column(String, nullable=True)  # Worker holding the lease while running
+    lease_expires_at = Column(DateTime, nullable=True)  # Running jobs past this are reclaimed
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_extraction_jobs_user_created', 'user_id', 'created_at'),
+        Index('ix_extraction_jobs_status_available', 'status', 'available_at'),
+    )
+
+class Migration(Base):
+    __tablename__ = 'schema_migrations'
+    name = Column(String, primary_key=True)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+def init_db():
+    """Create missing tables. Called by migrations.run_migrations rather than on import."""
+    Base.metadata.create_all(engine)
 
 # Create session factory
-Session = sessionmaker(bind=engine) 
\ No newline at end of file
+Session = sessionmaker(bind=engine)
+
+@contextmanager
+def session_scope():
+    """Provide a session that is committed on success, rolled back on error and always closed."""
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close() 
\ No newline at end of file
@@ -0,0 +1,66 @@
+"""bcrypt password hashing on a bounded thread pool.
+
+bcrypt is deliberately slow (about 250 ms at cost 12) and releases the GIL
+while it runs. Running it on a pool of config.BCRYPT_MAX_CONCURRENCY threads
+caps how many hashes compete for the CPU during a login burst, so requests
+queue briefly instead of all slowing down together.
+
+The work factor is config.BCRYPT_ROUNDS. Stored hashes keep the cost they
+were created with and still verify after it changes; `needs_rehash` tells
+the login flow to re-hash them at the configured cost.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+import config
+
+# Costs bcrypt accepts
+MIN_ROUNDS = 4
+MAX_ROUNDS = 31
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.BCRYPT_MAX_CONCURRENCY, thread_name_prefix="bcrypt")
+        return _executor
+
+
+def configured_rounds():
+    return min(max(config.BCRYPT_ROUNDS, MIN_ROUNDS), MAX_ROUNDS)
+
+
+def hash_password(password):
+    """Return a bcrypt hash of password at the configured cost."""
+    salt = bcrypt.gensalt(rounds=configured_rounds())
+    hashed = _get_executor().submit(bcrypt.hashpw, password.encode('utf-8'), salt).result()
+    return hashed.decode('utf-8')
+
+
+def verify_password(password, password_hash):
+    """Return True if password matches the stored bcrypt hash."""
+    try:
+        return _get_executor().submit(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8')).result()
+    except ValueError:
+        # Not a bcrypt hash
+        return False
+
+
+def hash_rounds(password_hash):
+    """Return the cost factor stored in a bcrypt hash ('$2b$12$...'), or None."""
+    parts = password_hash.split('$')
+    try:
+        return int(parts[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def needs_rehash(password_hash):
+    """True when the stored hash was made with a different cost than the configured one."""
+    return hash_rounds(password_hash) != configured_rounds()
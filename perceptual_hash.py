@@ -0,0 +1,148 @@
+"""Perceptual hashing and near-duplicate search for receipt images.
+
+The exact SHA-256 image hash misses the same receipt re-photographed,
+re-cropped or re-saved in another format. A DCT perceptual hash (pHash) of the
+downscaled grayscale image keeps only its low-frequency structure, which
+survives rescaling, re-encoding and border crops, so receipts whose hashes are
+within config.PHASH_MAX_DISTANCE bits are flagged as likely duplicates before
+any API call is made. On rendered receipts, half-size PNG and JPEG copies,
+JPEG q30-q60 re-encodes and 90% resizes land within about 15 bits of the
+original, while different receipts stay more than 55 bits apart (see
+tests/test_perceptual_hash.py).
+
+Lookups use multi-index hashing: each 256-bit hash is stored as 32 bands of 8
+bits in receipt_hash_bands. Two hashes that differ in fewer than 32 bits
+agree exactly on at least one band, so candidates come from 32 indexed
+equality lookups and only those are compared bit by bit.
+"""
+import io
+from functools import lru_cache
+
+from sqlalchemy import select, union
+
+import config
+from models import Receipt, ReceiptHashBand
+
+DCT_SIZE = 64  # Side of the downscaled image the DCT is taken of
+HASH_SIZE = 16  # Low-frequency DCT coefficients kept per side; the hash has HASH_SIZE * HASH_SIZE bits
+BAND_BITS = 8
+BAND_COUNT = HASH_SIZE * HASH_SIZE // BAND_BITS
+# Images with less contrast than this (standard deviation of gray levels) are near-blank
+# and would match each other
+MIN_CONTRAST = 2.0
+
+
+@lru_cache(maxsize=None)
+def _dct_matrix(n):
+    """Orthonormal DCT-II basis: _dct_matrix(n) @ x is the DCT of a length-n vector x."""
+    import numpy as np
+
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def _trim_background(gray, tolerance=40):
+    """Crop away the uniform border (table, scanner bed) around the receipt."""
+    corners = sorted(gray.getpixel(xy) for xy in ((0, 0), (gray.width - 1, 0), (0, gray.height - 1), (gray.width - 1, gray.height - 1)))
+    background = corners[1]
+    box = gray.point(lambda p: 255 if abs(p - background) > tolerance else 0).getbbox()
+    return gray.crop(box) if box else gray
+
+
+def phash(image):
+    """Return the DCT perceptual hash of a PIL image as a hex string, or None for near-blank images.
+
+    Borders are trimmed first so re-crops that keep the whole receipt hash the
+    same. Each bit says whether a low-frequency coefficient is above their
+    median, so half the bits are set whatever the image.
+    """
+    # numpy and PIL are imported on first use: only uploads need them, not every page
+    import numpy as np
+    from PIL import Image, ImageOps
+
+    gray = _trim_background(ImageOps.exif_transpose(image).convert("L"))
+    # BOX averages every source pixel, so the result hardly depends on the input resolution
+    pixels = np.asarray(gray.resize((DCT_SIZE, DCT_SIZE), Image.BOX), dtype=np.float64)
+    if pixels.std() < MIN_CONTRAST:
+        return None
+    dct = _dct_matrix(DCT_SIZE)
+    coefficients = (dct @ pixels @ dct.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+    value = 0
+    for bit in coefficients > np.median(coefficients):
+        value = (value << 1) | int(bit)
+    return f"{value:0{HASH_SIZE * HASH_SIZE // 4}x}"
+
+
+def phash_bytes(image_bytes):
+    """Return the perceptual hash of encoded image bytes, or None if they are not a usable image."""
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            return phash(image)
+    except (OSError, ValueError):
+        return None
+
+
+def phash_file(path):
+    """Return the perceptual hash of an image file, or None if it is not a usable image."""
+    from PIL import Image
+
+    try:
+        with Image.open(path) as image:
+            return phash(image)
+    except (OSError, ValueError):
+        return None
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
+
+
+def hash_bands(phash):
+    """Split a hex hash into BAND_COUNT integer bands, most significant first."""
+    chars = BAND_BITS // 4
+    return [int(phash[i * chars:(i + 1) * chars], 16) for i in range(BAND_COUNT)]
+
+
+def index_receipt(session, receipt, phash):
+    """Store the perceptual hash of a receipt and its band rows; the caller commits."""
+    receipt.perceptual_hash = phash
+    receipt.hash_bands = [
+        ReceiptHashBand(band=band, user_id=receipt.user_id, value=value)
+        for band, value in enumerate(hash_bands(phash))
+    ]
+
+
+def find_near_duplicates(session, user_id, phash, max_distance=None, limit=5):
+    """Return the user's receipts whose images are within max_distance bits of phash.
+
+    Results are [(receipt, distance)], closest first.
+    """
+    max_distance = config.PHASH_MAX_DISTANCE if max_distance is None else max_distance
+    if max_distance >= BAND_COUNT:
+        raise ValueError(f"max_distance must be below {BAND_COUNT}, the number of hash bands")
+    # One exact (user_id, band, value) index lookup per band; SQLite will not use the
+    # whole index for an OR of these conditions, so they are combined with UNION.
+    # Every band is searched: only then is a hash within max_distance bits guaranteed
+    # to share at least one of them.
+    band_lookups = [
+        select(ReceiptHashBand.receipt_id).where(
+            ReceiptHashBand.user_id == user_id, ReceiptHashBand.band == band, ReceiptHashBand.value == value
+        )
+        for band, value in enumerate(hash_bands(phash))
+    ]
+    candidate_ids = union(*band_lookups).scalar_subquery()
+    candidates = session.query(Receipt.id, Receipt.perceptual_hash).filter(Receipt.id.in_(candidate_ids))
+    close = sorted(
+        (distance, receipt_id)
+        for receipt_id, candidate_hash in candidates
+        if (distance := hamming_distance(phash, candidate_hash)) <= max_distance
+    )[:limit]
+    if not close:
+        return []
+    receipts = {r.id: r for r in session.query(Receipt).filter(Receipt.id.in_([rid for _, rid in close]))}
+    return [(receipts[receipt_id], distance) for distance, receipt_id in close]
@@ -1,5 +1,4 @@
-import openai
-from PIL import Image
+from PIL import Image, ImageOps
 import base64
 import io
 import json
@@ -8,49 +7,20 @@ from datetime import datetime
 import os
 import sys
 import hashlib
+import argparse
+import functools
+import threading
+import time
+import config
+import extraction_cache
+import extractors
+import receipt_schema
+from receipt_stream import StreamProgress, mark_restarted
+from tracing import span
 
-# Set OpenAI API key
-openai.api_key = "ADD YOU OPENAI API KEY HERE"
+REQUEST_PARAMS = {"max_tokens": 1500, "temperature": 0.2}
 
-def encode_image(image_path):
-    """Convert image to base64 encoding."""
-    with Image.open(image_path) as image:
-        buffered = io.BytesIO()
-        image.save(buffered, format="JPEG")
-        img_bytes = buffered.getvalue()
-        encoded_image = base64.b64encode(img_bytes).decode("utf-8")
-        return encoded_image
-
-def log_usage(image_path, input_tokens, output_tokens, total_cost, image_hash):
-    """Log API usage and costs to CSV file."""
-    log_file = "data/gpt_usage_log.csv"
-    # Ensure the data directory exists
-    os.makedirs(os.path.dirname(log_file), exist_ok=True)
-
-    file_exists = os.path.isfile(log_file)
-    with open(log_file, "a", newline="") as f:
-        writer = csv.writer(f)
-        if not file_exists:
-            writer.writerow(["timestamp", "image_path", "input_tokens", "output_tokens", "total_cost", "image_hash"])
-        writer.writerow([
-            datetime.now().isoformat(),
-            image_path,
-            input_tokens,
-            output_tokens,
-            f"{total_cost:.4f}",
-            image_hash
-        ])
-
-def process_receipt(image_path, image_hash):
-    """Process receipt image using GPT-4 Vision to extract and classify data."""
-    base64_image = encode_image(image_path)
-
-    response = openai.chat.completions.create(
-    model="gpt-4o",
-    messages=[
-        {
-            "role": "system",
-            "content": """
+SYSTEM_PROMPT = """
 You are a data extraction assistant. Your task is to extract and classify data from a receipt image and return a clean JSON object with this exact structure:
 
 {
@@ -87,6 +57,177 @@ You are a data extraction assistant. Your task is to extract and classify data f
 - Format dates as YYYY-MM-DD (e.g., 2024-03-19).
 - Return ONLY the JSON object. Do not include any explanations or markdown.
 """
+
+USER_PROMPT = "Extract all data from this receipt image using the rules above and output a valid JSON."
+
+# Several receipts in one request share a single copy of the system prompt
+BATCH_PROMPT = """These are {count} different receipts, one image each, in order.
+Extract each one using the rules above and output ONLY a JSON array of {count} objects, one per receipt, in the same order."""
+# Output budget for a batched request: REQUEST_PARAMS' budget per receipt, capped at the models' output limit
+BATCH_MAX_TOKENS = 16000
+
+# Text-only follow-up when a response cannot be repaired locally (see receipt_schema)
+REPAIR_PROMPT = """This JSON was extracted from a receipt but has these problems: {problems}.
+Return ONLY the corrected JSON object with the structure above. Keep every item and value that is present; do not invent new ones.
+
+{content}"""
+REPAIR_PARAMS = {"max_tokens": 2000, "temperature": 0}
+
+# Bump automatically whenever the prompts change so stale cache entries are never served
+PROMPT_VERSION = hashlib.sha256((SYSTEM_PROMPT + USER_PROMPT).encode("utf-8")).hexdigest()[:12]
+
+# Image preprocessing. GPT-4o fits images within 2048x2048 and then scales the
+# shortest side down to 768px before tiling, so larger uploads only cost bytes.
+GRAYSCALE = True
+MAX_LONG_EDGE = 2048
+MAX_SHORT_EDGE = 768
+TARGET_IMAGE_BYTES = 400 * 1024
+JPEG_QUALITY_STEPS = (90, 80, 70, 60)
+
+USAGE_LOG_FILE = "data/gpt_usage_log.csv"
+USAGE_LOG_FIELDS = ["timestamp", "image_path", "input_tokens", "output_tokens", "total_cost", "image_hash",
+                    "original_bytes", "encoded_bytes", "model", "route", "latency_ms"]
+_log_lock = threading.Lock()
+
+def preprocess_image(image_path):
+    """Orient, grayscale, downscale and compress a receipt photo for upload.
+
+    Returns the JPEG bytes and a dict of size statistics for the usage log.
+    """
+    original_bytes = os.path.getsize(image_path)
+    with Image.open(image_path) as image:
+        # Phone cameras store rotation in EXIF rather than in the pixels
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("L" if GRAYSCALE else "RGB")
+        original_size = image.size
+
+        # The model never sees more detail than this, so anything larger is wasted bytes
+        width, height = image.size
+        scale = min(1.0, MAX_LONG_EDGE / max(width, height), MAX_SHORT_EDGE / min(width, height))
+        if scale < 1.0:
+            image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+
+        # Use the highest quality that fits the byte budget
+        for quality in JPEG_QUALITY_STEPS:
+            buffered = io.BytesIO()
+            image.save(buffered, format="JPEG", quality=quality, optimize=True)
+            if buffered.tell() <= TARGET_IMAGE_BYTES:
+                break
+        img_bytes = buffered.getvalue()
+
+    stats = {
+        "original_bytes": original_bytes,
+        "encoded_bytes": len(img_bytes),
+        "original_size": original_size,
+        "encoded_size": image.size,
+        "jpeg_quality": quality,
+    }
+    return img_bytes, stats
+
+def encode_image(image_path):
+    """Convert image to base64 encoding."""
+    img_bytes, _ = preprocess_image(image_path)
+    return base64.b64encode(img_bytes).decode("utf-8")
+
+def prepare_usage_log(log_file=USAGE_LOG_FILE):
+    """Create the usage log, or rewrite one written with an older column set so rows stay aligned.
+
+    Run once before any extraction appends to the log (the usage log data
+    migration), since worker processes append without coordinating.
+    """
+    if not os.path.isfile(log_file):
+        _create_usage_log(log_file)
+        return
+    with open(log_file, newline="") as f:
+        header = next(csv.reader(f), [])
+    if header == USAGE_LOG_FIELDS:
+        return
+    tmp_file = log_file + ".tmp"
+    with open(log_file, newline="") as src, open(tmp_file, "w", newline="") as dst:
+        writer = csv.DictWriter(dst, fieldnames=USAGE_LOG_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for row in csv.DictReader(src):
+            writer.writerow(row)
+    os.replace(tmp_file, log_file)
+
+def _create_usage_log(log_file):
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    try:
+        # Exclusive create: never truncate a log another process has just started
+        with open(log_file, "x", newline="") as f:
+            csv.writer(f).writerow(USAGE_LOG_FIELDS)
+    except FileExistsError:
+        pass
+
+def log_usage(image_path, input_tokens, output_tokens, total_cost, image_hash, image_stats=None,
+              model="", route="", latency_ms=None):
+    """Log API usage, cost and latency of one model request to CSV file."""
+    log_file = USAGE_LOG_FILE
+    image_stats = image_stats or {}
+    line = io.StringIO()
+    csv.writer(line).writerow([
+        datetime.now().isoformat(),
+        image_path,
+        input_tokens,
+        output_tokens,
+        f"{total_cost:.6f}",
+        image_hash,
+        image_stats.get("original_bytes", ""),
+        image_stats.get("encoded_bytes", ""),
+        model,
+        route,
+        "" if latency_ms is None else f"{latency_ms:.0f}"
+    ])
+
+    # Bulk ingestion logs from several threads and the worker from several processes at
+    # once; each row is appended with a single write so rows never interleave
+    with _log_lock:
+        if not os.path.isfile(log_file):
+            _create_usage_log(log_file)
+        with open(log_file, "a", newline="") as f:
+            f.write(line.getvalue())
+
+def usage_summary(log_file=USAGE_LOG_FILE):
+    """Return per-(route, model) request counts, latency and cost from the usage log.
+
+    The log is only re-read when its size or modification time has changed.
+    """
+    try:
+        stat = os.stat(log_file)
+    except FileNotFoundError:
+        return []
+    return [dict(row) for row in _summarize_usage(log_file, stat.st_mtime_ns, stat.st_size)]
+
+@functools.lru_cache(maxsize=4)
+def _summarize_usage(log_file, mtime_ns, size):
+    groups = {}
+    with open(log_file, newline="") as f:
+        for row in csv.DictReader(f):
+            key = (row.get("route") or "", row.get("model") or "")
+            group = groups.setdefault(key, {"latencies": [], "cost": 0.0, "requests": 0})
+            group["requests"] += 1
+            group["cost"] += float(row.get("total_cost") or 0)
+            if row.get("latency_ms"):
+                group["latencies"].append(float(row["latency_ms"]))
+    summary = []
+    for (route, model), group in sorted(groups.items()):
+        latencies = sorted(group["latencies"])
+        summary.append({
+            "route": route or "(before routing)",
+            "model": model,
+            "requests": group["requests"],
+            "median_latency_ms": latencies[len(latencies) // 2] if latencies else None,
+            "total_cost": round(group["cost"], 4),
+            "cost_per_request": round(group["cost"] / group["requests"], 6),
+        })
+    return summary
+
+def build_messages(base64_image):
+    """Return the chat messages sent to every extraction backend."""
+    return [
+        {
+            "role": "system",
+            "content": SYSTEM_PROMPT
         },
         {
             "role": "user",
@@ -99,49 +240,142 @@ You are a data extraction assistant. Your task is to extract and classify data f
                 },
                 {
                     "type": "text",
-                    "text": "Extract all data from this receipt image using the rules above and output a valid JSON."
+                    "text": USER_PROMPT
                 }
             ]
         }
-    ],
-    max_tokens=1500,
-    temperature=0.2
-)
+    ]
 
+def build_batch_messages(base64_images):
+    """Return the chat messages for extracting several receipt images in one request."""
+    content = []
+    for number, base64_image in enumerate(base64_images, 1):
+        content.append({"type": "text", "text": f"Receipt {number}:"})
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}})
+    content.append({"type": "text", "text": BATCH_PROMPT.format(count=len(base64_images))})
+    return [
+        {
+            "role": "system",
+            "content": SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": content
+        }
+    ]
 
-    content = response.choices[0].message.content
-    usage = response.usage
-    input_tokens = usage.prompt_tokens
-    output_tokens = usage.completion_tokens
+def route_name(position, route_count):
+    """Label of the n-th extractor tried: "fast" then "strong", or "single" without routing."""
+    if route_count == 1:
+        return "single"
+    return "strong" if position == route_count - 1 else "fast"
 
-    # Cost Calculation for GPT-4 Vision
-    input_cost = (input_tokens / 1000) * 0.005
-    output_cost = (output_tokens / 1000) * 0.015
-    total_cost = input_cost + output_cost
+def call_model(extractor, route, messages, params, image_path, image_hash, image_stats=None, on_partial=None, throttle=None):
+    """Send one request to an extractor and log its usage, cost and latency; returns the response.
 
-    # Log usage
-    log_usage(image_path, input_tokens, output_tokens, total_cost, image_hash)
-    
-    try:
-        # Clean the content to ensure it's valid JSON
-        content = content.strip()
-        # Remove any markdown code block markers if present
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.startswith("```"):
-            content = content[3:]
-        if content.endswith("```"):
-            content = content[:-3]
-        content = content.strip()
-        
-        print("Raw response:", content)  # Debug print
-        
-        # Parse the content as JSON
-        json_data = json.loads(content)
-        return json_data
-    except json.JSONDecodeError as e:
-        print(f"Error parsing JSON response: {e}")
-        print("Raw response:", content)
+    throttle, when given, is called with the number of receipts in the request
+    before it is sent (bulk ingestion's rate limiter).
+    """
+    if throttle is not None:
+        throttle(1)
+    on_delta = StreamProgress(on_partial) if on_partial is not None else None
+    start = time.perf_counter()
+    with span("extract.model_call", backend=extractor.name, model=extractor.model, route=route, streamed=on_delta is not None):
+        response = extractor.complete(messages, params, image_hash=image_hash, on_delta=on_delta)
+    latency_ms = (time.perf_counter() - start) * 1000
+
+    input_tokens = response["input_tokens"]
+    output_tokens = response["output_tokens"]
+    total_cost = extractor.cost(input_tokens, output_tokens)
+    log_usage(image_path, input_tokens, output_tokens, total_cost, image_hash, image_stats,
+              model=extractor.model, route=route, latency_ms=latency_ms)
+    return response
+
+def process_receipt(image_path, image_hash, use_cache=True, extractor=None, on_partial=None, backend=None, skip_fast=False,
+                    throttle=None):
+    """Process receipt image with the configured extraction backend to extract and classify data.
+
+    Results are served from the extraction cache when the same image was already
+    extracted with the current models, prompt and parameters. When on_partial is
+    given the response is streamed and on_partial receives the store info and
+    items completed so far (see receipt_stream); the returned result is the same.
+    The last partial stays published while the request is escalated, until the
+    stronger model's first items replace it.
+
+    Without an explicit extractor the receipt is routed (extractors.get_routes):
+    the backend's fast model is tried first and the strong model only when the
+    fast result fails validation or receipt_schema.confidence_problems. A result
+    that still has confidence problems is returned with them listed under
+    "warnings" and is not cached, so the next attempt extracts it again.
+    skip_fast starts at the strong model, for a receipt the fast model has
+    already got wrong (see process_receipt_batch). throttle is passed to
+    call_model for every request made, including escalations and repairs.
+    """
+    routes = [extractor] if extractor is not None else extractors.get_routes(backend)
+    cache_key = extraction_cache.make_key(image_hash, ">".join(e.model for e in routes), PROMPT_VERSION, REQUEST_PARAMS)
+    if use_cache:
+        with span("extract.cache_lookup") as attrs:
+            cached = extraction_cache.get(cache_key)
+            attrs["hit"] = cached is not None
+        if cached is not None:
+            return cached
+
+    with span("extract.encode") as attrs:
+        img_bytes, image_stats = preprocess_image(image_path)
+        base64_image = base64.b64encode(img_bytes).decode("utf-8")
+        attrs["encoded_bytes"] = image_stats["encoded_bytes"]
+    messages = build_messages(base64_image)
+
+    json_data = doubtful = None
+    first = len(routes) - 1 if skip_fast else 0
+    for position in range(first, len(routes)):
+        extractor = routes[position]
+        route = route_name(position, len(routes))
+        last = position == len(routes) - 1
+        route_on_partial = mark_restarted(on_partial) if on_partial is not None and position > first else on_partial
+        response = call_model(extractor, route, messages, REQUEST_PARAMS, image_path, image_hash, image_stats, route_on_partial,
+                              throttle)
+        if config.EXTRACTOR_RECORD_DIR and extractor.name != "fake":
+            extractors.record_fixture(config.EXTRACTOR_RECORD_DIR, image_hash, response)
+        content = response["content"]
+        print(
+            f"Image {image_stats['original_size']} {image_stats['original_bytes']} B -> "
+            f"{image_stats['encoded_size']} {image_stats['encoded_bytes']} B (JPEG q={image_stats['jpeg_quality']}), "
+            f"{extractor.model} ({route}) prompt tokens: {response['input_tokens']}"
+        )
+
+        with span("extract.parse", route=route) as parse_attrs:
+            print("Raw response:", content)  # Debug print
+            try:
+                json_data, repairs = receipt_schema.parse_receipt(content)
+                parse_attrs["repairs"] = len(repairs)
+                problems = receipt_schema.confidence_problems(json_data, repairs)
+            except receipt_schema.ReceiptValidationError as e:
+                parse_attrs["valid_json"] = False
+                json_data, problems = None, e.problems
+                print(f"Could not repair extraction locally: {e}")
+            parse_attrs["escalated"] = bool(problems) and not last
+
+        if json_data is not None and (not problems or last):
+            result_model = extractor.model
+            break
+        if json_data is not None:
+            # Kept in case the stronger model's answer is unusable
+            doubtful = (json_data, repairs, problems, extractor.model)
+        if not last:
+            print(f"Escalating from {extractor.model}: {'; '.join(problems)}")
+
+    if json_data is None and doubtful is not None:
+        json_data, repairs, problems, result_model = doubtful
+    if json_data is None:
+        # Local repair failed; ask for a corrected JSON from the text alone, without the image
+        with span("extract.repair_call", backend=extractor.name, model=extractor.model) as repair_attrs:
+            json_data, repairs = repair_with_model(extractor, content, problems, image_path, image_hash, throttle)
+            repair_attrs["repaired"] = json_data is not None
+        if json_data is not None:
+            problems = receipt_schema.confidence_problems(json_data, repairs)
+        result_model = extractor.model
+    if json_data is None:
         # Return a default structure with error information
         return {
             "error": "Failed to parse receipt data",
@@ -150,14 +384,176 @@ You are a data extraction assistant. Your task is to extract and classify data f
             "transaction_details": {"total": 0, "tax": 0, "subtotal": 0, "payment_method": "", "change": 0},
             "items": []
         }
+    if repairs:
+        print("Repaired extraction:", "; ".join(repairs))
+    if problems:
+        # Every model's answer looks misread: show it for review, but never pin it in the cache
+        print(f"Extraction by {result_model} needs review: {'; '.join(problems)}")
+        json_data["warnings"] = problems
+    elif use_cache:
+        extraction_cache.put(cache_key, image_hash, result_model, PROMPT_VERSION, json_data)
+    return json_data
 
-def main():
-    """Main function to process receipt image from command line argument."""
-    if len(sys.argv) != 2:
-        print("Usage: python process_receipt.py <image_path>")
+def process_receipt_batch(images, use_cache=True, extractor=None, backend=None, throttle=None):
+    """Extract several receipts, sending the uncached ones in a single request.
+
+    images is [(image_path, image_hash)]; results come back in the same order.
+    The batch goes to the first routed model. Receipts missing from its answer
+    or failing validation fall back to process_receipt on their own, as does
+    the whole batch if the response is not an array of one receipt per image.
+    Receipts it answered doubtfully (when a stronger model is routed) go
+    straight to the strong model instead of asking the fast model again.
+    throttle is called before the batched request and every fallback request.
+    """
+    routes = [extractor] if extractor is not None else extractors.get_routes(backend)
+    route_key = ">".join(e.model for e in routes)
+    cache_keys = [extraction_cache.make_key(image_hash, route_key, PROMPT_VERSION, REQUEST_PARAMS) for _, image_hash in images]
+    results = [None] * len(images)
+    if use_cache:
+        with span("extract.cache_lookup", images=len(images)) as attrs:
+            for index, cache_key in enumerate(cache_keys):
+                results[index] = extraction_cache.get(cache_key)
+            attrs["hits"] = sum(result is not None for result in results)
+    todo = [index for index, result in enumerate(results) if result is None]
+    doubtful = set()
+
+    if len(todo) > 1:
+        batch_extractor = routes[0]
+        with span("extract.encode", images=len(todo)) as attrs:
+            encoded, image_stats = [], []
+            for index in todo:
+                img_bytes, stats = preprocess_image(images[index][0])
+                encoded.append(base64.b64encode(img_bytes).decode("utf-8"))
+                image_stats.append(stats)
+            attrs["encoded_bytes"] = sum(stats["encoded_bytes"] for stats in image_stats)
+        params = dict(REQUEST_PARAMS, max_tokens=min(REQUEST_PARAMS["max_tokens"] * len(todo), BATCH_MAX_TOKENS))
+        batch_hash = ",".join(images[index][1] for index in todo)
+        if throttle is not None:
+            throttle(len(todo))
+        start = time.perf_counter()
+        with span("extract.model_call", backend=batch_extractor.name, model=batch_extractor.model, route="batch", images=len(todo)):
+            response = batch_extractor.complete(build_batch_messages(encoded), params, image_hash=batch_hash)
+        latency_ms = (time.perf_counter() - start) * 1000
+
+        # One usage row per receipt, each carrying an equal share of the request
+        count = len(todo)
+        total_cost = batch_extractor.cost(response["input_tokens"], response["output_tokens"])
+        for index, stats in zip(todo, image_stats):
+            log_usage(images[index][0], round(response["input_tokens"] / count), round(response["output_tokens"] / count),
+                      total_cost / count, images[index][1], stats,
+                      model=batch_extractor.model, route="batch", latency_ms=latency_ms)
+        print(f"Batch of {count} receipts, {batch_extractor.model}: prompt tokens {response['input_tokens']}, "
+              f"completion tokens {response['output_tokens']}, {latency_ms:.0f} ms")
+
+        with span("extract.parse", route="batch", images=count) as parse_attrs:
+            try:
+                parsed = receipt_schema.parse_receipt_batch(response["content"], count)
+            except receipt_schema.ReceiptValidationError as e:
+                print(f"Batch response unusable, extracting one by one: {e}")
+                parsed = [None] * count
+            for index, entry in zip(todo, parsed):
+                if entry is None:
+                    continue
+                data, repairs = entry
+                problems = receipt_schema.confidence_problems(data, repairs)
+                if problems and len(routes) > 1:
+                    doubtful.add(index)
+                    continue
+                results[index] = data
+                if problems:
+                    # Same as process_receipt: returned for review, not cached
+                    data["warnings"] = problems
+                elif use_cache:
+                    extraction_cache.put(cache_keys[index], images[index][1], batch_extractor.model, PROMPT_VERSION, data)
+            parse_attrs["fallbacks"] = sum(results[index] is None for index in todo)
+
+    for index in todo:
+        if results[index] is None:
+            image_path, image_hash = images[index]
+            results[index] = process_receipt(image_path, image_hash, use_cache=use_cache, extractor=extractor, backend=backend,
+                                             skip_fast=index in doubtful, throttle=throttle)
+    return results
+
+def repair_with_model(extractor, content, problems, image_path, image_hash, throttle=None):
+    """Retry a response that could not be repaired locally as a text-only correction request.
+
+    Sending back the broken output without the image costs a fraction of a full
+    extraction. Returns (data, repairs), or (None, None) if the retry is unusable too.
+    """
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": REPAIR_PROMPT.format(problems="; ".join(problems), content=content)},
+    ]
+    try:
+        response = call_model(extractor, "repair", messages, REPAIR_PARAMS, image_path, image_hash, throttle=throttle)
+    except extractors.TransientExtractionError as e:
+        print(f"Repair request failed: {e}")
+        return None, None
+    try:
+        data, repairs = receipt_schema.parse_receipt(response["content"])
+    except receipt_schema.ReceiptValidationError as e:
+        print(f"Repair response is still invalid: {e}")
+        return None, None
+    if not data["items"]:
+        # Items missing from the broken output cannot be recovered without the image
+        print("Repair response has no items")
+        return None, None
+    return data, repairs
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Extract receipt data from one image, or ingest many with --batch.")
+    parser.add_argument("image_path", nargs="?", help="Single receipt image to process")
+    parser.add_argument("--backend", choices=sorted(extractors.BACKENDS), default=None, help="Extraction backend (default: EXTRACTOR_BACKEND or openai)")
+    parser.add_argument("--batch", metavar="SOURCE", help="Directory, glob pattern or manifest file of images to ingest")
+    parser.add_argument("--user", help="Email of the user that batch-ingested receipts are saved for")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum extractions in flight (default: 4)")
+    parser.add_argument("--rpm", type=int, default=60, help="Requests-per-minute limit (default: 60)")
+    parser.add_argument("--tpm", type=int, default=None, help="Tokens-per-minute limit (default: unlimited)")
+    parser.add_argument("--tokens-per-receipt", type=int, default=2000, help="Token estimate per receipt for --tpm (default: 2000)")
+    parser.add_argument("--batch-size", type=int, default=1, help="Receipts extracted per API request (default: 1)")
+    parser.add_argument("--retries", type=int, default=5, help="Retries for transient API errors (default: 5)")
+    parser.add_argument("--checkpoint", default="data/ingest_checkpoint.jsonl", help="Checkpoint file used to resume an interrupted batch")
+    parser.add_argument("--allow-duplicates", action="store_true", help="Ingest images the user already has receipts for, exact or near-duplicate")
+    args = parser.parse_args(argv)
+    if bool(args.image_path) == bool(args.batch):
+        parser.error("give either an image path or --batch SOURCE")
+    if args.batch and not args.user:
+        parser.error("--batch requires --user")
+    return args
+
+def run_batch_from_args(args):
+    """Run a bulk ingestion from parsed command line arguments."""
+    from bulk_ingest import run_batch
+
+    summary = run_batch(
+        args.batch,
+        args.user,
+        concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        tokens_per_receipt=args.tokens_per_receipt,
+        checkpoint_path=args.checkpoint,
+        max_retries=args.retries,
+        skip_duplicates=not args.allow_duplicates,
+        backend=args.backend,
+        batch_size=args.batch_size
+    )
+    print(f"Batch complete: {summary['saved']} saved, {summary['skipped']} skipped, {summary['failed']} failed")
+    print("Extraction cache:", extraction_cache.stats())
+    if summary["failed"]:
         sys.exit(1)
 
-    image_path = sys.argv[1]
+def main():
+    """Main function to process receipt image(s) from command line arguments."""
+    args = parse_args(sys.argv[1:])
+    if args.batch:
+        run_batch_from_args(args)
+        return
+
+    from models import init_db
+
+    init_db()
+    image_path = args.image_path
     if not os.path.exists(image_path):
         print(f"Error: Image file not found at {image_path}")
         sys.exit(1)
@@ -166,9 +562,10 @@ def main():
         # For command line testing, we'll calculate hash here as well.
         # In the Streamlit app, hash is passed from app.py
         temp_hash = hashlib.sha256(open(image_path, 'rb').read()).hexdigest()
-        result = process_receipt(image_path, temp_hash)
+        result = process_receipt(image_path, temp_hash, backend=args.backend)
         print("Type of result:", type(result))
         print("Result:", json.dumps(result, indent=2))
+        print("Extraction cache:", extraction_cache.stats())
         
         # Save the processed data
         with open("processed_receipt.json", "w", encoding="utf-8") as f:
@@ -0,0 +1,63 @@
+"""Spending aggregates computed in the database.
+
+The Analytics and Budgets pages use these instead of loading every receipt and
+decoding its items in Python.
+"""
+from sqlalchemy import func
+
+from models import User, Receipt, ReceiptItem, MonthlyCategorySpend
+
+CATEGORIES = ["Food", "Electronics", "Services", "Personal Care", "Household", "Other"]
+
+
+def _user_items(session, user_id, *columns):
+    return session.query(*columns).select_from(ReceiptItem).join(Receipt).filter(Receipt.user_id == user_id)
+
+
+def spending_by_day(session, user_id):
+    """Return [(day, amount)] item spending per calendar day, oldest first."""
+    day = func.date(Receipt.date)
+    rows = _user_items(session, user_id, day, func.sum(ReceiptItem.subtotal)).group_by(day).order_by(day).all()
+    # SQLite returns days as 'YYYY-MM-DD' strings, other databases as dates
+    return [(str(d)[:10], amount) for d, amount in rows]
+
+
+def spending_by_category(session, user_id, start=None, end=None):
+    """Return {category: amount} for receipts dated in [start, end)."""
+    query = _user_items(session, user_id, ReceiptItem.category, func.sum(ReceiptItem.subtotal))
+    if start is not None:
+        query = query.filter(Receipt.date >= start)
+    if end is not None:
+        query = query.filter(Receipt.date < end)
+    return dict(query.group_by(ReceiptItem.category).all())
+
+
+def spending_by_vendor(session, user_id, limit=10):
+    """Return [(vendor, amount)] for the top vendors by item spending."""
+    total = func.sum(ReceiptItem.subtotal)
+    return _user_items(session, user_id, Receipt.vendor, total).group_by(Receipt.vendor).order_by(total.desc()).limit(limit).all()
+
+
+def receipt_months(session, user_id):
+    """Return the sorted 'YYYY-MM' months the user has spending in."""
+    months = session.query(MonthlyCategorySpend.month).filter(
+        MonthlyCategorySpend.user_id == user_id
+    ).distinct().order_by(MonthlyCategorySpend.month)
+    return [month for (month,) in months]
+
+
+def monthly_spend_by_category(session, user_id, month):
+    """Return {category: amount} for a 'YYYY-MM' month from the maintained aggregate."""
+    rows = session.query(MonthlyCategorySpend.category, MonthlyCategorySpend.total).filter_by(
+        user_id=user_id, month=month
+    )
+    return dict(rows.all())
+
+
+def has_receipt_with_hash(session, user_email, image_hash):
+    """Return True if the user already saved a receipt for this image (indexed lookup)."""
+    existing = session.query(Receipt.id).join(User).filter(
+        User.email == user_email,
+        Receipt.image_hash == image_hash
+    ).first()
+    return existing is not None
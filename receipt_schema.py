@@ -0,0 +1,327 @@
+"""Validation and local repair of extraction output.
+
+The model is asked for the JSON structure in process_receipt.SYSTEM_PROMPT,
+but responses regularly come back with defects that would otherwise mean a
+failed upload or a crash further down:
+
+- text around the JSON object (markdown fences, "Here is the data:")
+- truncation at max_tokens, leaving brackets open
+- prices as strings ("$1,299.00"), missing quantities
+- item subtotals that are not price × quantity
+- categories outside the six known ones ("Groceries", "Health & Beauty")
+
+`parse_receipt` fixes these locally and returns the repaired result with a
+list of what was changed. Only output it cannot repair raises
+ReceiptValidationError (including a response truncated before its first
+complete item), so the caller can fall back to a retry.
+`confidence_problems` flags valid results that still look misread, which the
+model router uses to escalate to a stronger model.
+"""
+import json
+import re
+
+from queries import CATEGORIES
+
+STORE_FIELDS = ("name", "address", "phone", "date")
+AMOUNT_FIELDS = ("subtotal", "tax", "total", "change")
+
+# Lower-cased category labels the model uses instead of the known ones
+CATEGORY_SYNONYMS = {
+    "grocery": "Food", "groceries": "Food", "food and beverage": "Food", "food and beverages": "Food",
+    "food and drink": "Food", "beverage": "Food", "beverages": "Food", "drink": "Food", "drinks": "Food",
+    "produce": "Food", "dairy": "Food", "bakery": "Food", "meat": "Food", "snacks": "Food",
+    "restaurant": "Food", "dining": "Food",
+    "electronic": "Electronics", "tech": "Electronics", "technology": "Electronics",
+    "computers": "Electronics", "computer accessories": "Electronics",
+    "service": "Services", "fee": "Services", "fees": "Services", "labor": "Services",
+    "subscription": "Services", "delivery": "Services",
+    "health": "Personal Care", "beauty": "Personal Care", "health and beauty": "Personal Care",
+    "pharmacy": "Personal Care", "medicine": "Personal Care", "toiletries": "Personal Care",
+    "cosmetics": "Personal Care", "hygiene": "Personal Care", "personal hygiene": "Personal Care",
+    "home": "Household", "household items": "Household", "household goods": "Household",
+    "home goods": "Household", "cleaning": "Household", "cleaning supplies": "Household",
+    "kitchen": "Household", "hardware": "Household",
+}
+_CANONICAL = {cat.lower(): cat for cat in CATEGORIES}
+
+# Item subtotals within this of price × quantity are rounding, not defects
+SUBTOTAL_TOLERANCE = 0.01
+# Items adding up to more than this fraction away from the receipt subtotal suggest misread or missing lines
+ITEMS_TOTAL_TOLERANCE = 0.02
+TRUNCATED = "closed truncated JSON"
+
+_decoder = json.JSONDecoder()
+
+
+class ReceiptValidationError(ValueError):
+    """Extraction output that could not be repaired locally."""
+
+    def __init__(self, problems):
+        super().__init__("; ".join(problems))
+        self.problems = problems
+
+
+def canonical_category(label):
+    """Map a category label to one of CATEGORIES; unknown labels become "Other"."""
+    key = re.sub(r"[\s_-]+", " ", str(label or "").replace("&", " and ")).strip().lower()
+    return _CANONICAL.get(key) or CATEGORY_SYNONYMS.get(key) or "Other"
+
+
+def _to_number(value):
+    """Return value as a float, accepting strings like "$1,299.00"; None if it is not a number."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        cleaned = re.sub(r"[^\d.\-]", "", value)
+        try:
+            return float(cleaned)
+        except ValueError:
+            return None
+    return None
+
+
+def _close_truncated(text):
+    """Parse JSON cut off mid-document: drop the unfinished value and close the open brackets.
+
+    Returns the parsed value, or None when the text is not a truncated document.
+    """
+    closers = []
+    in_string = escape = False
+    cuts = []  # (position, closing brackets) where everything before is complete
+    for i, ch in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if not closers:
+                return None
+            closers.pop()
+            cuts.append((i + 1, "".join(reversed(closers))))
+        elif ch == ",":
+            # Never cut inside an array element such as an item: drop the unfinished item whole
+            if not (closers[-1:] == ["}"] and "]" in closers[:-1]):
+                cuts.append((i, "".join(reversed(closers))))
+    if not closers:
+        # Brackets balance, so the document is malformed rather than truncated
+        return None
+    for position, closing in reversed(cuts):
+        try:
+            return json.loads(text[:position] + closing)
+        except ValueError:
+            continue
+    return None
+
+
+def _normalize_item(index, item, repairs, problems):
+    if not isinstance(item, dict):
+        problems.append(f"item {index + 1} is not an object")
+        return
+    if not str(item.get("name") or "").strip():
+        item["name"] = "Unnamed item"
+        repairs.append(f"item {index + 1}: added missing name")
+
+    price = _to_number(item.get("price"))
+    quantity = _to_number(item.get("quantity"))
+    subtotal = _to_number(item.get("subtotal"))
+    if quantity is None or quantity <= 0:
+        # The prompt's rule: quantity defaults to 1
+        quantity = 1.0
+        repairs.append(f"item {index + 1}: quantity set to 1")
+    if price is None and subtotal is None:
+        problems.append(f"item {index + 1} ({item['name']}) has no price or subtotal")
+        return
+    if price is None:
+        price = round(subtotal / quantity, 2)
+        repairs.append(f"item {index + 1}: price derived from subtotal")
+    elif subtotal is None:
+        subtotal = round(price * quantity, 2)
+        repairs.append(f"item {index + 1}: subtotal derived from price")
+    elif abs(subtotal - price * quantity) > SUBTOTAL_TOLERANCE:
+        if quantity != 1 and abs(price - subtotal) <= SUBTOTAL_TOLERANCE:
+            # The line total was read as the unit price
+            price = round(subtotal / quantity, 2)
+            repairs.append(f"item {index + 1}: unit price derived from line total")
+        else:
+            subtotal = round(price * quantity, 2)
+            repairs.append(f"item {index + 1}: subtotal set to price × quantity")
+    item["price"] = price
+    item["quantity"] = int(quantity) if quantity.is_integer() else quantity
+    item["subtotal"] = subtotal
+
+    category = canonical_category(item.get("category"))
+    if category != item.get("category"):
+        repairs.append(f"item {index + 1}: category {item.get('category')!r} -> {category!r}")
+        item["category"] = category
+
+
+def normalize_receipt(data):
+    """Check a parsed extraction against the schema and repair it in place.
+
+    Returns (data, repairs); raises ReceiptValidationError for defects that need the model.
+    """
+    if not isinstance(data, dict):
+        raise ReceiptValidationError(["response is not a JSON object"])
+    repairs, problems = [], []
+
+    store = data.get("store_info")
+    if not isinstance(store, dict):
+        store = data["store_info"] = {}
+        repairs.append("added missing store_info")
+    for field in STORE_FIELDS:
+        if store.get(field) is None:
+            store[field] = ""
+        elif not isinstance(store[field], str):
+            store[field] = str(store[field])
+
+    items = data.get("items")
+    if items is None:
+        items = data["items"] = []
+        repairs.append("added missing items list")
+    if not isinstance(items, list):
+        raise ReceiptValidationError(["items is not a list"])
+    for index, item in enumerate(items):
+        _normalize_item(index, item, repairs, problems)
+
+    txn = data.get("transaction_details")
+    if not isinstance(txn, dict):
+        txn = data["transaction_details"] = {}
+        repairs.append("added missing transaction_details")
+    for field in AMOUNT_FIELDS:
+        value = _to_number(txn.get(field))
+        if value is None and txn.get(field) not in (None, ""):
+            repairs.append(f"transaction {field} {txn.get(field)!r} was not a number")
+        txn[field] = value
+    if txn["subtotal"] is None:
+        txn["subtotal"] = round(sum(item.get("subtotal") or 0.0 for item in items if isinstance(item, dict)), 2)
+        repairs.append("transaction subtotal derived from items")
+    if txn["tax"] is None:
+        txn["tax"] = 0.0
+    if txn["total"] is None:
+        txn["total"] = round(txn["subtotal"] + txn["tax"], 2)
+        repairs.append("transaction total derived from subtotal and tax")
+    if txn["change"] is None:
+        txn["change"] = 0.0
+    txn["payment_method"] = "" if txn.get("payment_method") is None else str(txn["payment_method"])
+
+    if problems:
+        raise ReceiptValidationError(problems)
+    return data, repairs
+
+
+def usable_items(items):
+    """Repair items in place as normalize_receipt does; returns those that could be repaired."""
+    usable = []
+    for index, item in enumerate(items):
+        problems = []
+        _normalize_item(index, item, [], problems)
+        if not problems:
+            usable.append(item)
+    return usable
+
+
+def _strip_fences(content):
+    # Markdown code fences are expected noise, not a repair
+    text = re.sub(r"^```(?:json)?", "", content.strip()).strip()
+    return re.sub(r"```$", "", text).strip()
+
+
+def parse_receipt(content):
+    """Parse, validate and repair a raw model response.
+
+    Returns (data, repairs); raises ReceiptValidationError when it cannot be repaired locally.
+    """
+    text = _strip_fences(content)
+    repairs = []
+    start = text.find("{")
+    if start < 0:
+        raise ReceiptValidationError(["no JSON object in response"])
+    if start > 0:
+        repairs.append("ignored text before the JSON object")
+    try:
+        data, end = _decoder.raw_decode(text, start)
+        if text[end:].strip():
+            repairs.append("ignored text after the JSON object")
+    except ValueError as e:
+        data = _close_truncated(text[start:])
+        if data is None:
+            raise ReceiptValidationError([f"invalid JSON: {e}"]) from e
+        repairs.append(TRUNCATED)
+
+    data, schema_repairs = normalize_receipt(data)
+    if TRUNCATED in repairs and not data["items"]:
+        # Cut off before the first item closed: closing the brackets leaves an empty receipt
+        raise ReceiptValidationError(["response was truncated before any complete item"])
+    return data, repairs + schema_repairs
+
+
+def _complete_elements(text, index):
+    """Decode the array elements from index on, stopping at the first unfinished one."""
+    elements = []
+    while True:
+        while index < len(text) and text[index] in " \t\r\n,":
+            index += 1
+        try:
+            element, index = _decoder.raw_decode(text, index)
+        except ValueError:
+            # An unfinished receipt is dropped whole rather than closed like a single response
+            return elements
+        elements.append(element)
+
+
+def parse_receipt_batch(content, count):
+    """Parse a batched response: a JSON array with one receipt per image, in order.
+
+    Returns a list of count entries, each (data, repairs) or None for a receipt that
+    needs its own request. A truncated array keeps its complete leading receipts.
+    Raises ReceiptValidationError when the array cannot be matched to the images.
+    """
+    text = _strip_fences(content)
+    start = min((i for i in (text.find("["), text.find("{")) if i >= 0), default=-1)
+    if start < 0 or text[start] != "[":
+        raise ReceiptValidationError(["response is not a JSON array"])
+    truncated = False
+    try:
+        receipts, _ = _decoder.raw_decode(text, start)
+    except ValueError as e:
+        receipts = _complete_elements(text, start + 1)
+        if not receipts:
+            raise ReceiptValidationError([f"invalid JSON array: {e}"]) from e
+        truncated = True
+    if len(receipts) > count or (len(receipts) < count and not truncated):
+        # Receipts can no longer be matched to images by position
+        raise ReceiptValidationError([f"expected {count} receipts, got {len(receipts)}"])
+
+    parsed = []
+    for receipt in receipts:
+        try:
+            parsed.append(normalize_receipt(receipt))
+        except ReceiptValidationError:
+            parsed.append(None)
+    return parsed + [None] * (count - len(parsed))
+
+
+def confidence_problems(data, repairs):
+    """Return reasons to doubt a repaired extraction (empty when it looks right)."""
+    problems = []
+    if TRUNCATED in repairs:
+        problems.append("response was truncated")
+    if not data["items"]:
+        problems.append("no items")
+    if not data["store_info"]["name"].strip():
+        problems.append("no store name")
+    items_total = round(sum(item["subtotal"] for item in data["items"]), 2)
+    subtotal = data["transaction_details"]["subtotal"]
+    if data["items"] and abs(items_total - subtotal) > max(0.05, ITEMS_TOTAL_TOLERANCE * abs(subtotal)):
+        problems.append(f"items add up to {items_total:.2f}, not the subtotal {subtotal:.2f}")
+    return problems
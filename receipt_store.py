@@ -0,0 +1,186 @@
+"""Persist extraction results as Receipt rows.
+
+Shared by the Streamlit Dashboard and the bulk ingestion CLI so both save
+receipts the same way.
+"""
+import json
+from collections import defaultdict
+from datetime import datetime
+
+from dateutil import parser as date_parser
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from models import User, Receipt, ReceiptItem, MonthlyCategorySpend
+from perceptual_hash import index_receipt
+from tracing import span
+
+
+def parse_receipt_date(date_value):
+    """Parse the extracted receipt date.
+
+    Returns a (datetime, warning) tuple; warning is None when the date was usable.
+    """
+    try:
+        # Try to parse the date from store info
+        receipt_date = date_parser.parse(date_value)
+        # Ensure the date has no timezone info (convert to system timezone if it does)
+        if receipt_date.tzinfo is not None:
+            receipt_date = receipt_date.astimezone().replace(tzinfo=None)
+    except (ValueError, TypeError, OverflowError):
+        # If date parsing fails, use current date
+        return datetime.now(), "Could not parse receipt date. Using current date instead."
+
+    # Ensure the date is not in the future
+    if receipt_date > datetime.now():
+        return datetime.now(), "Receipt date was in the future. Using current date instead."
+    return receipt_date, None
+
+
+def _to_float(value, default=None):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def build_receipt_items(items):
+    """Turn extracted item dicts into ReceiptItem rows."""
+    return [
+        ReceiptItem(
+            name=item.get('name'),
+            price=_to_float(item.get('price')),
+            quantity=_to_float(item.get('quantity')),
+            category=item.get('category') or 'Other',
+            subtotal=_to_float(item.get('subtotal'), 0.0)
+        )
+        for item in items
+    ]
+
+
+def _upsert_insert(session):
+    """Return the dialect's insert() supporting ON CONFLICT DO UPDATE, or None."""
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    return insert
+
+
+def add_to_monthly_spend(session, user_id, month, line_items):
+    """Add line items to the monthly_category_spend aggregate in the session's transaction."""
+    totals = defaultdict(lambda: [0.0, 0])
+    for line_item in line_items:
+        totals[line_item.category][0] += line_item.subtotal
+        totals[line_item.category][1] += 1
+    if not totals:
+        return
+    rows = [
+        {"user_id": user_id, "month": month, "category": category, "total": total, "item_count": count}
+        for category, (total, count) in totals.items()
+    ]
+    table = MonthlyCategorySpend.__table__
+    insert = _upsert_insert(session)
+    if insert is not None:
+        # One atomic upsert, incrementing in SQL: concurrent writers never overwrite each
+        # other's totals, and the first receipt of a month cannot race another's INSERT
+        statement = insert(table).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.user_id, table.c.month, table.c.category],
+            set_={
+                "total": table.c.total + statement.excluded.total,
+                "item_count": table.c.item_count + statement.excluded.item_count,
+            },
+        )
+        session.execute(statement)
+        return
+    for row in rows:
+        while True:
+            updated = session.query(MonthlyCategorySpend).filter_by(
+                user_id=user_id, month=month, category=row["category"]
+            ).update({
+                MonthlyCategorySpend.total: MonthlyCategorySpend.total + row["total"],
+                MonthlyCategorySpend.item_count: MonthlyCategorySpend.item_count + row["item_count"]
+            }, synchronize_session=False)
+            if updated:
+                break
+            try:
+                # Another writer may insert the same row first; the savepoint keeps our transaction usable
+                with session.begin_nested():
+                    session.execute(table.insert().values(row))
+                break
+            except IntegrityError:
+                continue
+
+
+def rebuild_monthly_spend(session, user_id=None):
+    """Recompute monthly_category_spend from receipt_items, for one user or everyone.
+
+    Returns the number of aggregate rows written; the caller commits.
+    """
+    delete = session.query(MonthlyCategorySpend)
+    if user_id is not None:
+        delete = delete.filter(MonthlyCategorySpend.user_id == user_id)
+    delete.delete(synchronize_session=False)
+
+    # Group per day in SQL (portable across databases) and roll days up into months here
+    day = func.date(Receipt.date)
+    query = session.query(
+        Receipt.user_id, day, ReceiptItem.category, func.sum(ReceiptItem.subtotal), func.count(ReceiptItem.id)
+    ).select_from(ReceiptItem).join(Receipt)
+    if user_id is not None:
+        query = query.filter(Receipt.user_id == user_id)
+    totals = defaultdict(lambda: [0.0, 0])
+    for row_user_id, row_day, category, total, count in query.group_by(Receipt.user_id, day, ReceiptItem.category):
+        key = (row_user_id, str(row_day)[:7], category)
+        totals[key][0] += total or 0.0
+        totals[key][1] += count
+
+    session.add_all(
+        MonthlyCategorySpend(user_id=u, month=m, category=c, total=total, item_count=count)
+        for (u, m, c), (total, count) in totals.items()
+    )
+    session.flush()
+    return len(totals)
+
+
+def bump_data_version(session, user_id):
+    """Mark the user's receipt data as changed so cached computations are rebuilt."""
+    session.query(User).filter_by(id=user_id).update(
+        {User.data_version: User.data_version + 1}, synchronize_session=False
+    )
+
+
+def save_receipt(session, user, result, image_hash, perceptual_hash=None):
+    """Add a Receipt for an extraction result to the session; the caller commits.
+
+    perceptual_hash, when given, is indexed for near-duplicate detection.
+
+    Returns a (receipt, warnings) tuple.
+    """
+    # Confidence problems the extraction was returned with (see process_receipt)
+    warnings = list(result.get('warnings', []))
+    with span("save.parse_date"):
+        receipt_date, warning = parse_receipt_date(result['store_info'].get('date'))
+    if warning:
+        warnings.append(warning)
+
+    receipt = Receipt(
+        user_id=user.id,
+        date=receipt_date,
+        vendor=result['store_info']['name'],
+        total=result['transaction_details']['total'],
+        items=json.dumps(result['items']),
+        categories=json.dumps([item['category'] for item in result['items']]),
+        image_hash=image_hash,
+        line_items=build_receipt_items(result['items'])
+    )
+    if perceptual_hash:
+        index_receipt(session, receipt, perceptual_hash)
+    session.add(receipt)
+    add_to_monthly_spend(session, user.id, receipt_date.strftime('%Y-%m'), receipt.line_items)
+    bump_data_version(session, user.id)
+    return receipt, warnings
@@ -0,0 +1,96 @@
+"""Incremental parsing of a streamed extraction response.
+
+While the model streams its JSON, `parse_partial_receipt` pulls out whatever is
+already complete: the store_info object once it closes, and every item object
+in the items array that has closed so far. Closed items are normalized like the
+final result (see receipt_schema.usable_items) and skipped if they cannot be,
+so the Dashboard can render them as they are. Nothing is guessed from
+unfinished text, so each partial result only ever grows and the final result is
+still parsed from the full response exactly as without streaming. When the
+model router escalates, the stronger model's partials start over and are
+marked with "restarted".
+"""
+import json
+import re
+import time
+
+import config
+from receipt_schema import usable_items
+from tracing import record
+
+_decoder = json.JSONDecoder()
+_STORE_INFO = re.compile(r'"store_info"\s*:\s*(?=\{)')
+_ITEMS = re.compile(r'"items"\s*:\s*\[')
+
+
+def _decode_at(text, index):
+    """Decode the JSON value starting at index; returns (value, end) or (None, index) if it is unfinished."""
+    try:
+        return _decoder.raw_decode(text, index)
+    except ValueError:
+        return None, index
+
+
+def parse_partial_receipt(text):
+    """Return {"store_info": dict or None, "items": [complete items]} from a partial response."""
+    partial = {"store_info": None, "items": []}
+    match = _STORE_INFO.search(text)
+    if match:
+        store_info, _ = _decode_at(text, match.end())
+        if isinstance(store_info, dict):
+            partial["store_info"] = store_info
+
+    match = _ITEMS.search(text)
+    if match:
+        index = match.end()
+        while True:
+            # Skip the separator before the next element
+            while index < len(text) and text[index] in " \t\r\n,":
+                index += 1
+            if index >= len(text) or text[index] != "{":
+                break
+            item, index = _decode_at(text, index)
+            if not isinstance(item, dict):
+                break
+            partial["items"].append(item)
+    partial["items"] = usable_items(partial["items"])
+    return partial
+
+
+def mark_restarted(on_partial):
+    """Wrap on_partial for a re-extraction, whose items start over from the first one."""
+    return lambda partial: on_partial(dict(partial, restarted=True))
+
+
+class StreamProgress:
+    """on_delta callback that reports the growing partial receipt to on_partial.
+
+    on_partial is called at most every config.STREAM_PROGRESS_INTERVAL_SECONDS,
+    and only when more of the receipt has become complete.
+    """
+
+    def __init__(self, on_partial, interval=None):
+        self.on_partial = on_partial
+        self.interval = config.STREAM_PROGRESS_INTERVAL_SECONDS if interval is None else interval
+        self.started = time.perf_counter()
+        self._chunks = []
+        self._last_emit = 0.0
+        self._last_size = (False, 0)
+
+    def __call__(self, delta):
+        self._chunks.append(delta)
+        now = time.perf_counter()
+        if now - self._last_emit >= self.interval:
+            self._last_emit = now
+            self._emit()
+
+    def _emit(self):
+        partial = parse_partial_receipt("".join(self._chunks))
+        size = (partial["store_info"] is not None, len(partial["items"]))
+        if size == self._last_size:
+            return
+        if not self._last_size[0] and not self._last_size[1]:
+            # Time to first content: when the user first has something to look at
+            record("extract.first_content", (time.perf_counter() - self.started) * 1000)
+        self._last_size = size
+        self.on_partial(partial)
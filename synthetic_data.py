@@ -0,0 +1,182 @@
+"""Populate the database with synthetic users, receipts and items.
+
+Used by benchmark.py to measure how pages scale with data size:
+
+    python synthetic_data.py --users 10 --receipts 2000 --items 8 --months 24
+
+Vendors are drawn with a long-tailed popularity distribution and each vendor
+type has its own category mix and price levels, so per-category and per-vendor
+aggregates look like real spending. Synthetic users have emails ending in
+SYNTHETIC_EMAIL_DOMAIN; --reset removes only those users and their data.
+"""
+import argparse
+import hashlib
+import json
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from migrations import run_migrations
+from models import Session, User, Receipt, ReceiptItem, ReceiptHashBand, MonthlyCategorySpend, Budget, ExtractionJob
+from receipt_store import rebuild_monthly_spend, bump_data_version
+
+SYNTHETIC_EMAIL_DOMAIN = "synthetic.receiptgenie.test"
+SYNTHETIC_PASSWORD = "benchmark"
+
+# (vendor type, {category: weight}) mixes
+VENDOR_TYPES = {
+    "grocery": {"Food": 75, "Household": 15, "Personal Care": 8, "Other": 2},
+    "electronics": {"Electronics": 85, "Services": 10, "Household": 5},
+    "pharmacy": {"Personal Care": 70, "Food": 15, "Household": 10, "Other": 5},
+    "restaurant": {"Food": 95, "Services": 5},
+    "home": {"Household": 80, "Electronics": 10, "Other": 10},
+    "services": {"Services": 90, "Other": 10},
+}
+
+VENDORS = [
+    ("FreshMart", "grocery"), ("Green Valley Market", "grocery"), ("SaveMore Foods", "grocery"),
+    ("Corner Bodega", "grocery"), ("TechHub", "electronics"), ("Circuit City Outlet", "electronics"),
+    ("CornerCare Pharmacy", "pharmacy"), ("HealthPlus Drugs", "pharmacy"), ("Luigi's Trattoria", "restaurant"),
+    ("Sunrise Diner", "restaurant"), ("Noodle Bar", "restaurant"), ("Bean There Cafe", "restaurant"),
+    ("HomeGoods Depot", "home"), ("Hardware Hank", "home"), ("QuickClean Laundry", "services"),
+    ("AutoFix Garage", "services"),
+]
+
+ITEM_NAMES = {
+    "Food": ["Bananas", "Whole Milk", "Sourdough Bread", "Eggs 12ct", "Chicken Breast", "Cheddar", "Coffee Beans",
+             "Pasta", "Tomatoes", "Orange Juice", "Burger Meal", "Latte", "Salad Bowl", "Pizza Slice"],
+    "Electronics": ["USB-C Cable", "Wireless Mouse", "HDMI Cable", "Earbuds", "Phone Charger", "SD Card 64GB"],
+    "Services": ["Extended Warranty", "Delivery Fee", "Oil Change", "Wash & Fold", "Service Charge"],
+    "Personal Care": ["Toothpaste", "Shampoo", "Vitamin D", "Sunscreen", "Razor Blades", "Hand Soap"],
+    "Household": ["Paper Towels", "Dish Soap", "Light Bulbs", "Trash Bags", "Batteries AA", "Sponges"],
+    "Other": ["Gift Card", "Greeting Card", "Magazine", "Bag Fee"],
+}
+
+# Median unit price per category; prices are drawn log-normally around it
+MEDIAN_PRICE = {"Food": 4.0, "Electronics": 30.0, "Services": 25.0, "Personal Care": 8.0, "Household": 6.0, "Other": 5.0}
+
+
+def _vendor_weights():
+    # Zipf-like popularity: a few vendors get most of the receipts
+    return [1 / (rank + 1) for rank in range(len(VENDORS))]
+
+
+def make_receipt_items(rng, vendor_type, mean_items):
+    """Return extracted-style item dicts for one synthetic receipt."""
+    mix = VENDOR_TYPES[vendor_type]
+    count = max(1, int(rng.gauss(mean_items, mean_items / 3)))
+    items = []
+    for category in rng.choices(list(mix), weights=list(mix.values()), k=count):
+        price = round(rng.lognormvariate(0, 0.6) * MEDIAN_PRICE[category], 2)
+        quantity = rng.choices([1, 2, 3, 4], weights=[80, 12, 5, 3])[0]
+        items.append({
+            "name": rng.choice(ITEM_NAMES[category]),
+            "price": price,
+            "quantity": quantity,
+            "category": category,
+            "subtotal": round(price * quantity, 2),
+        })
+    return items
+
+
+def reset_synthetic_data(session):
+    """Delete synthetic users and everything they own; the caller commits."""
+    user_ids = [uid for (uid,) in session.query(User.id).filter(User.email.like(f"%@{SYNTHETIC_EMAIL_DOMAIN}"))]
+    if not user_ids:
+        return 0
+    receipt_ids = session.query(Receipt.id).filter(Receipt.user_id.in_(user_ids))
+    for model in (ReceiptItem, ReceiptHashBand):
+        session.query(model).filter(model.receipt_id.in_(receipt_ids)).delete(synchronize_session=False)
+    for model in (ExtractionJob, Receipt, MonthlyCategorySpend, Budget):
+        session.query(model).filter(model.user_id.in_(user_ids)).delete(synchronize_session=False)
+    session.query(User).filter(User.id.in_(user_ids)).delete(synchronize_session=False)
+    return len(user_ids)
+
+
+def generate(users=5, receipts_per_user=500, items_per_receipt=6, months=12, seed=42, chunk_size=1000):
+    """Create synthetic users with receipts spread over the last `months` months.
+
+    Returns the list of created user emails.
+    """
+    rng = random.Random(seed)
+    vendor_weights = _vendor_weights()
+    now = datetime.now()
+    span_seconds = int(timedelta(days=30 * months).total_seconds())
+    emails = []
+
+    session = Session()
+    try:
+        # Rows are inserted in bulk with explicit ids, far faster than one ORM flush per receipt
+        next_receipt_id = (session.query(func.max(Receipt.id)).scalar() or 0) + 1
+        next_item_id = (session.query(func.max(ReceiptItem.id)).scalar() or 0) + 1
+        for user_index in range(users):
+            email = f"user{user_index}-{seed}@{SYNTHETIC_EMAIL_DOMAIN}"
+            user = User(email=email)
+            user.set_password(SYNTHETIC_PASSWORD)
+            session.add(user)
+            session.flush()
+
+            receipt_rows, item_rows = [], []
+            for receipt_index in range(receipts_per_user):
+                vendor, vendor_type = rng.choices(VENDORS, weights=vendor_weights)[0]
+                items = make_receipt_items(rng, vendor_type, items_per_receipt)
+                receipt_rows.append({
+                    "id": next_receipt_id,
+                    "user_id": user.id,
+                    "date": now - timedelta(seconds=rng.randrange(span_seconds)),
+                    "vendor": vendor,
+                    "total": round(sum(item["subtotal"] for item in items), 2),
+                    "items": json.dumps(items),
+                    "categories": json.dumps([item["category"] for item in items]),
+                    "image_hash": hashlib.sha256(f"synthetic:{seed}:{email}:{receipt_index}".encode()).hexdigest(),
+                    "created_at": now,
+                })
+                for item in items:
+                    item_rows.append(dict(item, id=next_item_id, receipt_id=next_receipt_id))
+                    next_item_id += 1
+                next_receipt_id += 1
+
+                if len(receipt_rows) >= chunk_size:
+                    session.bulk_insert_mappings(Receipt, receipt_rows)
+                    session.bulk_insert_mappings(ReceiptItem, item_rows)
+                    receipt_rows, item_rows = [], []
+            if receipt_rows:
+                session.bulk_insert_mappings(Receipt, receipt_rows)
+                session.bulk_insert_mappings(ReceiptItem, item_rows)
+
+            rebuild_monthly_spend(session, user.id)
+            bump_data_version(session, user.id)
+            session.commit()
+            emails.append(email)
+            print(f"Generated {email}: {receipts_per_user} receipts")
+    finally:
+        session.close()
+    return emails
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Populate the database with synthetic receipt data.")
+    parser.add_argument("--users", type=int, default=5, help="Users to create (default: 5)")
+    parser.add_argument("--receipts", type=int, default=500, help="Receipts per user (default: 500)")
+    parser.add_argument("--items", type=int, default=6, help="Mean items per receipt (default: 6)")
+    parser.add_argument("--months", type=int, default=12, help="Months of history to spread receipts over (default: 12)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (default: 42)")
+    parser.add_argument("--reset", action="store_true", help="Delete existing synthetic users first")
+    args = parser.parse_args()
+
+    run_migrations()
+    if args.reset:
+        session = Session()
+        try:
+            removed = reset_synthetic_data(session)
+            session.commit()
+        finally:
+            session.close()
+        print(f"Removed {removed} synthetic users")
+    generate(args.users, args.receipts, args.items, args.months, args.seed)
+    print(f"Log in as any generated user with password '{SYNTHETIC_PASSWORD}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Near-duplicate detection must survive the copies users actually upload.
+
+Receipts are rendered with PIL (dense text on paper, photographed on a darker
+table) and compared with rescaled, re-encoded and border-cropped copies.
+"""
+import io
+import random
+from datetime import datetime
+
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+from sqlalchemy.orm import sessionmaker
+
+import config
+from models import Base, Receipt, User, make_engine
+from perceptual_hash import BAND_BITS, BAND_COUNT, find_near_duplicates, hamming_distance, index_receipt, phash
+
+WORDS = ("MILK BREAD EGGS APPLES CHEESE COFFEE RICE PASTA SOAP TOOTHPASTE "
+         "SHAMPOO BANANA YOGURT BUTTER JUICE CEREAL TUNA BEANS ONIONS TOMATO").split()
+
+
+def render_receipt(seed, lines=30, dense=False):
+    rng = random.Random(seed)
+    step = 22 if dense else 34
+    font = ImageFont.load_default(size=16 if dense else 20)
+    paper = Image.new("L", (600, 300 + lines * step), 250)
+    draw = ImageDraw.Draw(paper)
+    draw.text((150, 20), f"STORE #{rng.randint(100, 999)} {rng.choice(WORDS)} MART", font=ImageFont.load_default(size=26), fill=20)
+    draw.text((40, 70), f"{rng.randint(1, 999)} MAIN ST  TEL 555-{rng.randint(1000, 9999)}", font=font, fill=30)
+    y = 110
+    for _ in range(lines):
+        name = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3 if dense else 2)))
+        draw.text((40, y), name, font=font, fill=20)
+        draw.text((460, y), f"{rng.uniform(0.5, 40):7.2f}", font=font, fill=20)
+        y += step
+    draw.text((40, y + 20), f"TOTAL {rng.uniform(20, 400):8.2f}", font=ImageFont.load_default(size=24), fill=10)
+    photo = Image.new("L", (paper.width + 160, paper.height + 160), 90)
+    photo.paste(paper, (80, 80))
+    return photo.convert("RGB")
+
+
+def reencode(image, fmt, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **options)
+    buffer.seek(0)
+    return Image.open(buffer)
+
+
+def copies(image):
+    width, height = image.size
+    return {
+        "half size, PNG": reencode(image.resize((width // 2, height // 2), Image.BILINEAR), "PNG"),
+        "half size, JPEG q70": reencode(image.resize((width // 2, height // 2), Image.BILINEAR), "JPEG", quality=70),
+        "JPEG q60": reencode(image, "JPEG", quality=60),
+        "JPEG q30": reencode(image, "JPEG", quality=30),
+        "90% resize": image.resize((int(width * 0.9), int(height * 0.9)), Image.BICUBIC),
+        "border crop": image.crop((40, 40, width - 40, height - 40)),
+        "tight crop": image.crop((75, 75, width - 75, height - 75)),
+    }
+
+
+RECEIPTS = [render_receipt(seed, lines=45 if seed % 2 == 0 else 20, dense=seed % 2 == 0) for seed in range(6)]
+
+
+@pytest.fixture
+def session():
+    engine = make_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add(User(id=1, email="a@example.com", password_hash="x"))
+    session.flush()
+    yield session
+    session.close()
+
+
+def add_receipt(session, phash_value):
+    receipt = Receipt(user_id=1, date=datetime(2024, 5, 1), vendor="Shop", total=1.0, items="[]")
+    session.add(receipt)
+    session.flush()
+    index_receipt(session, receipt, phash_value)
+    session.flush()
+    return receipt
+
+
+@pytest.mark.parametrize("index", range(len(RECEIPTS)))
+def test_copies_stay_within_threshold(index):
+    original = phash(RECEIPTS[index])
+    for name, copy in copies(RECEIPTS[index]).items():
+        assert hamming_distance(original, phash(copy)) <= config.PHASH_MAX_DISTANCE, name
+
+
+def test_different_receipts_are_far_apart():
+    hashes = [phash(image) for image in RECEIPTS]
+    closest = min(hamming_distance(a, b) for i, a in enumerate(hashes) for b in hashes[i + 1:])
+    assert closest > 2 * config.PHASH_MAX_DISTANCE
+
+
+def test_blank_image_has_no_hash():
+    assert phash(Image.new("RGB", (400, 800), (250, 250, 250))) is None
+
+
+def test_copies_are_found_in_the_index(session):
+    receipts = [add_receipt(session, phash(image)) for image in RECEIPTS]
+    for image, receipt in zip(RECEIPTS, receipts):
+        for name, copy in copies(image).items():
+            matches = find_near_duplicates(session, 1, phash(copy))
+            assert matches and matches[0][0].id == receipt.id, name
+
+
+def test_hash_differing_in_every_band_but_one_is_found(session):
+    original = phash(RECEIPTS[0])
+    receipt = add_receipt(session, original)
+    # Flip one bit in each of the first BAND_COUNT - 1 bands; only the last band still matches
+    flipped = int(original, 16)
+    for band in range(BAND_COUNT - 1):
+        flipped ^= 1 << (BAND_BITS * (BAND_COUNT - 1 - band))
+    flipped = f"{flipped:0{len(original)}x}"
+    assert hamming_distance(original, flipped) == BAND_COUNT - 1
+    assert find_near_duplicates(session, 1, flipped, max_distance=BAND_COUNT - 1) == [(receipt, BAND_COUNT - 1)]
+
+
+def test_threshold_must_fit_the_band_index(session):
+    with pytest.raises(ValueError):
+        find_near_duplicates(session, 1, phash(RECEIPTS[0]), max_distance=BAND_COUNT)
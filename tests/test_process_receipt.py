@@ -0,0 +1,110 @@
+"""Model routing of batched extractions: which requests are sent to which model."""
+import json
+
+import pytest
+from PIL import Image
+
+import extractors
+import process_receipt
+from extractors import Extractor
+
+
+def make_receipt(store, subtotal=None):
+    items = [{"name": "Tea", "price": 2.5, "quantity": 1, "category": "Food", "subtotal": 2.5}]
+    return {
+        "store_info": {"name": store, "address": "", "phone": "", "date": "2024-05-01"},
+        "items": items,
+        "transaction_details": {"subtotal": 2.5 if subtotal is None else subtotal, "tax": 0, "total": 2.5,
+                                "payment_method": "Cash", "change": 0},
+    }
+
+
+class ScriptedExtractor(Extractor):
+    """Answers every request with the receipts scripted per image hash, and counts the requests."""
+
+    name = "scripted"
+
+    def __init__(self, model, receipts):
+        self.model = model
+        self.receipts = receipts
+        self.requests = []
+
+    def complete(self, messages, params, image_hash=None, on_delta=None):
+        hashes = image_hash.split(",")
+        self.requests.append(hashes)
+        answers = [self.receipts[image_hash] for image_hash in hashes]
+        return {"content": json.dumps(answers if len(hashes) > 1 else answers[0]), "input_tokens": 100, "output_tokens": 50}
+
+
+@pytest.fixture
+def images(tmp_path, monkeypatch):
+    monkeypatch.setattr(process_receipt, "USAGE_LOG_FILE", str(tmp_path / "usage.csv"))
+    paths = []
+    for name in ("a", "b", "c"):
+        path = tmp_path / f"{name}.png"
+        Image.new("RGB", (200, 400), "white").save(path)
+        paths.append((str(path), name))
+    return paths
+
+
+def test_doubtful_batch_members_go_straight_to_the_strong_model(images, monkeypatch):
+    # The fast model misreads receipt b: its items do not add up to the subtotal
+    fast = ScriptedExtractor("fast-model", {"a": make_receipt("A"), "b": make_receipt("B", subtotal=40.0), "c": make_receipt("C")})
+    strong = ScriptedExtractor("strong-model", {"b": make_receipt("B")})
+    monkeypatch.setattr(extractors, "get_routes", lambda name=None: [fast, strong])
+
+    results = process_receipt.process_receipt_batch(images, use_cache=False)
+
+    assert [result["store_info"]["name"] for result in results] == ["A", "B", "C"]
+    assert "warnings" not in results[1]
+    assert fast.requests == [["a", "b", "c"]]
+    assert strong.requests == [["b"]]
+
+
+class UnusableBatchExtractor(ScriptedExtractor):
+    """Answers batched requests with an empty array."""
+
+    def complete(self, messages, params, image_hash=None, on_delta=None):
+        response = super().complete(messages, params, image_hash, on_delta)
+        return dict(response, content="[]") if "," in image_hash else response
+
+
+def test_receipts_missing_from_the_batch_start_at_the_fast_model(images, monkeypatch):
+    fast = UnusableBatchExtractor("fast-model", {"a": make_receipt("A"), "b": make_receipt("B"), "c": make_receipt("C")})
+    strong = ScriptedExtractor("strong-model", {})
+    monkeypatch.setattr(extractors, "get_routes", lambda name=None: [fast, strong])
+
+    results = process_receipt.process_receipt_batch(images, use_cache=False)
+
+    assert [result["store_info"]["name"] for result in results] == ["A", "B", "C"]
+    assert fast.requests == [["a", "b", "c"], ["a"], ["b"], ["c"]]
+    assert strong.requests == []
+
+
+def test_every_request_is_throttled(images, monkeypatch):
+    fast = ScriptedExtractor("fast-model", {"a": make_receipt("A"), "b": make_receipt("B", subtotal=40.0), "c": make_receipt("C")})
+    strong = ScriptedExtractor("strong-model", {"b": make_receipt("B")})
+    monkeypatch.setattr(extractors, "get_routes", lambda name=None: [fast, strong])
+    charged = []
+
+    process_receipt.process_receipt_batch(images, use_cache=False, throttle=charged.append)
+
+    # The batched request for three receipts, then the strong model's request for the doubtful one
+    assert charged == [3, 1]
+
+
+def test_usage_log_is_upgraded_once_and_summary_follows_appends(tmp_path, monkeypatch):
+    log_file = tmp_path / "usage.csv"
+    log_file.write_text("timestamp,image_path,input_tokens,output_tokens,total_cost,image_hash\n"
+                        "2024-01-01T00:00:00,a.jpg,10,5,0.001000,abc\n")
+    monkeypatch.setattr(process_receipt, "USAGE_LOG_FILE", str(log_file))
+
+    process_receipt.prepare_usage_log(str(log_file))
+    process_receipt.log_usage("b.jpg", 100, 50, 0.01, "def", model="fast-model", route="fast", latency_ms=120)
+    assert [(row["route"], row["requests"]) for row in process_receipt.usage_summary(str(log_file))] == [
+        ("(before routing)", 1), ("fast", 1)]
+
+    process_receipt.log_usage("c.jpg", 100, 50, 0.01, "ghi", model="fast-model", route="fast", latency_ms=80)
+    summary = process_receipt.usage_summary(str(log_file))
+    assert summary[1]["requests"] == 2
+    assert log_file.read_text().splitlines()[0] == ",".join(process_receipt.USAGE_LOG_FIELDS)
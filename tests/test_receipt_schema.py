@@ -0,0 +1,158 @@
+"""Local validation and repair of extraction output, including truncated responses."""
+import json
+
+import pytest
+
+from receipt_schema import (
+    TRUNCATED, ReceiptValidationError, _close_truncated, confidence_problems, normalize_receipt,
+    parse_receipt, parse_receipt_batch,
+)
+
+
+def make_receipt(store="Green Valley Market", items=3):
+    return {
+        "store_info": {"name": store, "address": "12 Main St", "phone": "555-0100", "date": "2024-05-01"},
+        "items": [
+            {"name": f"Item \"{n}\" [x]", "price": 1.5 + n, "quantity": 1, "category": "Food", "subtotal": 1.5 + n}
+            for n in range(items)
+        ],
+        "transaction_details": {"subtotal": sum(1.5 + n for n in range(items)), "tax": 0.5,
+                                "total": sum(1.5 + n for n in range(items)) + 0.5,
+                                "payment_method": "Cash", "change": 0},
+    }
+
+
+def cut_after(text, marker, offset=0):
+    """Truncate text just after the first occurrence of marker (plus offset characters)."""
+    return text[:text.index(marker) + len(marker) + offset]
+
+
+RECEIPT_TEXT = json.dumps(make_receipt(), indent=2)
+
+
+def test_complete_response_needs_no_repairs():
+    data, repairs = parse_receipt(RECEIPT_TEXT)
+    assert repairs == []
+    assert data == make_receipt()
+
+
+def test_fences_and_surrounding_text_are_ignored():
+    data, repairs = parse_receipt(f"```json\nHere is the data: {RECEIPT_TEXT}\nHope this helps!\n```")
+    assert len(data["items"]) == 3
+    assert repairs == ["ignored text before the JSON object", "ignored text after the JSON object"]
+
+
+def test_truncated_inside_string_keeps_complete_items():
+    # Cut in the middle of the third item's name, inside its escaped quotes
+    data, repairs = parse_receipt(cut_after(RECEIPT_TEXT, 'Item \\"2', 0))
+    assert TRUNCATED in repairs
+    assert [item["name"] for item in data["items"]] == ['Item "0" [x]', 'Item "1" [x]']
+    # Missing totals are derived from the items that survived
+    assert data["transaction_details"]["subtotal"] == 4.0
+
+
+def test_truncated_between_array_elements():
+    data, repairs = parse_receipt(cut_after(RECEIPT_TEXT, '"subtotal": 2.5\n    },'))
+    assert TRUNCATED in repairs
+    assert len(data["items"]) == 2
+
+
+def test_truncated_inside_nested_object_keeps_complete_fields():
+    data, repairs = parse_receipt(cut_after(RECEIPT_TEXT, '"tax": 0.5,\n    "total"'))
+    assert TRUNCATED in repairs
+    assert len(data["items"]) == 3
+    assert data["transaction_details"]["tax"] == 0.5
+    assert data["transaction_details"]["total"] == data["transaction_details"]["subtotal"] + 0.5
+
+
+def test_truncated_inside_first_item_is_a_failure():
+    with pytest.raises(ReceiptValidationError, match="truncated before any complete item"):
+        parse_receipt(cut_after(RECEIPT_TEXT, '"price": 1.5'))
+
+
+def test_truncated_inside_store_info_is_a_failure():
+    with pytest.raises(ReceiptValidationError):
+        parse_receipt(cut_after(RECEIPT_TEXT, '"address": "12 Ma'))
+
+
+def test_close_truncated_ignores_brackets_inside_strings():
+    assert _close_truncated('{"a": "[{", "b": [1, 2') == {"a": "[{", "b": [1]}
+
+
+def test_close_truncated_rejects_balanced_malformed_json():
+    assert _close_truncated('{"a": 1,, "b": 2}') is None
+
+
+def test_malformed_response_is_not_repaired():
+    with pytest.raises(ReceiptValidationError):
+        parse_receipt('{"store_info": {"name": "X"},, "items": []}')
+    with pytest.raises(ReceiptValidationError):
+        parse_receipt("I could not read this receipt.")
+
+
+def test_normalize_repairs_prices_quantities_and_categories():
+    data, repairs = normalize_receipt({
+        "store_info": {"name": "Shop", "date": None},
+        "items": [
+            {"name": "Soap", "price": "$1,299.00", "category": "Health & Beauty"},
+            {"name": "Eggs", "quantity": 2, "subtotal": 6.0, "category": "groceries"},
+            {"name": "Tea", "price": 4.0, "quantity": 2, "subtotal": 4.0, "category": "Beverages"},
+            {"name": "Gizmo", "price": 3.0, "quantity": 1, "subtotal": 3.0, "category": "Unknown stuff"},
+        ],
+    })
+    soap, eggs, tea, gizmo = data["items"]
+    assert (soap["price"], soap["quantity"], soap["subtotal"], soap["category"]) == (1299.0, 1, 1299.0, "Personal Care")
+    assert (eggs["price"], eggs["category"]) == (3.0, "Food")
+    # The line total was read as the unit price
+    assert (tea["price"], tea["subtotal"]) == (2.0, 4.0)
+    assert gizmo["category"] == "Other"
+    assert data["store_info"]["date"] == ""
+    assert data["transaction_details"]["total"] == data["transaction_details"]["subtotal"] == 1312.0
+    assert "transaction subtotal derived from items" in repairs
+
+
+def test_normalize_rejects_items_without_a_price():
+    with pytest.raises(ReceiptValidationError, match="no price or subtotal"):
+        normalize_receipt({"items": [{"name": "Mystery"}]})
+    with pytest.raises(ReceiptValidationError):
+        normalize_receipt(["not", "an", "object"])
+
+
+def test_confidence_problems_flags_mismatched_totals():
+    data, repairs = parse_receipt(RECEIPT_TEXT)
+    assert confidence_problems(data, repairs) == []
+    data["transaction_details"]["subtotal"] = 50.0
+    assert confidence_problems(data, repairs) == ["items add up to 7.50, not the subtotal 50.00"]
+
+
+BATCH_TEXT = json.dumps([make_receipt("A"), make_receipt("B"), make_receipt("C")], indent=2)
+
+
+def test_batch_returns_receipts_in_order():
+    parsed = parse_receipt_batch(f"```json\n{BATCH_TEXT}\n```", 3)
+    assert [data["store_info"]["name"] for data, _ in parsed] == ["A", "B", "C"]
+
+
+def test_truncated_batch_keeps_only_complete_receipts():
+    # Cut inside the second receipt's second item: it is dropped whole, not closed
+    second = BATCH_TEXT.index('"name": "B"')
+    text = BATCH_TEXT[:BATCH_TEXT.index('Item \\"1', second)]
+    parsed = parse_receipt_batch(text, 3)
+    assert parsed[0][0]["store_info"]["name"] == "A"
+    assert parsed[1:] == [None, None]
+
+
+def test_batch_with_an_invalid_receipt_marks_only_that_one():
+    receipts = [make_receipt("A"), {"items": [{"name": "Mystery"}]}, make_receipt("C")]
+    parsed = parse_receipt_batch(json.dumps(receipts), 3)
+    assert parsed[1] is None
+    assert parsed[2][0]["store_info"]["name"] == "C"
+
+
+def test_batch_that_cannot_be_matched_to_images_is_rejected():
+    with pytest.raises(ReceiptValidationError, match="expected 4 receipts, got 3"):
+        parse_receipt_batch(BATCH_TEXT, 4)
+    with pytest.raises(ReceiptValidationError, match="not a JSON array"):
+        parse_receipt_batch(RECEIPT_TEXT, 1)
+    with pytest.raises(ReceiptValidationError):
+        parse_receipt_batch('[{"store_info": {"name": "A"', 2)
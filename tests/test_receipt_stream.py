@@ -0,0 +1,38 @@
+"""Partial results published while an extraction streams."""
+import json
+
+from receipt_stream import StreamProgress, mark_restarted, parse_partial_receipt
+
+RESPONSE = json.dumps({
+    "store_info": {"name": "Shop", "date": "2024-05-01"},
+    "items": [
+        {"name": "Tea", "price": "$2.50", "category": "Beverages", "subtotal": 2.5},
+        {"name": "Mystery", "category": "Food"},
+        {"name": "Soap", "price": 1.25, "quantity": 2, "category": "Personal Care", "subtotal": 2.5},
+    ],
+}, indent=2)
+
+
+def test_partial_items_are_normalized_for_display():
+    partial = parse_partial_receipt(RESPONSE)
+    assert partial["store_info"]["name"] == "Shop"
+    tea, soap = partial["items"]
+    assert (tea["price"], tea["quantity"], tea["subtotal"], tea["category"]) == (2.5, 1, 2.5, "Food")
+    assert soap["name"] == "Soap"
+
+
+def test_unfinished_items_are_not_published():
+    partial = parse_partial_receipt(RESPONSE[:RESPONSE.index('"Soap"') + 20])
+    assert [item["name"] for item in partial["items"]] == ["Tea"]
+    assert parse_partial_receipt(RESPONSE[:RESPONSE.index('"Tea"')]) == {
+        "store_info": {"name": "Shop", "date": "2024-05-01"}, "items": []}
+
+
+def test_partials_only_grow_and_restarts_are_marked():
+    published = []
+    progress = StreamProgress(mark_restarted(published.append), interval=0)
+    for start in range(0, len(RESPONSE), 40):
+        progress(RESPONSE[start:start + 40])
+    counts = [len(partial["items"]) for partial in published]
+    assert counts == sorted(counts) and counts[-1] == 2
+    assert all(partial["restarted"] for partial in published)
@@ -0,0 +1,148 @@
+"""Per-stage latency spans for the receipt ingestion pipeline.
+
+Wrap a stage in `span("extract.encode")` and its duration is appended as one
+JSON line to config.TRACE_LOG_FILE, shared by the app and worker processes:
+
+    {"ts": ..., "trace_id": ..., "stage": "extract.encode", "duration_ms": 41.2, "ok": true, "pid": 123, ...}
+
+Spans recorded inside `trace(trace_id)` carry that id, so all the stages of
+one upload can be lined up across processes. `stage_stats` computes rolling
+p50/p95/p99 per stage over the most recent spans in the log.
+"""
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+import config
+
+# Spans that enclose other stages; left out of per-trace totals so time is not counted twice
+ENVELOPE_STAGES = {"job.run"}
+
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+_write_lock = threading.Lock()
+
+
+@contextmanager
+def trace(trace_id):
+    """Tag spans recorded in this block (and this thread) with trace_id."""
+    token = _trace_id.set(trace_id)
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+
+@contextmanager
+def span(stage, **attrs):
+    """Time the enclosed block as `stage`. Yields attrs so callers can add to them."""
+    if not config.TRACING_ENABLED:
+        yield attrs
+        return
+    start = time.perf_counter()
+    ok = True
+    try:
+        yield attrs
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        record(stage, (time.perf_counter() - start) * 1000, ok, attrs)
+
+
+def record(stage, duration_ms, ok=True, attrs=None):
+    """Append a finished span to the trace log."""
+    if not config.TRACING_ENABLED:
+        return
+    entry = {
+        "ts": datetime.now().isoformat(timespec="milliseconds"),
+        "trace_id": _trace_id.get(),
+        "stage": stage,
+        "duration_ms": round(duration_ms, 3),
+        "ok": ok,
+        "pid": os.getpid(),
+    }
+    entry.update(attrs or {})
+    line = json.dumps(entry, default=str) + "\n"
+
+    log_file = config.TRACE_LOG_FILE
+    with _write_lock:
+        os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+        # Keep one rotated file so the log never grows without bound
+        if os.path.exists(log_file) and os.path.getsize(log_file) > config.TRACE_LOG_MAX_BYTES:
+            os.replace(log_file, log_file + ".1")
+        with open(log_file, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def read_recent_spans(max_bytes=4 * 1024 * 1024):
+    """Return spans from the last max_bytes of the trace log, oldest first."""
+    spans = []
+    log_file = config.TRACE_LOG_FILE
+    for path in (log_file + ".1", log_file):
+        if not os.path.exists(path):
+            continue
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            if size > max_bytes:
+                f.seek(size - max_bytes)
+                f.readline()  # Skip the partial first line
+            for line in f:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    # Ignore a line another process is still writing
+                    continue
+    return spans
+
+
+def _percentile(sorted_values, pct):
+    # Nearest-rank percentile
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def stage_stats(spans, window=None):
+    """Return {stage: {count, errors, mean_ms, p50_ms, p95_ms, p99_ms, max_ms}} over each stage's last `window` spans."""
+    window = window or config.TRACE_STATS_WINDOW
+    by_stage = defaultdict(list)
+    for entry in spans:
+        by_stage[entry["stage"]].append(entry)
+
+    stats = {}
+    for stage, entries in by_stage.items():
+        entries = entries[-window:]
+        durations = sorted(e["duration_ms"] for e in entries)
+        stats[stage] = {
+            "count": len(durations),
+            "errors": sum(1 for e in entries if not e.get("ok", True)),
+            "mean_ms": round(sum(durations) / len(durations), 2),
+            "p50_ms": round(_percentile(durations, 50), 2),
+            "p95_ms": round(_percentile(durations, 95), 2),
+            "p99_ms": round(_percentile(durations, 99), 2),
+            "max_ms": round(durations[-1], 2),
+        }
+    return stats
+
+
+def slowest_traces(spans, limit=10):
+    """Return the traces with the most total span time as [{trace_id, total_ms, stages}]."""
+    traces = defaultdict(lambda: {"total_ms": 0.0, "stages": defaultdict(float), "last_ts": ""})
+    for entry in spans:
+        if not entry.get("trace_id") or entry["stage"] in ENVELOPE_STAGES:
+            continue
+        t = traces[entry["trace_id"]]
+        t["total_ms"] += entry["duration_ms"]
+        t["stages"][entry["stage"]] += entry["duration_ms"]
+        t["last_ts"] = max(t["last_ts"], entry["ts"])
+    ranked = sorted(traces.items(), key=lambda kv: kv[1]["total_ms"], reverse=True)[:limit]
+    return [
+        {"trace_id": trace_id, "last_ts": t["last_ts"], "total_ms": round(t["total_ms"], 2),
+         "stages": {stage: round(ms, 2) for stage, ms in t["stages"].items()}}
+        for trace_id, t in ranked
+    ]
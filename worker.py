@@ -0,0 +1,90 @@
+"""Standalone extraction worker runner.
+
+Runs N worker processes (each with M threads) that claim jobs from the
+extraction_jobs table and process them. Start as many runners as needed, on
+one machine or several sharing the database:
+
+    python worker.py --processes 4 --threads 2
+
+Set EXTRACTION_WORKERS=0 for the Streamlit app to leave all extraction to
+these workers.
+"""
+import argparse
+import multiprocessing
+import signal
+import threading
+import time
+
+import config
+
+
+def _worker_thread(stop_event):
+    from jobs import drain_queue, make_worker_id
+
+    worker_id = make_worker_id()
+    while not stop_event.is_set():
+        try:
+            processed = drain_queue(worker_id, stop_event)
+        except Exception as e:
+            # Database hiccups should not kill the worker; back off and try again
+            print(f"[{worker_id}] error while draining queue: {e}")
+            processed = 0
+        if not processed:
+            stop_event.wait(config.WORKER_POLL_SECONDS)
+
+
+def worker_process(threads):
+    """Entry point of one worker process: run `threads` claim loops until signalled."""
+    from jobs import sweep_uploads
+    from migrations import run_migrations
+
+    run_migrations()
+    sweep_uploads()
+    stop_event = threading.Event()
+
+    def handle_signal(signum, frame):
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    workers = [
+        threading.Thread(target=_worker_thread, args=(stop_event,), name=f"worker-{i}")
+        for i in range(threads)
+    ]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run receipt extraction worker processes.")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="Worker processes to start (default: CPU count)")
+    parser.add_argument("--threads", type=int, default=2, help="Concurrent jobs per process (default: 2)")
+    args = parser.parse_args()
+
+    # Spawn rather than fork so every process opens its own database connections
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=worker_process, args=(args.threads,), name=f"extraction-worker-{i}")
+        for i in range(args.processes)
+    ]
+    for p in processes:
+        p.start()
+    print(f"Started {len(processes)} worker processes x {args.threads} threads")
+
+    def shutdown(signum, frame):
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+
+    # Children stop claiming on SIGTERM and exit after finishing their current job
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    while any(p.is_alive() for p in processes):
+        time.sleep(1)
+
+
+if __name__ == "__main__":
+    main()